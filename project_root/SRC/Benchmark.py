@@ -0,0 +1,256 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+
+from DataSimulator import DataSimulator
+from DB_Setup import init_db, TestingSimulationData
+from DB import DatabaseManager
+from Kernels import NUMBA_AVAILABLE
+from Features import BASE_FEATURES
+from Main import IMPORT_MODULES
+from PredictMed import evaluate_rolling_forecast
+
+
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINE_PATH = os.path.join(SOURCE_DIR, "benchmark_baseline.json")
+
+# A case counts as a regression when its best time exceeds the baseline by this factor
+REGRESSION_TOLERANCE = 1.5
+
+SIMULATION_MONTHS = (120, 1_200, 12_000)
+SIMULATION_SCENARIOS = (1, 100, 10_000)
+# Scenarios of 121 months per database benchmark: ~1k, 12k and 121k rows
+DB_SCENARIOS = (10, 100, 1_000)
+ORM_SCENARIOS = (10, 100)
+EVALUATION_SCENARIOS = (1, 100, 1_000)
+
+
+class IdentityScaler:
+    """
+    Stand-in scaler so the evaluation benchmark measures the forecast loop, not sklearn.
+    """
+
+    def transform(self, X):
+        return np.asarray(X, dtype=float)
+
+
+class ConstantModel:
+    """
+    Stand-in model predicting the same shortage level for every row.
+    """
+
+    def __init__(self, value=5.0):
+        self.value = value
+
+    def predict(self, X):
+        return np.full(len(X), self.value)
+
+
+def measure(function, repeat=5, setup=None):
+    """
+    Time `function` `repeat` times (after an untimed warm-up call) and return the
+    best and median seconds. `setup`, if given, runs untimed before every call and
+    its result is passed to `function`. Output of the benchmarked code is silenced.
+    """
+    timings = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for run in range(repeat + 1):
+            argument = setup() if setup is not None else None
+            start = time.perf_counter()
+            function(argument) if setup is not None else function()
+            elapsed = time.perf_counter() - start
+            if run > 0:
+                timings.append(elapsed)
+    return {"best": min(timings), "median": statistics.median(timings), "repeat": repeat}
+
+
+def _largest_dropped(sizes, quick):
+    return sizes[:-1] if quick else sizes
+
+
+def simulator_benchmarks(quick=False):
+    # The baseline cases pin the NumPy engine; the compiled engine gets its own cases
+    for months in _largest_dropped(SIMULATION_MONTHS, quick):
+        simulator = DataSimulator(random_state=42, months_to_simulate=months, engine='numpy')
+        yield f"simulate_sales_and_stock[months={months}]", lambda s=simulator: s.simulate_sales_and_stock(), 5, None
+
+    for n_scenarios in _largest_dropped(SIMULATION_SCENARIOS, quick):
+        simulator = DataSimulator(random_state=42, engine='numpy')
+        yield (f"simulate_batch[scenarios={n_scenarios}]",
+               lambda s=simulator, n=n_scenarios: s.simulate_batch(n, seed=0), 3, None)
+
+    if NUMBA_AVAILABLE:
+        for n_scenarios in _largest_dropped(SIMULATION_SCENARIOS, quick):
+            simulator = DataSimulator(random_state=42, engine='numba')
+            yield (f"simulate_batch[scenarios={n_scenarios},engine=numba]",
+                   lambda s=simulator, n=n_scenarios: s.simulate_batch(n, seed=0), 3, None)
+
+
+def database_benchmarks(quick=False):
+    with tempfile.TemporaryDirectory(prefix="benchmark_db_") as scratch_dir:
+        yield from _database_cases(scratch_dir, quick)
+
+
+def _database_cases(scratch_dir, quick):
+    # One scratch database per case, so earlier cases do not grow the tables
+    def database(name):
+        return DatabaseManager(init_db(os.path.join(scratch_dir, f"{name}.db")))
+
+    for n_scenarios in _largest_dropped(ORM_SCENARIOS, quick):
+        simulation = DataSimulator(random_state=42).simulate_batch(n_scenarios, seed=0)
+        db_manager = database(f"orm_{n_scenarios}")
+        yield (f"save_simulation_to_db[rows={len(simulation)}]",
+               lambda run_id, db=db_manager, df=simulation: db.save_simulation_to_db(df, TestingSimulationData,
+                                                                                     run_id=run_id),
+               3, db_manager.create_simulation_run)
+
+    for n_scenarios in _largest_dropped(DB_SCENARIOS, quick):
+        simulation = DataSimulator(random_state=42).simulate_batch(n_scenarios, seed=0)
+        db_manager = database(f"bulk_{n_scenarios}")
+        yield (f"bulk_save_simulation_to_db[rows={len(simulation)}]",
+               lambda run_id, db=db_manager, df=simulation: db.bulk_save_simulation_to_db(df, TestingSimulationData,
+                                                                                          run_id=run_id),
+               3, db_manager.create_simulation_run)
+
+    for n_scenarios in _largest_dropped(DB_SCENARIOS, quick):
+        simulation = DataSimulator(random_state=42).simulate_batch(n_scenarios, seed=0)
+        db_manager = database(f"load_{n_scenarios}")
+        with contextlib.redirect_stdout(io.StringIO()):
+            db_manager.bulk_save_simulation_to_db(simulation, TestingSimulationData,
+                                                  run_id=db_manager.create_simulation_run())
+        yield (f"load_simulation_data[rows={len(simulation)}]",
+               lambda db=db_manager: db.load_simulation_data(TestingSimulationData), 3, None)
+        yield (f"load_summary[rows={len(simulation)}]",
+               lambda db=db_manager: db.load_summary(TestingSimulationData, group_by=['month_name']), 5, None)
+
+
+def evaluation_benchmarks(quick=False):
+    scaler, model = IdentityScaler(), ConstantModel()
+    for n_scenarios in _largest_dropped(EVALUATION_SCENARIOS, quick):
+        testing_df = DataSimulator(random_state=99).simulate_batch(n_scenarios, seed=1)
+        yield (f"evaluate_rolling_forecast[scenarios={n_scenarios}]",
+               lambda df=testing_df: evaluate_rolling_forecast(df, BASE_FEATURES, scaler, model, steps=12), 5, None)
+
+
+def import_benchmarks(quick=False):
+    # Every case starts a fresh interpreter, so it pays the cold imports plus interpreter startup
+    def run_python(*args, cwd=SOURCE_DIR):
+        subprocess.run([sys.executable, *args], cwd=cwd, check=True, capture_output=True)
+
+    for module in IMPORT_MODULES:
+        yield f"import[{module}]", lambda m=module: run_python("-c", f"import {m}"), 3, None
+
+    # The report subcommand from an empty directory: CLI startup without any cached data
+    with tempfile.TemporaryDirectory(prefix="benchmark_cli_") as scratch_dir:
+        yield ("cli[report]", lambda: run_python(os.path.join(SOURCE_DIR, "Main.py"), "report", cwd=scratch_dir),
+               3, None)
+
+
+BENCHMARKS = {
+    "simulator": simulator_benchmarks,
+    "database": database_benchmarks,
+    "evaluation": evaluation_benchmarks,
+    "imports": import_benchmarks,
+}
+
+
+def run_benchmarks(groups=None, quick=False):
+    """
+    Run the benchmark groups (default: all) and return {case: timing}.
+    """
+    results = {}
+    for group in groups or BENCHMARKS:
+        for name, function, repeat, setup in BENCHMARKS[group](quick):
+            results[name] = measure(function, repeat=repeat, setup=setup)
+            print(f"{name:<50} best {results[name]['best']:9.4f}s   median {results[name]['median']:9.4f}s")
+    return results
+
+
+def compare(results, baseline, tolerance=REGRESSION_TOLERANCE):
+    """
+    Ratio of every case's best time to the baseline. Returns the regressed cases.
+    """
+    regressions = {}
+    for name, timing in results.items():
+        if name not in baseline.get("results", {}):
+            print(f"{name:<50} no baseline")
+            continue
+        ratio = timing["best"] / baseline["results"][name]["best"]
+        flag = "REGRESSION" if ratio > tolerance else ""
+        print(f"{name:<50} {ratio:6.2f}x baseline {flag}")
+        if ratio > tolerance:
+            regressions[name] = ratio
+    return regressions
+
+
+def environment():
+    return {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the simulator, database layer, forecast evaluation and imports.")
+    parser.add_argument("--group", nargs="+", choices=list(BENCHMARKS), help="Only run these benchmark groups.")
+    parser.add_argument("--quick", action="store_true", help="Skip the largest size of every benchmark.")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="Baseline file to compare against.")
+    parser.add_argument("--save-baseline", action="store_true", help="Store the results as the new baseline.")
+    parser.add_argument("--output", help="Also write the results to this JSON file.")
+    parser.add_argument("--tolerance", type=float, default=REGRESSION_TOLERANCE,
+                        help="Slowdown factor against the baseline that counts as a regression.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = {"environment": environment(), "results": run_benchmarks(args.group, args.quick)}
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+
+    if args.save_baseline:
+        baseline = {"results": {}}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as baseline_file:
+                baseline = json.load(baseline_file)
+        # Keep the baseline of cases that were not run this time
+        baseline["environment"] = report["environment"]
+        baseline["results"].update(report["results"])
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(baseline, baseline_file, indent=2)
+        print(f"Baseline written to {args.baseline}.")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}; run with --save-baseline first.")
+        return 0
+
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+    print(f"\nCompared with the baseline from {baseline['environment']['created_at']}:")
+    regressions = compare(report["results"], baseline, args.tolerance)
+    if regressions:
+        print(f"{len(regressions)} case(s) slower than {args.tolerance}x the baseline.")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
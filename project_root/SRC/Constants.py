@@ -0,0 +1,5 @@
+# Shared domain constants. Keep this module free of imports so that the schema,
+# the kernels and the simulator can all use it without pulling in each other.
+
+# Shortage level from which a month counts as a shortage month
+SHORTAGE_THRESHOLD = 7
@@ -1,9 +1,30 @@
+import calendar
+import json
+import time
+
 from sqlalchemy.engine import row
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy import select, func
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from DB_Setup import *
+import numpy as np
 import pandas as pd
 from sqlalchemy.orm import joinedload
 
+from utils import count, timed
+
+
+DATA_COLUMNS = [
+    'sales', 'stock', 'wirkstoff_stock', 'demand_spike_indicator', 'stock_to_sales_ratio',
+    'time_since_last_shortage_event', 'months_since_prod_issue', 'cumulative_shortages',
+    'sales_to_stock_ratio', 'wirkstoff_stock_percentage', 'shortage_level', 'last_restock_amount',
+    'days_since_last_restock', 'trend', 'seasonal', 'residual',
+]
+
+# Columns the summary tables can be grouped by
+SUMMARY_GROUPS = ['run_id', 'product_id', 'site_id', 'scenario_id', 'month_name']
+MONTH_ORDER = {name: month for month, name in enumerate(calendar.month_name) if name}
+
 
 class DatabaseManager:
     def __init__(self, engine):
@@ -14,10 +35,80 @@ class DatabaseManager:
         Session = sessionmaker(bind=self.engine)
         return Session()
 
-    def save_simulation_to_db(self, simulation_df, table):
+    def create_simulation_run(self, parameters=None, seed=None):
+        """
+        Register a new simulation run and return its run_id.
+        """
+        run = SimulationRun(parameters=json.dumps(parameters or {}, default=float), seed=seed)
+        self.session.add(run)
+        self.session.commit()
+        return run.run_id
+
+    def save_network(self, products=None, sites=None):
+        """
+        Insert or update the product and site dimension rows (DataFrames as
+        returned by `Network.make_network`), keyed by their ids.
+        """
+        self.session.commit()
+        with self.engine.begin() as connection:
+            for table, frame in ((Product, products), (Site, sites)):
+                if frame is None or frame.empty:
+                    continue
+                columns = [column.name for column in table.__table__.columns if column.name in frame.columns]
+                key = table.__table__.primary_key.columns.keys()[0]
+                records = [dict(zip(columns, values)) for values in zip(*(frame[column].tolist() for column in columns))]
+                statement = sqlite_insert(table)
+                connection.execute(
+                    statement.on_conflict_do_update(index_elements=[key],
+                                                    set_={column: statement.excluded[column]
+                                                          for column in columns if column != key}),
+                    records,
+                )
+
+    def load_products(self):
+        """
+        The product dimension table as a DataFrame.
+        """
+        return pd.read_sql(select(Product).order_by(Product.product_id), self.engine)
+
+    def load_sites(self):
+        """
+        The site dimension table as a DataFrame.
+        """
+        return pd.read_sql(select(Site).order_by(Site.site_id), self.engine)
+
+    def load_runs(self):
+        """
+        All simulation runs (run_id, parameters as JSON text, seed, created_at) as a DataFrame.
+        """
+        return pd.read_sql(select(SimulationRun).order_by(SimulationRun.run_id), self.engine)
+
+    def delete_runs(self, run_ids, tables=(TrainingSimulationData, TestingSimulationData)):
+        """
+        Delete simulation runs and their rows (and summaries) from the given tables.
+        """
+        run_ids = list(run_ids)
+        for table in tables:
+            self.session.query(table).filter(table.run_id.in_(run_ids)).delete(synchronize_session=False)
+            summary = SUMMARY_TABLES[table]
+            self.session.query(summary).filter(summary.run_id.in_(run_ids)).delete(synchronize_session=False)
+        self.session.query(SimulationRun).filter(SimulationRun.run_id.in_(run_ids)).delete(synchronize_session=False)
+        self.session.commit()
+
+    def count_run_rows(self, table, run_ids):
+        """
+        Number of rows stored for the given runs.
+        """
+        return self.session.query(table).filter(table.run_id.in_(list(run_ids))).count()
+
+    @timed('db.save_simulation')
+    def save_simulation_to_db(self, simulation_df, table, run_id=None):
         """
         Save simulation data to the specified table (training or testing).
+        The summary of `run_id` is refreshed in the same transaction; rows
+        without a run are not summarized.
         """
+        start = time.perf_counter()
         date_id_map = {}
         for date in simulation_df['date'].unique():
             existing_date = self.session.query(Dates).filter_by(date=date).first()
@@ -35,6 +126,8 @@ class DatabaseManager:
         for _, row in simulation_df.iterrows():
             simulation_data = table(
                 date_id=date_id_map[row['date']],
+                run_id=run_id,
+                scenario_id=row.get('scenario_id', 0),
                 sales=row['sales'],
                 stock=row['stock'],
                 wirkstoff_stock=row['wirkstoff_stock'],
@@ -54,52 +147,212 @@ class DatabaseManager:
             )
             self.session.add(simulation_data)
 
+        if run_id is not None:
+            self.session.flush()
+            refresh_summary(self.session.connection(), table, [run_id])
+        self.session.commit()
+        return self._report_insert(table, len(simulation_df), time.perf_counter() - start)
+
+    @timed('db.bulk_save_simulation')
+    def bulk_save_simulation_to_db(self, simulation_df, table, run_id=None, chunk_size=50_000):
+        """
+        Save simulation data in bulk: one set-based upsert for the dates,
+        chunked executemany inserts for the rows and the summary refresh of
+        `run_id`, all in one transaction.
+        """
+        start = time.perf_counter()
+        # Make sure the ORM session does not hold a write lock on the database
         self.session.commit()
 
+        value_columns = [column.name for column in table.__table__.columns
+                         if column.name in simulation_df.columns and not column.primary_key
+                         and column.name not in ('date_id', 'run_id')]
+
+        with self.engine.connect() as connection:
+            with connection.begin():
+                unique_dates = simulation_df[['date', 'month_name']].drop_duplicates('date')
+                connection.execute(
+                    sqlite_insert(Dates).on_conflict_do_nothing(index_elements=['date']),
+                    unique_dates.to_dict('records'),
+                )
+                date_id_map = dict(connection.execute(
+                    select(Dates.date, Dates.date_id).where(Dates.date.in_(unique_dates['date'].tolist()))
+                ).all())
+
+                rows = simulation_df[value_columns].assign(date_id=simulation_df['date'].map(date_id_map),
+                                                           run_id=run_id)
+                insert_columns = ['date_id', 'run_id'] + value_columns
+                for chunk_start in range(0, len(rows), chunk_size):
+                    chunk = rows.iloc[chunk_start:chunk_start + chunk_size]
+                    # .tolist() converts numpy scalars into types the sqlite driver can bind
+                    records = [dict(zip(insert_columns, values))
+                               for values in zip(*(chunk[column].tolist() for column in insert_columns))]
+                    connection.execute(table.__table__.insert(), records)
+
+                if run_id is not None:
+                    refresh_summary(connection, table, [run_id])
+
+        return self._report_insert(table, len(simulation_df), time.perf_counter() - start)
+
+    @staticmethod
+    def _report_insert(table, row_count, elapsed):
+        """
+        Print and return the insert throughput for one save call.
+        """
+        rows_per_second = row_count / elapsed if elapsed > 0 else float('inf')
+        count('db.rows_inserted', row_count)
+        print(f"Inserted {row_count} rows into {table.__tablename__} in {elapsed:.2f}s "
+              f"({rows_per_second:,.0f} rows/s).")
+        return {"rows": row_count, "seconds": elapsed, "rows_per_second": rows_per_second}
+
+    @timed('db.load_summary')
+    def load_summary(self, table, group_by=('month_name',), run_ids=None, scenario_ids=None, month_names=None,
+                     product_ids=None, site_ids=None):
+        """
+        Shortage rate (share of months with shortage_level >= SHORTAGE_THRESHOLD),
+        mean stock, mean sales and spike frequency per group of `group_by`
+        (any of `SUMMARY_GROUPS`), read from the summary table instead of the
+        simulation rows. Rows without a product or site have id 0. Months are
+        in calendar order.
+        """
+        group_by = list(group_by)
+        unknown = set(group_by) - set(SUMMARY_GROUPS)
+        if unknown:
+            raise ValueError(f"Cannot group by {sorted(unknown)}. Choose from {SUMMARY_GROUPS}.")
+
+        summary = SUMMARY_TABLES[table]
+        n_months = func.sum(summary.n_months)
+        query = select(
+            *(getattr(summary, key) for key in group_by),
+            n_months.label('n_months'),
+            (func.sum(summary.shortage_months) * 1.0 / n_months).label('shortage_rate'),
+            (func.sum(summary.sum_stock) / n_months).label('mean_stock'),
+            (func.sum(summary.sum_sales) / n_months).label('mean_sales'),
+            (func.sum(summary.spike_months) * 1.0 / n_months).label('spike_frequency'),
+            func.max(summary.max_shortage_level).label('max_shortage_level'),
+        ).group_by(*(getattr(summary, key) for key in group_by))
+
+        if run_ids is not None:
+            query = query.where(summary.run_id.in_(list(run_ids)))
+        if scenario_ids is not None:
+            query = query.where(summary.scenario_id.in_(list(scenario_ids)))
+        if month_names is not None:
+            query = query.where(summary.month_name.in_(list(month_names)))
+        if product_ids is not None:
+            query = query.where(summary.product_id.in_(list(product_ids)))
+        if site_ids is not None:
+            query = query.where(summary.site_id.in_(list(site_ids)))
+
+        with self.engine.connect() as connection:
+            frame = pd.DataFrame(connection.execute(query).all(), columns=group_by + [
+                'n_months', 'shortage_rate', 'mean_stock', 'mean_sales', 'spike_frequency', 'max_shortage_level'])
+        if group_by:
+            frame = frame.sort_values(group_by, ignore_index=True, key=lambda column: (
+                column.map(MONTH_ORDER) if column.name == 'month_name' else column))
+        return frame
+
     def load_simulation_data(self, table):
         """
         Load simulation data from the specified table (training or testing).
         """
-        query = self.session.query(
-            table.sales,
-            table.stock,
-            table.wirkstoff_stock,
-            table.demand_spike_indicator,
-            table.stock_to_sales_ratio,
-            table.time_since_last_shortage_event,
-            table.months_since_prod_issue,
-            table.cumulative_shortages,
-            table.sales_to_stock_ratio,
-            table.wirkstoff_stock_percentage,
-            table.shortage_level,
-            table.last_restock_amount,
-            table.days_since_last_restock,
-            table.trend,
-            table.seasonal,
-            table.residual,
-            Dates.date  # Selecting the `date` field from the `Dates` table
-        ).join(Dates, table.date_id == Dates.date_id)  # Proper join with Dates table
-
-        df = pd.DataFrame([{
-            'date': row.date,  # Accessing the date from the Dates table
-            'sales': row.sales,
-            'stock': row.stock,
-            'wirkstoff_stock': row.wirkstoff_stock,
-            'demand_spike_indicator': row.demand_spike_indicator,
-            'stock_to_sales_ratio': row.stock_to_sales_ratio,
-            'time_since_last_shortage_event': row.time_since_last_shortage_event,
-            'months_since_prod_issue': row.months_since_prod_issue,
-            'cumulative_shortages': row.cumulative_shortages,
-            'sales_to_stock_ratio': row.sales_to_stock_ratio,
-            'wirkstoff_stock_percentage': row.wirkstoff_stock_percentage,
-            'shortage_level': row.shortage_level,
-            'last_restock_amount': row.last_restock_amount,
-            'days_since_last_restock': row.days_since_last_restock,
-            'trend': row.trend,
-            'seasonal': row.seasonal,
-            'residual': row.residual
-        } for row in query.all()])
-
-        return df
+        return self.load_simulation_frame(table)
+
+    @timed('db.load_simulation')
+    def load_simulation_frame(self, table, columns=None, start_date=None, end_date=None, run_ids=None,
+                              scenario_ids=None, product_ids=None, site_ids=None, chunk_size=50_000):
+        """
+        Load simulation data into one DataFrame, streamed from SQL in chunks.
+        See `iter_simulation_data` for the projection and filter arguments.
+        """
+        chunks = list(self.iter_simulation_data(table, columns, start_date, end_date, run_ids, scenario_ids,
+                                                product_ids, site_ids, chunk_size))
+        if not chunks:
+            return pd.DataFrame(columns=['date'] + DATA_COLUMNS if columns is None else columns)
+        return pd.concat(chunks, ignore_index=True)
+
+    def iter_simulation_data(self, table, columns=None, start_date=None, end_date=None, run_ids=None,
+                             scenario_ids=None, product_ids=None, site_ids=None, chunk_size=50_000):
+        """
+        Yield simulation data as DataFrames of at most `chunk_size` rows.
+
+        Only `columns` are selected (default: date plus all data columns), and the
+        date range (inclusive, 'YYYY-MM-DD'), run, scenario, product and site
+        filters run in SQL.
+        """
+        query = self._simulation_query(table, columns, start_date, end_date, run_ids, scenario_ids, product_ids,
+                                       site_ids)
+
+        with self.engine.connect() as connection:
+            result = connection.execution_options(stream_results=True).execute(query)
+            names = list(result.keys())
+            for rows in result.partitions(chunk_size):
+                count('db.rows_loaded', len(rows))
+                yield self._rows_to_frame(query, names, rows)
+
+    @timed('db.load_simulation_page')
+    def load_simulation_page(self, table, page=0, page_size=1_000, columns=None, start_date=None, end_date=None,
+                             run_ids=None, scenario_ids=None, product_ids=None, site_ids=None):
+        """
+        One page of the rows `load_simulation_frame` returns, in the same order.
+        Returns the page as a DataFrame and whether further pages follow.
+        """
+        query = self._simulation_query(table, columns, start_date, end_date, run_ids, scenario_ids, product_ids,
+                                       site_ids)
+        # One extra row tells whether there is a next page
+        query = query.offset(page * page_size).limit(page_size + 1)
+
+        with self.engine.connect() as connection:
+            result = connection.execute(query)
+            names = list(result.keys())
+            rows = result.all()
+        count('db.rows_loaded', min(len(rows), page_size))
+        return self._rows_to_frame(query, names, rows[:page_size]), len(rows) > page_size
+
+    @classmethod
+    def _rows_to_frame(cls, query, names, rows):
+        """
+        Build typed columns straight from the row tuples, without per-row dicts.
+        """
+        dtypes = {column.name: float for column in query.selected_columns if isinstance(column.type, Float)}
+        dtypes['date'] = object
+        if not rows:
+            return pd.DataFrame({name: np.array([], dtype=dtypes.get(name, float)) for name in names})
+        return pd.DataFrame({name: cls._typed_column(values, dtypes.get(name))
+                             for name, values in zip(names, zip(*rows))})
+
+    @staticmethod
+    def _typed_column(values, dtype):
+        """
+        Convert one column of row values to a NumPy array; integer columns with NULLs become float.
+        """
+        if dtype is None and None in values:
+            dtype = float
+        return np.array(values, dtype=dtype)
+
+    @staticmethod
+    def _simulation_query(table, columns, start_date, end_date, run_ids, scenario_ids, product_ids=None,
+                          site_ids=None):
+        """
+        Build the projected and filtered SELECT behind the simulation loaders.
+        """
+        columns = ['date'] + DATA_COLUMNS if columns is None else list(columns)
+        selected = [Dates.date.label('date') if name == 'date' else getattr(table, name).label(name)
+                    for name in columns]
+        query = select(*selected).order_by(table.simulation_id)
 
+        if 'date' in columns or start_date is not None or end_date is not None:
+            query = query.join(Dates, table.date_id == Dates.date_id)
+        if start_date is not None:
+            query = query.where(Dates.date >= start_date)
+        if end_date is not None:
+            query = query.where(Dates.date <= end_date)
+        if run_ids is not None:
+            query = query.where(table.run_id.in_(list(run_ids)))
+        if scenario_ids is not None:
+            query = query.where(table.scenario_id.in_(list(scenario_ids)))
+        if product_ids is not None:
+            query = query.where(table.product_id.in_(list(product_ids)))
+        if site_ids is not None:
+            query = query.where(table.site_id.in_(list(site_ids)))
 
+        return query
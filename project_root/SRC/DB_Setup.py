@@ -1,13 +1,25 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, ForeignKey
-from sqlalchemy.orm import declarative_base
+from datetime import datetime
+
+from sqlalchemy import (create_engine, event, inspect, text, select, func, case, MetaData, Column, Integer, String,
+                        Float, ForeignKey, DateTime, Text, Index)
+from sqlalchemy.orm import declarative_base, declared_attr
+
+from Constants import SHORTAGE_THRESHOLD
 
 Base = declarative_base()
 
+SCHEMA_VERSION = 5
+
 
 # Shared schema for training and testing tables
 class BaseSimulationData:
     simulation_id = Column(Integer, primary_key=True)
-    date_id = Column(Integer, ForeignKey('dates.date_id'))
+    run_id = Column(Integer, ForeignKey('simulation_runs.run_id'))
+    scenario_id = Column(Integer, nullable=False, default=0, server_default='0')
+    # Set for network simulations only; single-drug runs leave them NULL
+    product_id = Column(Integer, ForeignKey('products.product_id'))
+    site_id = Column(Integer, ForeignKey('sites.site_id'))
+    date_id = Column(Integer, ForeignKey('dates.date_id'), index=True)
     sales = Column(Float)
     stock = Column(Float)
     wirkstoff_stock = Column(Float)
@@ -26,6 +38,13 @@ class BaseSimulationData:
     trend = Column(Float)
     seasonal = Column(Float)
     residual = Column(Float)
+    wirkstoff_allocation = Column(Float)  # Share of the requested Wirkstoff the shared pool delivered
+
+    @declared_attr
+    def __table_args__(cls):
+        # Per-run, per-scenario and per-product queries become index range scans
+        return (Index(f'ix_{cls.__tablename__}_run_scenario_date', 'run_id', 'scenario_id', 'date_id'),
+                Index(f'ix_{cls.__tablename__}_product_site', 'product_id', 'site_id', 'run_id'))
 
 
 class TrainingSimulationData(Base, BaseSimulationData):
@@ -36,6 +55,72 @@ class TestingSimulationData(Base, BaseSimulationData):
     __tablename__ = 'testing_simulation_data'
 
 
+# Per run, product, site, scenario and calendar month: counts and sums, so summaries of new rows
+# add up and rates and means over any grouping are exact. Rows without a product or site have id 0.
+class BaseSimulationSummary:
+    run_id = Column(Integer, ForeignKey('simulation_runs.run_id'), primary_key=True)
+    product_id = Column(Integer, primary_key=True, default=0)
+    site_id = Column(Integer, primary_key=True, default=0)
+    scenario_id = Column(Integer, primary_key=True)
+    month_name = Column(String, primary_key=True)
+    n_months = Column(Integer, nullable=False)
+    shortage_months = Column(Integer, nullable=False)  # Months with shortage_level >= SHORTAGE_THRESHOLD
+    spike_months = Column(Integer, nullable=False)
+    sum_sales = Column(Float)
+    sum_stock = Column(Float)
+    max_shortage_level = Column(Integer)
+
+
+class TrainingSimulationSummary(Base, BaseSimulationSummary):
+    __tablename__ = 'training_simulation_summary'
+
+
+class TestingSimulationSummary(Base, BaseSimulationSummary):
+    __tablename__ = 'testing_simulation_summary'
+
+
+SUMMARY_TABLES = {TrainingSimulationData: TrainingSimulationSummary, TestingSimulationData: TestingSimulationSummary}
+
+
+class SimulationRun(Base):
+    __tablename__ = 'simulation_runs'
+    run_id = Column(Integer, primary_key=True)
+    parameters = Column(Text)  # JSON-encoded simulator parameters
+    seed = Column(Integer)
+    created_at = Column(DateTime, default=datetime.now)
+
+    # Never reuse the id of a deleted run, so caches keyed by run_id stay valid
+    __table_args__ = {'sqlite_autoincrement': True}
+
+
+class TrainedModel(Base):
+    __tablename__ = 'trained_models'
+    model_id = Column(Integer, primary_key=True)
+    model_name = Column(String, nullable=False)
+    fingerprint = Column(String, nullable=False)  # Hash of training data, features and param grid
+    best_params = Column(Text)  # JSON-encoded best_params_
+    scaler_path = Column(String)
+    model_path = Column(String)
+    created_at = Column(DateTime, default=datetime.now)
+
+    __table_args__ = (Index('ix_trained_models_name_fingerprint', 'model_name', 'fingerprint', unique=True),)
+
+
+class Product(Base):
+    __tablename__ = 'products'
+    product_id = Column(Integer, primary_key=True)
+    name = Column(String, unique=True, nullable=False)
+    wirkstoff = Column(String, nullable=False)  # Products with the same Wirkstoff share its stock
+    demand_share = Column(Float)  # Demand relative to the single reference drug
+
+
+class Site(Base):
+    __tablename__ = 'sites'
+    site_id = Column(Integer, primary_key=True)
+    name = Column(String, unique=True, nullable=False)
+    capacity_share = Column(Float)  # Share of the network's production capacity
+
+
 class Dates(Base):
     __tablename__ = 'dates'
     date_id = Column(Integer, primary_key=True)
@@ -44,8 +129,131 @@ class Dates(Base):
 
 
 # Initialize database
-def init_db(db_name='simulation_3nf.db'):
-    engine = create_engine(f'sqlite:///{db_name}', echo=False)
+def set_connection_pragmas(dbapi_connection, connection_record):
+    # synchronous is per connection; NORMAL is safe in WAL mode and skips an fsync per commit
+    dbapi_connection.execute("PRAGMA synchronous=NORMAL")
+
+
+def init_db(db_name='simulation_3nf.db', **engine_options):
+    # engine_options go to create_engine, e.g. pool_size for services with concurrent readers
+    engine = create_engine(f'sqlite:///{db_name}', echo=False, **engine_options)
+    event.listen(engine, 'connect', set_connection_pragmas)
+    with engine.connect() as connection:
+        # WAL is the database's permanent journal mode: it is stored in the file, lets
+        # readers run alongside a writer and makes bulk loads cheaper to commit
+        connection.exec_driver_sql("PRAGMA journal_mode=WAL")
     Base.metadata.create_all(engine)
+    migrate_db(engine)
     return engine
 
+
+def refresh_summary(connection, table, run_ids=None):
+    """
+    Recompute the summary rows of the given runs (default: all) from the
+    simulation `table` in SQL. Only the groups of these runs are touched, so
+    refreshing after an insert costs as much as the inserted run.
+    """
+    data, summary = table.__table__, SUMMARY_TABLES[table].__table__
+    product_id, site_id = func.coalesce(data.c.product_id, 0), func.coalesce(data.c.site_id, 0)
+    aggregates = (
+        select(data.c.run_id, product_id, site_id, data.c.scenario_id, Dates.month_name, func.count(),
+               func.sum(case((data.c.shortage_level >= SHORTAGE_THRESHOLD, 1), else_=0)),
+               func.sum(case((data.c.demand_spike_indicator > 0, 1), else_=0)),
+               func.sum(data.c.sales), func.sum(data.c.stock), func.max(data.c.shortage_level))
+        .join_from(data, Dates.__table__, data.c.date_id == Dates.date_id)
+        .where(data.c.run_id.is_not(None))
+        .group_by(data.c.run_id, product_id, site_id, data.c.scenario_id, Dates.month_name)
+    )
+    delete = summary.delete()
+    if run_ids is not None:
+        aggregates = aggregates.where(data.c.run_id.in_(list(run_ids)))
+        delete = delete.where(summary.c.run_id.in_(list(run_ids)))
+
+    connection.execute(delete)
+    connection.execute(summary.insert().from_select(
+        ['run_id', 'product_id', 'site_id', 'scenario_id', 'month_name', 'n_months', 'shortage_months',
+         'spike_months', 'sum_sales', 'sum_stock', 'max_shortage_level'], aggregates))
+
+
+def rebuild_runs_table(connection):
+    """
+    Recreate a `simulation_runs` table created without AUTOINCREMENT, keeping
+    its rows. The id sequence starts after the highest run id still referenced
+    anywhere, so ids of deleted runs are not handed out again from now on.
+    """
+    table = SimulationRun.__table__
+    create_sql = connection.execute(
+        text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"), {"name": table.name}
+    ).scalar()
+    if create_sql is None or 'AUTOINCREMENT' in create_sql.upper():
+        return
+
+    # Create, copy, drop, rename: renaming the old table would repoint the foreign keys of the data tables
+    rebuilt = table.to_metadata(MetaData(), name=f'{table.name}_rebuilt')
+    rebuilt.create(connection)
+    columns = ', '.join(column.name for column in table.columns)
+    connection.exec_driver_sql(f"INSERT INTO {rebuilt.name} ({columns}) SELECT {columns} FROM {table.name}")
+    connection.exec_driver_sql(f"DROP TABLE {table.name}")
+    connection.exec_driver_sql(f"ALTER TABLE {rebuilt.name} RENAME TO {table.name}")
+
+    inspector = inspect(connection)
+    last_run_id = 0
+    for name in (table.name, TrainingSimulationData.__tablename__, TestingSimulationData.__tablename__):
+        if 'run_id' in {column['name'] for column in inspector.get_columns(name)}:
+            last_run_id = max(last_run_id,
+                              connection.exec_driver_sql(f"SELECT MAX(run_id) FROM {name}").scalar() or 0)
+    connection.exec_driver_sql("DELETE FROM sqlite_sequence WHERE name = ?", (table.name,))
+    connection.exec_driver_sql("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", (table.name, last_run_id))
+
+
+def migrate_db(engine):
+    """
+    Upgrade databases created by older versions: add the `run_id`,
+    `scenario_id`, `product_id`, `site_id` and `wirkstoff_allocation` columns
+    and their indexes, rebuild `simulation_runs` with AUTOINCREMENT, assign
+    rows without a run to one migrated run per table and build the summary
+    tables. Tracked through SQLite's user_version.
+    """
+    with engine.begin() as connection:
+        if connection.exec_driver_sql("PRAGMA user_version").scalar() >= SCHEMA_VERSION:
+            return
+
+        rebuild_runs_table(connection)
+
+        inspector = inspect(connection)
+        for table in (TrainingSimulationData.__table__, TestingSimulationData.__table__):
+            existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+            if 'run_id' not in existing_columns:
+                connection.exec_driver_sql(
+                    f"ALTER TABLE {table.name} ADD COLUMN run_id INTEGER REFERENCES simulation_runs (run_id)")
+            if 'scenario_id' not in existing_columns:
+                connection.exec_driver_sql(
+                    f"ALTER TABLE {table.name} ADD COLUMN scenario_id INTEGER NOT NULL DEFAULT 0")
+            if 'product_id' not in existing_columns:
+                connection.exec_driver_sql(
+                    f"ALTER TABLE {table.name} ADD COLUMN product_id INTEGER REFERENCES products (product_id)")
+            if 'site_id' not in existing_columns:
+                connection.exec_driver_sql(
+                    f"ALTER TABLE {table.name} ADD COLUMN site_id INTEGER REFERENCES sites (site_id)")
+            if 'wirkstoff_allocation' not in existing_columns:
+                connection.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN wirkstoff_allocation FLOAT")
+
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+
+            if connection.execute(text(f"SELECT 1 FROM {table.name} WHERE run_id IS NULL LIMIT 1")).first():
+                run_id = connection.execute(
+                    SimulationRun.__table__.insert().values(parameters='{"migrated_from": "%s"}' % table.name)
+                ).inserted_primary_key[0]
+                connection.execute(text(f"UPDATE {table.name} SET run_id = :run_id WHERE run_id IS NULL"),
+                                   {"run_id": run_id})
+
+        # Summary tables only hold derived rows: recreate those from before the product and site keys
+        for table, summary in SUMMARY_TABLES.items():
+            if 'product_id' not in {column['name'] for column in inspector.get_columns(summary.__tablename__)}:
+                summary.__table__.drop(connection)
+                summary.__table__.create(connection)
+            refresh_summary(connection, table)
+
+        connection.exec_driver_sql(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
@@ -1,11 +1,83 @@
+import itertools
+
 import numpy as np
 import pandas as pd
-from prophet import Prophet
+
+from Constants import SHORTAGE_THRESHOLD
+from Decomposition import decompose
+from Kernels import resolve_engine, run_recurrence
+from utils import count, timed
+
+
+SEASONALITY = {
+    'January': 1.2, 'February': 1.1, 'March': 1.0, 'April': 0.9, 'May': 0.8,
+    'June': 0.6, 'July': 0.7, 'August': 0.7, 'September': 0.8,
+    'October': 1.0, 'November': 1.3, 'December': 1.4
+}
+
+# Relative jitter applied to the base parameters of every simulated scenario
+PARAMETER_JITTER = {
+    'max_production_capacity': (0.98, 1.05),
+    'population': (0.95, 1.05),
+    'variance': (0.9, 1.1),
+}
+
+# Supply-chain parameters that can differ between scenarios of one batch
+SCENARIO_PARAMETERS = [
+    'initial_pharma_stock', 'max_pharma_stock', 'population', 'variance',
+    'wirkstoff_stock', 'max_wirkstoff_stock', 'production_cycle',
+    'max_production_capacity', 'wirkstoff_restock_interval',
+    'wirkstoff_restock_amount', 'wirkstoff_restock_variance',
+]
+
+START_DATE = pd.Timestamp('2024-01-01')
+
+SIMULATION_COLUMNS = [
+    'date', 'month_name', 'sales', 'stock', 'wirkstoff_stock', 'demand_spike_indicator',
+    'stock_to_sales_ratio', 'time_since_last_shortage_event', 'months_since_prod_issue',
+    'cumulative_shortages', 'sales_to_stock_ratio', 'wirkstoff_stock_percentage',
+    'shortage_level', 'last_restock_amount', 'days_since_last_restock',
+    'trend', 'seasonal', 'residual',
+]
+
+# Streamed months have no decomposition: trend and seasonal need the whole series
+STREAM_COLUMNS = SIMULATION_COLUMNS[:-3]
+
+
+class SimulationState:
+    """
+    State of the month recurrence for a set of scenarios: the month counter plus
+    one (n_scenarios,) array per carried quantity. This is all that is kept
+    between months, so stepping needs constant memory.
+
+    With `pool_params`, the Wirkstoff stock and its last restock day are kept
+    per shared pool instead of per scenario (see `DataSimulator._step`).
+    """
+    __slots__ = ('month', 'stock', 'wirkstoff_stock', 'cumulative_shortages', 'last_shortage_event',
+                 'last_prod_issue', 'last_restock_day')
+
+    def __init__(self, params, n_scenarios, pool_params=None):
+        wirkstoff_params = params if pool_params is None else pool_params
+        n_wirkstoff = n_scenarios if pool_params is None else len(pool_params['wirkstoff_stock'])
+
+        self.month = 0
+        self.stock = np.broadcast_to(np.asarray(params['initial_pharma_stock'], dtype=float), (n_scenarios,)).copy()
+        self.wirkstoff_stock = np.broadcast_to(np.asarray(wirkstoff_params['wirkstoff_stock'], dtype=float),
+                                               (n_wirkstoff,)).copy()
+        self.cumulative_shortages = np.zeros(n_scenarios, dtype=int)
+        self.last_shortage_event = np.full(n_scenarios, -1)
+        self.last_prod_issue = np.full(n_scenarios, -1)
+        self.last_restock_day = np.zeros(n_wirkstoff, dtype=int)
 
 
 class DataSimulator:
-    def __init__(self, random_state=None, months_to_simulate=120):
+    def __init__(self, random_state=None, months_to_simulate=120, decomposer='classical', decomposition_cache=None,
+                 engine='auto'):
         self.random_state = random_state
+        # Recurrence engine: "numba" (compiled, if installed), "numpy" or "auto"
+        self.engine = resolve_engine(engine)
+        self.decomposer = decomposer
+        self.decomposition_cache = decomposition_cache
         self.simulation_time_span = months_to_simulate + 1
         self.initial_pharma_stock = 3_000_000
         self.max_pharma_stock = 6_000_000
@@ -21,149 +93,395 @@ class DataSimulator:
         self.wirkstoff_restock_interval = 3
         self.wirkstoff_restock_amount = 1_400_000
         self.wirkstoff_restock_variance = 500_000
+        # Wirkstoff stock left after the last simulate_sales_and_stock() call
+        self.final_wirkstoff_stock = None
 
-        np.random.seed(self.random_state)
-        self.max_production_capacity *= np.random.uniform(0.98, 1.05)
-        self.population *= np.random.uniform(0.95, 1.05)
-        self.variance *= np.random.uniform(0.9, 1.1)
+        # Keep the un-jittered values so batches can draw their own jitter
+        self.base_parameters = {name: getattr(self, name) for name in SCENARIO_PARAMETERS}
 
+        rng = np.random.RandomState(self.random_state)
+        for name, (low, high) in PARAMETER_JITTER.items():
+            setattr(self, name, getattr(self, name) * rng.uniform(low, high))
+
+    def run_parameters(self):
+        """
+        Parameters describing this simulator, as stored with a simulation run.
+        """
+        # .item() turns numpy scalars from the jitter into plain JSON-friendly numbers
+        parameters = {name: np.asarray(getattr(self, name)).item() for name in SCENARIO_PARAMETERS}
+        parameters['months_to_simulate'] = self.simulation_time_span - 1
+        parameters['decomposer'] = getattr(self.decomposer, 'name', self.decomposer)
+        return parameters
+
+    def get_dates(self):
+        """
+        Monthly date index covering the simulation time span.
+        """
+        return pd.date_range(start=START_DATE, periods=self.simulation_time_span, freq='MS')
+
+    @timed('simulator.simulate_sales_and_stock')
     def simulate_sales_and_stock(self):
-        np.random.seed(self.random_state)
+        """
+        Simulate a single scenario seeded with `random_state`.
 
-        seasonality = {
-            'January': 1.2, 'February': 1.1, 'March': 1.0, 'April': 0.9, 'May': 0.8,
-            'June': 0.6, 'July': 0.7, 'August': 0.7, 'September': 0.8,
-            'October': 1.0, 'November': 1.3, 'December': 1.4
-        }
+        This is the one-scenario special case of the batch engine: the random
+        draws are taken in the original month-by-month order so results stay
+        reproducible for a given seed.
+        """
+        dates = self.get_dates()
+        noise = self._draw_legacy_noise(dates)
+        params = {name: np.array([getattr(self, name)]) for name in SCENARIO_PARAMETERS}
 
-        dates = pd.date_range(start='2024-01-01', periods=self.simulation_time_span, freq='MS')
-
-        # Initialize storage variables
-        total_sales, total_stock = [], []
-        wirkstoff_stock_over_time, demand_spike_indicator = [], []
-        stock_to_sales_ratio, time_since_last_shortage_event = [], []
-        months_since_prod_issue, cumulative_shortages_over_time = [], []
-        cumulative_shortages = 0
-        shortage_levels, sales_to_stock_ratios = [], []
-        wirkstoff_stock_percentages, last_restock_amounts = [], []
-        days_since_last_restock = []
-
-        stock = self.initial_pharma_stock
-        last_shortage_event = -1
-        last_prod_issue = -1
-        last_restock_day = 0
-
-        for month in range(self.simulation_time_span):
-            month_name = dates[month].strftime('%B')
-            seasonal_factor = seasonality[month_name]
-
-            # Generate monthly demand
-            monthly_demand = (
-                (self.population * 0.007 * 30 * seasonal_factor)
-                + np.random.normal(0, self.variance)
-                + np.random.normal(0, self.variance * 0.1)
-            )
-            monthly_demand = max(0, monthly_demand)
-
-            if seasonality[month_name] > 1.0 and np.random.random() < 0.06:
-                monthly_demand *= 1.5 + np.random.random() * 0.5
-                demand_spike_indicator.append(1)
-            else:
-                demand_spike_indicator.append(0)
-
-            # Production logic
-            production_output = self.max_production_capacity
-            required_wirkstoff = production_output * self.production_cycle
-
-            if self.wirkstoff_stock >= required_wirkstoff:
-                self.wirkstoff_stock -= required_wirkstoff
-            else:
-                production_output = self.wirkstoff_stock / self.production_cycle
-                self.wirkstoff_stock = 0
-
-            if np.random.random() < 0.05:
-                production_output *= 0.9
-                last_prod_issue = month
-
-            stock += production_output
-            stock = min(stock, self.max_pharma_stock)
-
-            # Shortage calculation
-            shortage_level = int((1 - (stock / self.max_pharma_stock)) * 9) + 1
-            shortage_level = min(max(shortage_level, 1), 10)
-
-            if shortage_level >= 7:
-                cumulative_shortages += 1
-                last_shortage_event = month
-
-            # Restock logic
-            if month % self.wirkstoff_restock_interval == 0:
-                wirkstoff_restock_amount = (
-                    self.wirkstoff_restock_amount + np.random.normal(0, self.wirkstoff_restock_variance)
-                )
-                wirkstoff_restock_amount = max(0, wirkstoff_restock_amount)
-                self.wirkstoff_stock += wirkstoff_restock_amount
-                self.wirkstoff_stock = min(self.wirkstoff_stock, self.max_wirkstoff_stock)
-                last_restock_day = month
-                last_restock_amounts.append(wirkstoff_restock_amount / 1e6)
-            else:
-                last_restock_amounts.append(0)
-
-            days_since_last_restock.append(month - last_restock_day)
-
-            # Sales logic
-            max_sales = stock * 0.65 if stock < self.max_pharma_stock * 0.75 else stock
-            min_sales = stock * 0.02
-
-            monthly_sales = min(stock, monthly_demand, max_sales)
-            monthly_sales = max(monthly_sales, min_sales)
-            stock -= monthly_sales
-
-            total_sales.append(monthly_sales / 1e6)
-            total_stock.append(stock / 1e6)
-
-            # Calculate ratios
-            sales_to_stock_ratio = monthly_sales / stock if stock > 0 else np.nan
-            wirkstoff_stock_percentage = (self.wirkstoff_stock / self.max_wirkstoff_stock) * 100
-            stock_to_sales_ratio.append(stock / monthly_sales if monthly_sales > 0 else np.nan)
-
-            # Track shortages
-            cumulative_shortages_over_time.append(cumulative_shortages)
-            shortage_levels.append(shortage_level)
-            months_since_prod_issue.append(month - last_prod_issue if last_prod_issue >= 0 else np.nan)
-            time_since_last_shortage_event.append(month - last_shortage_event if last_shortage_event >= 0 else np.nan)
-            wirkstoff_stock_over_time.append(self.wirkstoff_stock / 1e6)
-            sales_to_stock_ratios.append(sales_to_stock_ratio)
-            wirkstoff_stock_percentages.append(wirkstoff_stock_percentage)
-
-        # Create DataFrame
-        simulation_df = pd.DataFrame({
-            'date': dates.strftime('%Y-%m-%d'),
-            'month_name': dates.strftime('%B'),
-            'sales': total_sales,
-            'stock': total_stock,
-            'wirkstoff_stock': wirkstoff_stock_over_time,
-            'demand_spike_indicator': demand_spike_indicator,
-            'stock_to_sales_ratio': stock_to_sales_ratio,
-            'time_since_last_shortage_event': time_since_last_shortage_event,
-            'months_since_prod_issue': months_since_prod_issue,
-            'cumulative_shortages': cumulative_shortages_over_time,
-            'sales_to_stock_ratio': sales_to_stock_ratios,
-            'wirkstoff_stock_percentage': wirkstoff_stock_percentages,
-            'shortage_level': shortage_levels,
-            'last_restock_amount': last_restock_amounts,
-            'days_since_last_restock': days_since_last_restock,
-        })
-
-        prophet_data = simulation_df[['date', 'sales']].rename(columns={'date': 'ds', 'sales': 'y'})
-        prophet = Prophet(seasonality_mode='additive')
-        prophet.fit(prophet_data)
-        forecast = prophet.predict(prophet_data)
-
-        simulation_df['trend'] = forecast['trend']
-        simulation_df['seasonal'] = forecast.get('seasonal', 0)
-        simulation_df['residual'] = simulation_df['sales'] - forecast['yhat']
+        paths = self._simulate_paths(params, noise, dates, self.engine)
+        # Keep the Wirkstoff stock left at the end apart from the configured one,
+        # so run_parameters() still describes the inputs of this run
+        self.final_wirkstoff_stock = paths.pop('final_wirkstoff_stock')[0]
+
+        self.add_decomposition(paths, dates)
+
+        simulation_df = pd.DataFrame({'date': dates.strftime('%Y-%m-%d'), 'month_name': dates.strftime('%B')})
+        for column in SIMULATION_COLUMNS[2:]:
+            simulation_df[column] = paths[column][0]
 
+        count('simulator.scenarios')
         return simulation_df.round(2)
 
+    @timed('simulator.simulate_batch')
+    def simulate_batch(self, n_scenarios, seed=None):
+        """
+        Simulate `n_scenarios` independent scenarios at once.
+
+        Every scenario draws its own parameter jitter and noise from one
+        `np.random.Generator` seeded with `seed` (defaults to `random_state`).
+        Returns a long-format DataFrame with a `scenario_id` column.
+        """
+        rng = np.random.default_rng(self.random_state if seed is None else seed)
+        dates = self.get_dates()
+
+        params = self.draw_scenario_parameters(n_scenarios, rng)
+        noise = self._draw_batch_noise(params, dates, rng)
+        paths = self._simulate_paths(params, noise, dates, self.engine)
+        paths.pop('final_wirkstoff_stock')
+        self.add_decomposition(paths, dates)
+        count('simulator.scenarios', n_scenarios)
+
+        return self._paths_to_frame(paths, dates).round(2)
+
+    def stream(self, n_scenarios=None, seed=None, months=None):
+        """
+        Simulate month by month, yielding one DataFrame per month with one row per
+        scenario (columns `STREAM_COLUMNS`, plus `scenario_id` for batches).
+
+        Only a `SimulationState` and the current month's random numbers are held,
+        so memory stays constant however long the horizon is; `months=None`
+        streams `months_to_simulate` + 1 months, `months=float('inf')` never stops.
+        Without `n_scenarios` the single legacy scenario is streamed and matches
+        `simulate_sales_and_stock` month for month. Batches draw per month from
+        `np.random.default_rng(seed)`, so they differ from `simulate_batch`.
+        """
+        months = self.simulation_time_span if months is None else months
+        if n_scenarios is None:
+            params = {name: np.array([getattr(self, name)]) for name in SCENARIO_PARAMETERS}
+            noise_blocks = self._iter_legacy_noise(START_DATE)
+        else:
+            rng = np.random.default_rng(self.random_state if seed is None else seed)
+            params = self.draw_scenario_parameters(n_scenarios, rng)
+            noise_blocks = (self._draw_batch_noise(params, self._month_dates(month), rng)
+                            for month in itertools.count())
+
+        recurrence = self._recurrence_parameters(params)
+        state = SimulationState(params, len(params['population']))
+
+        for noise in noise_blocks:
+            if state.month >= months:
+                return
+            dates = self._month_dates(state.month)
+            demand, restock, restock_amount = self._month_inputs(params, noise, np.array([state.month]), dates)
+            values = self._step(state, recurrence, demand[:, 0], restock[:, 0], restock_amount[:, 0],
+                                noise['prod_issue'][:, 0])
+            values = self._derived_columns({name: value.reshape(-1, 1) for name, value in values.items()},
+                                           recurrence, restock_amount, noise['spike'])
+
+            month_df = pd.DataFrame({'date': dates.strftime('%Y-%m-%d')[0], 'month_name': dates.strftime('%B')[0],
+                                     **{column: values[column][:, 0] for column in STREAM_COLUMNS[2:]}})
+            if n_scenarios is not None:
+                month_df.insert(0, 'scenario_id', np.arange(n_scenarios))
+            count('simulator.streamed_months')
+            yield month_df.round(2)
+
+    @staticmethod
+    def _month_dates(month):
+        return pd.DatetimeIndex([START_DATE + pd.DateOffset(months=month)])
+
+    @timed('simulator.decomposition')
+    def add_decomposition(self, paths, dates):
+        """
+        Add `trend`, `seasonal` and `residual` arrays computed from the simulated sales.
+        """
+        paths['trend'], paths['seasonal'], paths['residual'] = decompose(
+            paths['sales'], dates, decomposer=self.decomposer, cache=self.decomposition_cache
+        )
+        return paths
+
+    def draw_scenario_parameters(self, n_scenarios, rng):
+        """
+        Draw per-scenario parameter arrays of shape (n_scenarios,) around the base parameters.
+        """
+        params = {name: np.full(n_scenarios, value) for name, value in self.base_parameters.items()}
+        for name, (low, high) in PARAMETER_JITTER.items():
+            params[name] = params[name] * rng.uniform(low, high, size=n_scenarios)
+        return params
+
+    def _draw_legacy_noise(self, dates):
+        """
+        Draw the random numbers of one scenario in the original per-month order.
+        """
+        blocks = list(itertools.islice(self._iter_legacy_noise(dates[0]), len(dates)))
+        return {name: np.concatenate([block[name] for block in blocks], axis=1) for name in blocks[0]}
+
+    def _iter_legacy_noise(self, start_date):
+        """
+        Yield the random numbers of one scenario month by month as (1, 1) arrays,
+        seeded with `random_state` and drawn in the original order.
+        """
+        rng = np.random.RandomState(self.random_state)
+        # SEASONALITY is ordered January..December
+        seasonal_factors = list(SEASONALITY.values())
+        for month in itertools.count():
+            seasonal_factor = seasonal_factors[(start_date.month - 1 + month) % 12]
+            noise = {
+                'demand_noise': rng.normal(0, self.variance),
+                'demand_noise_small': rng.normal(0, self.variance * 0.1),
+                'spike': False,
+                'spike_scale': 0.0,
+                'prod_issue': False,
+                'restock_noise': 0.0,
+            }
+
+            if seasonal_factor > 1.0 and rng.random_sample() < 0.06:
+                noise['spike'] = True
+                noise['spike_scale'] = rng.random_sample()
+
+            noise['prod_issue'] = rng.random_sample() < 0.05
+
+            if month % self.wirkstoff_restock_interval == 0:
+                noise['restock_noise'] = rng.normal(0, self.wirkstoff_restock_variance)
+
+            yield {name: np.array([[value]]) for name, value in noise.items()}
+
+    @staticmethod
+    def _draw_batch_noise(params, dates, rng):
+        """
+        Draw all random numbers of a batch as (n_scenarios, months) arrays.
+        """
+        variance = params['variance'].reshape(-1, 1)
+        restock_variance = params['wirkstoff_restock_variance'].reshape(-1, 1)
+        shape = (len(variance), len(dates))
+        seasonal = np.array([SEASONALITY[name] for name in dates.strftime('%B')])
+
+        return {
+            'demand_noise': variance * rng.standard_normal(shape),
+            'demand_noise_small': (variance * 0.1) * rng.standard_normal(shape),
+            'spike': (seasonal > 1.0) & (rng.random(shape) < 0.06),
+            'spike_scale': rng.random(shape),
+            'prod_issue': rng.random(shape) < 0.05,
+            'restock_noise': restock_variance * rng.standard_normal(shape),
+        }
+
+    @staticmethod
+    @timed('simulator.recurrence')
+    def _simulate_paths(params, noise, dates, engine='numpy'):
+        """
+        Run the month recurrence for all scenarios at once.
+
+        `params` holds (n_scenarios,) arrays and `noise` holds the pre-drawn, already
+        scaled (n_scenarios, months) random arrays. Returns a dict of
+        (n_scenarios, months) arrays, one per output column. The "numba" engine
+        runs the same recurrence compiled (see `Kernels`); the NumPy loop
+        below is the reference implementation.
+        """
+        n_scenarios, n_months = noise['demand_noise'].shape
+        recurrence = DataSimulator._recurrence_parameters(params)
+        demand, restock_month, restock_amounts = DataSimulator._month_inputs(params, noise, np.arange(n_months), dates)
+        state = SimulationState(params, n_scenarios)
+
+        if resolve_engine(engine) == 'numba':
+            out = run_recurrence(recurrence, state, demand, restock_month, restock_amounts, noise['prod_issue'])
+            out = DataSimulator._derived_columns(out, recurrence, restock_amounts, noise['spike'])
+            out['final_wirkstoff_stock'] = state.wirkstoff_stock
+            return out
+
+        out = DataSimulator._run_steps(state, recurrence, demand, restock_month, restock_amounts, noise['prod_issue'])
+        out = DataSimulator._derived_columns(out, recurrence, restock_amounts, noise['spike'])
+        out['final_wirkstoff_stock'] = state.wirkstoff_stock
+        return out
+
+    @staticmethod
+    def _run_steps(state, recurrence, demand, restock_month, restock_amounts, prod_issue, pool_index=None):
+        """
+        Step `state` through all months of the (n_scenarios, months) inputs and
+        collect the recurrence columns. Restock inputs are per pool with `pool_index`.
+        """
+        n_scenarios, n_months = demand.shape
+        shape = (n_scenarios, n_months)
+        out = {
+            'sales': np.empty(shape), 'stock': np.empty(shape), 'wirkstoff_stock': np.empty(shape),
+            'shortage_level': np.empty(shape, dtype=int), 'cumulative_shortages': np.empty(shape, dtype=int),
+            'time_since_last_shortage_event': np.empty(shape), 'months_since_prod_issue': np.empty(shape),
+            'days_since_last_restock': np.empty(shape, dtype=int),
+        }
+        if pool_index is not None:
+            out['wirkstoff_allocation'] = np.empty(shape)
+
+        for month in range(n_months):
+            values = DataSimulator._step(state, recurrence, demand[:, month], restock_month[:, month],
+                                         restock_amounts[:, month], prod_issue[:, month], pool_index)
+            for name, value in values.items():
+                out[name][:, month] = value
+        return out
+
+    @staticmethod
+    def _recurrence_parameters(params):
+        """
+        The parameters the month recurrence reads, as (n_scenarios,) arrays.
+        """
+        return {
+            'max_pharma_stock': np.asarray(params['max_pharma_stock'], dtype=float),
+            'max_wirkstoff_stock': np.asarray(params['max_wirkstoff_stock'], dtype=float),
+            'production_cycle': np.asarray(params['production_cycle'], dtype=float),
+            'capacity': np.asarray(params['max_production_capacity'], dtype=float),
+        }
+
+    @staticmethod
+    def _month_inputs(params, noise, months, dates):
+        """
+        Demand, restock flags and restock amounts for a block of months. None of
+        them depend on the stock, so they are computed for all months at once.
+        `months` are the absolute month indices of the noise columns.
+        """
+        n_scenarios = noise['demand_noise'].shape[0]
+        seasonal = np.array([SEASONALITY[name] for name in dates.strftime('%B')])
+        column = lambda values: np.asarray(values, dtype=float).reshape(-1, 1)
+
+        demand = (column(params['population']) * 0.007 * 30 * seasonal) + noise['demand_noise'] + noise['demand_noise_small']
+        demand = np.maximum(0, demand)
+        demand = np.where(noise['spike'], demand * (1.5 + noise['spike_scale'] * 0.5), demand)
+
+        restock_interval = np.asarray(params['wirkstoff_restock_interval'], dtype=int).reshape(-1, 1)
+        restock_month = (months % restock_interval) == 0
+        restock_amounts = np.where(restock_month,
+                                   np.maximum(0, column(params['wirkstoff_restock_amount']) + noise['restock_noise']), 0.0)
+
+        shape = (n_scenarios, len(months))
+        return np.broadcast_to(demand, shape), np.broadcast_to(restock_month, shape), np.broadcast_to(restock_amounts, shape)
+
+    @staticmethod
+    def _step(state, recurrence, demand, restock, restock_amount, prod_issue, pool_index=None):
+        """
+        Advance `state` by one month for all scenarios. The month's inputs are
+        (n_scenarios,) arrays; returns the month's values of the recurrence columns.
+
+        With `pool_index`, scenario i draws its Wirkstoff from the shared pool
+        pool_index[i]: the Wirkstoff state, `restock`, `restock_amount` and
+        recurrence['max_wirkstoff_stock'] are per pool. A pool that cannot cover
+        the requirement of all its scenarios gives each the same share of it
+        (pro rata), returned as `wirkstoff_allocation`.
+        """
+        month = state.month
+        capacity, production_cycle = recurrence['capacity'], recurrence['production_cycle']
+        max_pharma_stock = recurrence['max_pharma_stock']
+
+        # Production logic
+        required_wirkstoff = capacity * production_cycle
+        if pool_index is None:
+            available_wirkstoff = state.wirkstoff_stock
+            wirkstoff_stock = np.where(available_wirkstoff >= required_wirkstoff,
+                                       state.wirkstoff_stock - required_wirkstoff, 0.0)
+        else:
+            pool_required = np.bincount(pool_index, weights=required_wirkstoff, minlength=len(state.wirkstoff_stock))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                pool_share = np.where(pool_required > 0, np.minimum(1.0, state.wirkstoff_stock / pool_required), 1.0)
+            allocation = pool_share[pool_index]
+            available_wirkstoff = required_wirkstoff * allocation
+            wirkstoff_stock = state.wirkstoff_stock - np.minimum(state.wirkstoff_stock, pool_required)
+        enough_wirkstoff = available_wirkstoff >= required_wirkstoff
+        production_output = np.where(enough_wirkstoff, capacity, available_wirkstoff / production_cycle)
+
+        production_output = np.where(prod_issue, production_output * 0.9, production_output)
+        state.last_prod_issue = np.where(prod_issue, month, state.last_prod_issue)
+
+        stock = np.minimum(state.stock + production_output, max_pharma_stock)
+
+        # Shortage calculation
+        shortage_level = ((1 - (stock / max_pharma_stock)) * 9).astype(int) + 1
+        shortage_level = np.clip(shortage_level, 1, 10)
+        shortage = shortage_level >= SHORTAGE_THRESHOLD
+        state.cumulative_shortages = state.cumulative_shortages + shortage
+        state.last_shortage_event = np.where(shortage, month, state.last_shortage_event)
+
+        # Restock logic
+        wirkstoff_stock = np.where(
+            restock, np.minimum(wirkstoff_stock + restock_amount, recurrence['max_wirkstoff_stock']), wirkstoff_stock
+        )
+        state.last_restock_day = np.where(restock, month, state.last_restock_day)
+
+        # Sales logic
+        max_sales = np.where(stock < max_pharma_stock * 0.75, stock * 0.65, stock)
+        min_sales = stock * 0.02
+        monthly_sales = np.minimum(np.minimum(stock, demand), max_sales)
+        monthly_sales = np.maximum(monthly_sales, min_sales)
+        stock = stock - monthly_sales
+
+        state.stock, state.wirkstoff_stock, state.month = stock, wirkstoff_stock, month + 1
+        values = {
+            'sales': monthly_sales,
+            'stock': stock,
+            'wirkstoff_stock': wirkstoff_stock,
+            'shortage_level': shortage_level,
+            'cumulative_shortages': state.cumulative_shortages,
+            'time_since_last_shortage_event': np.where(state.last_shortage_event >= 0,
+                                                       month - state.last_shortage_event, np.nan),
+            'months_since_prod_issue': np.where(state.last_prod_issue >= 0, month - state.last_prod_issue, np.nan),
+            'days_since_last_restock': month - state.last_restock_day,
+        }
+        if pool_index is not None:
+            # Pool quantities are reported for every scenario drawing on the pool
+            values['wirkstoff_stock'] = wirkstoff_stock[pool_index]
+            values['days_since_last_restock'] = values['days_since_last_restock'][pool_index]
+            values['wirkstoff_allocation'] = allocation
+        return values
+
+    @staticmethod
+    def _derived_columns(out, recurrence, restock_amounts, spike):
+        """
+        Add the ratio, percentage and indicator columns and scale stocks to millions.
+        Works on (n_scenarios, months) arrays of any number of months.
+        """
+        sales, stock = out['sales'], out['stock']
+        with np.errstate(divide='ignore', invalid='ignore'):
+            out['stock_to_sales_ratio'] = np.where(sales > 0, stock / sales, np.nan)
+            out['sales_to_stock_ratio'] = np.where(stock > 0, sales / stock, np.nan)
+        out['wirkstoff_stock_percentage'] = (out['wirkstoff_stock'] / recurrence['max_wirkstoff_stock'].reshape(-1, 1)) * 100
+
+        out['sales'] = sales / 1e6
+        out['stock'] = stock / 1e6
+        out['wirkstoff_stock'] = out['wirkstoff_stock'] / 1e6
+        out['last_restock_amount'] = restock_amounts / 1e6
+        out['demand_spike_indicator'] = spike.astype(int)
+        return out
+
+    @staticmethod
+    def _paths_to_frame(paths, dates):
+        """
+        Flatten (n_scenarios, months) arrays into a long-format DataFrame.
+        """
+        n_scenarios, n_months = paths['sales'].shape
+        frame = {
+            'scenario_id': np.repeat(np.arange(n_scenarios), n_months),
+            'date': np.tile(dates.strftime('%Y-%m-%d'), n_scenarios),
+            'month_name': np.tile(dates.strftime('%B'), n_scenarios),
+        }
+        for column in SIMULATION_COLUMNS[2:]:
+            frame[column] = paths[column].ravel()
 
+        return pd.DataFrame(frame)
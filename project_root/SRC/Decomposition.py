@@ -0,0 +1,225 @@
+import hashlib
+import os
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from utils import count, timed
+
+
+class ClassicalDecomposer:
+    """
+    Classical additive decomposition (centered moving-average trend plus
+    calendar-month seasonal means), vectorized over many scenarios.
+    """
+    name = 'classical'
+
+    def __init__(self, period=12):
+        self.period = period
+
+    def cache_token(self):
+        return f'{self.name}-{self.period}'
+
+    def decompose(self, sales, dates):
+        """
+        Split (n_scenarios, months) sales into trend, seasonal and residual arrays.
+        """
+        sales = np.asarray(sales, dtype=float)
+        trend = self._centered_moving_average(sales)
+
+        detrended = sales - trend
+        month_of_period = (dates.month.to_numpy() - 1) % self.period
+        seasonal_means = np.stack(
+            [detrended[:, month_of_period == k].mean(axis=1) for k in range(self.period)], axis=1
+        )
+        # Additive seasonal effects sum to zero over one period
+        seasonal_means -= seasonal_means.mean(axis=1, keepdims=True)
+        seasonal = seasonal_means[:, month_of_period]
+
+        residual = sales - trend - seasonal
+        return trend, seasonal, residual
+
+    def _centered_moving_average(self, sales):
+        """
+        2x`period` centered moving average; the edges repeat the first and last full window.
+        """
+        n_months = sales.shape[1]
+        if n_months <= self.period:
+            return np.repeat(sales.mean(axis=1, keepdims=True), n_months, axis=1)
+
+        cumsum = np.concatenate([np.zeros((sales.shape[0], 1)), np.cumsum(sales, axis=1)], axis=1)
+        window_means = (cumsum[:, self.period:] - cumsum[:, :-self.period]) / self.period
+
+        half = self.period // 2
+        trend = np.empty_like(sales)
+        if self.period % 2 == 0:
+            centered = (window_means[:, :-1] + window_means[:, 1:]) / 2
+        else:
+            centered = window_means
+        trend[:, half:half + centered.shape[1]] = centered
+        trend[:, :half] = centered[:, :1]
+        trend[:, half + centered.shape[1]:] = centered[:, -1:]
+        return trend
+
+
+class ProphetDecomposer:
+    """
+    Prophet-based decomposition. Fits one Stan model per scenario, so it is slow
+    and only used when explicitly requested.
+    """
+    name = 'prophet'
+
+    def __init__(self, seasonality_mode='additive'):
+        self.seasonality_mode = seasonality_mode
+
+    def cache_token(self):
+        return f'{self.name}-{self.seasonality_mode}'
+
+    def decompose(self, sales, dates):
+        from prophet import Prophet
+
+        sales = np.asarray(sales, dtype=float)
+        trend, seasonal, residual = (np.empty_like(sales) for _ in range(3))
+
+        for i, series in enumerate(sales):
+            prophet_data = pd.DataFrame({'ds': dates.strftime('%Y-%m-%d'), 'y': series})
+            prophet = Prophet(seasonality_mode=self.seasonality_mode)
+            with timed('decomposition.prophet_fit'):
+                prophet.fit(prophet_data)
+            count('decomposition.prophet_fits')
+            forecast = prophet.predict(prophet_data)
+
+            trend[i] = forecast['trend']
+            seasonal[i] = forecast.get('seasonal', 0)
+            residual[i] = series - forecast['yhat']
+
+        return trend, seasonal, residual
+
+
+DECOMPOSERS = {
+    'classical': ClassicalDecomposer,
+    'prophet': ProphetDecomposer,
+}
+
+
+def get_decomposer(decomposer):
+    """
+    Resolve a decomposer name from `DECOMPOSERS`, or pass a decomposer object through.
+    """
+    if isinstance(decomposer, str):
+        if decomposer not in DECOMPOSERS:
+            raise ValueError(f"Unknown decomposer '{decomposer}'. Choose from {list(DECOMPOSERS)}.")
+        return DECOMPOSERS[decomposer]()
+    return decomposer
+
+
+# Series kept by the shared in-memory cache (trend, seasonal and residual of 120 months take about 3 kB)
+DEFAULT_CACHE_ENTRIES = 4_096
+
+
+class DecompositionCache:
+    """
+    Content-addressed cache of decomposition results, one entry per sales
+    series, so a batch that differs in a few scenarios only decomposes those.
+    Kept in memory as an LRU of at most `max_entries` series and, if
+    `cache_dir` is given, on disk as .npz files.
+    """
+
+    def __init__(self, cache_dir=None, max_entries=DEFAULT_CACHE_ENTRIES):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def keys(decomposer, sales, dates):
+        """
+        One key per row of (n_scenarios, months) `sales`.
+        """
+        sales = np.ascontiguousarray(sales, dtype=float)
+        prefix = hashlib.blake2b(digest_size=20)
+        prefix.update(decomposer.cache_token().encode())
+        prefix.update(str(dates[0].date()).encode())
+        prefix.update(str(sales.shape[1:]).encode())
+
+        keys = []
+        for series in sales:
+            digest = prefix.copy()
+            digest.update(series.tobytes())
+            keys.append(digest.hexdigest())
+        return keys
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.npz')
+
+    def get(self, key):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            count('decomposition.cache_hits')
+            return self.memory[key]
+
+        if self.cache_dir and os.path.exists(self._path(key)):
+            with np.load(self._path(key)) as stored:
+                result = np.stack([stored['trend'], stored['seasonal'], stored['residual']])
+            self._remember(key, result)
+            self.hits += 1
+            count('decomposition.cache_hits')
+            return result
+
+        self.misses += 1
+        count('decomposition.cache_misses')
+        return None
+
+    def put(self, key, result):
+        """
+        Store the (3, months) trend, seasonal and residual array of one series.
+        """
+        self._remember(key, result)
+        if self.cache_dir:
+            trend, seasonal, residual = result
+            np.savez(self._path(key), trend=trend, seasonal=seasonal, residual=residual)
+
+    def _remember(self, key, result):
+        if self.max_entries <= 0:
+            return
+        self.memory[key] = result
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def __len__(self):
+        return len(self.memory)
+
+
+# Shared in-memory cache used when no explicit cache is passed
+default_cache = DecompositionCache()
+
+
+def decompose(sales, dates, decomposer='classical', cache=None):
+    """
+    Decompose (n_scenarios, months) sales with the given decomposer. Series
+    found in the cache are reused; only the others are decomposed, as one batch.
+    """
+    decomposer = get_decomposer(decomposer)
+    cache = default_cache if cache is None else cache
+    sales = np.asarray(sales, dtype=float)
+
+    keys = cache.keys(decomposer, sales, dates)
+    results = [cache.get(key) for key in keys]
+    missing = [i for i, result in enumerate(results) if result is None]
+    if missing:
+        computed = np.stack(decomposer.decompose(sales[missing], dates), axis=1)
+        for i, components in zip(missing, computed):
+            # Copies, so cached rows do not keep the whole batch array alive
+            results[i] = components.copy()
+            cache.put(keys[i], results[i])
+
+    if not results:
+        return tuple(np.empty_like(sales) for _ in range(3))
+    components = np.stack(results)
+    return components[:, 0], components[:, 1], components[:, 2]
@@ -0,0 +1,211 @@
+import glob
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from DB import DATA_COLUMNS
+
+
+# Features the models were originally trained on
+BASE_FEATURES = [
+    'sales', 'stock', 'last_restock_amount', 'days_since_last_restock',
+    'wirkstoff_stock', 'trend', 'seasonal',
+]
+
+LAG_COLUMNS = ['sales', 'stock', 'wirkstoff_stock', 'shortage_level']
+ROLLING_COLUMNS = ['sales', 'stock', 'wirkstoff_stock']
+LAGS = (1, 2, 3)
+WINDOWS = (3, 6, 12)
+
+
+def group_keys(simulation_df):
+    """
+    Columns that identify one simulated series (run, product, site and/or scenario), if present.
+    """
+    return [key for key in ('run_id', 'product_id', 'site_id', 'scenario_id') if key in simulation_df.columns]
+
+
+def build_features(simulation_df, lags=LAGS, windows=WINDOWS):
+    """
+    Add lagged, rolling-window and calendar features to a simulation frame.
+
+    All series (runs and scenarios) are processed at once with grouped,
+    vectorized operations; rows must be in date order within each series.
+    Lags before the start of a series are NaN, rolling means use the months available.
+    """
+    features = simulation_df.reset_index(drop=True).copy()
+    keys = group_keys(features)
+    group_ids = features.groupby(keys, sort=False).ngroup().to_numpy() if keys else np.zeros(len(features), dtype=int)
+    grouped = features.groupby(group_ids, sort=False)
+    position = grouped.cumcount().to_numpy()
+
+    new_columns = {}
+    for column in LAG_COLUMNS:
+        for lag in lags:
+            new_columns[f'{column}_lag_{lag}'] = grouped[column].shift(lag)
+
+    # Rolling means from per-series cumulative sums: sum(t-w+1..t) = csum(t) - csum(t-w)
+    cumulative = grouped[ROLLING_COLUMNS].cumsum()
+    for window in windows:
+        lagged = cumulative.groupby(group_ids, sort=False).shift(window).fillna(0)
+        count = np.minimum(position + 1, window)[:, None]
+        means = (cumulative - lagged) / count
+        for column in ROLLING_COLUMNS:
+            new_columns[f'{column}_rolling_mean_{window}'] = means[column]
+
+    dates = pd.to_datetime(features['date'])
+    month = dates.dt.month.to_numpy()
+    new_columns['month'] = month
+    new_columns['quarter'] = dates.dt.quarter.to_numpy()
+    new_columns['month_sin'] = np.sin(2 * np.pi * (month - 1) / 12)
+    new_columns['month_cos'] = np.cos(2 * np.pi * (month - 1) / 12)
+
+    return pd.concat([features, pd.DataFrame(new_columns, index=features.index)], axis=1)
+
+
+# Partition of rows that do not belong to a stored simulation run
+DEFAULT_RUN = 'default'
+
+
+def run_key(run_id, created_at):
+    """
+    Feature store partition of a simulation run. The creation time is part of
+    the key, so a recreated database that hands out the same run ids again
+    never picks up features of an older run.
+    """
+    return f'{int(run_id)}-{pd.Timestamp(created_at):%Y%m%d%H%M%S%f}'
+
+
+class FeatureStore:
+    """
+    Parquet store of materialized features: one directory per dataset, one
+    partition per simulation run (see `run_key`) and one part file per write,
+    so new months can be appended without rewriting.
+    """
+
+    def __init__(self, store_dir="./feature_store", lags=LAGS, windows=WINDOWS):
+        self.store_dir = os.path.abspath(store_dir)
+        self.lags = lags
+        self.windows = windows
+        os.makedirs(self.store_dir, exist_ok=True)
+
+    def _run_dir(self, name, run):
+        return os.path.join(self.store_dir, name, f'run={run}')
+
+    def _parts(self, name, runs=None):
+        if runs is None:
+            return sorted(glob.glob(os.path.join(self.store_dir, name, 'run=*', 'part-*.parquet')))
+        return [part for run in runs for part in sorted(glob.glob(os.path.join(self._run_dir(name, run),
+                                                                              'part-*.parquet')))]
+
+    def exists(self, name, run=None):
+        return bool(self._parts(name, None if run is None else [run]))
+
+    def read(self, name, columns=None, runs=None, since=None):
+        """
+        Read a dataset, optionally only some columns, the partitions of some
+        `runs` and the months from `since` ('YYYY-MM-DD') on.
+        """
+        parts = self._parts(name, runs)
+        if not parts:
+            raise FileNotFoundError(f"No features stored for '{name}' in {self.store_dir}.")
+        filters = [('date', '>=', since)] if since is not None else None
+        features = pd.concat([pd.read_parquet(part, columns=columns, filters=filters) for part in parts],
+                             ignore_index=True)
+        # Appended months live in later part files; restore date order within every series
+        order = [column for column in group_keys(features) + ['date'] if column in features.columns]
+        return features.sort_values(order, kind='stable', ignore_index=True) if order else features
+
+    def write(self, name, features_df, run=DEFAULT_RUN):
+        """
+        Replace the features of one run partition.
+        """
+        for part in self._parts(name, [run]):
+            os.remove(part)
+        self._append(name, features_df, run)
+
+    def drop_runs(self, name, run_ids):
+        """
+        Remove the partitions of the given run ids, whatever their creation time.
+        """
+        for run_id in run_ids:
+            for run_dir in glob.glob(os.path.join(self.store_dir, name, f'run={int(run_id)}-*')):
+                shutil.rmtree(run_dir)
+
+    def _append(self, name, features_df, run):
+        run_dir = self._run_dir(name, run)
+        os.makedirs(run_dir, exist_ok=True)
+        features_df.to_parquet(os.path.join(run_dir, f'part-{len(self._parts(name, [run])):05d}.parquet'),
+                               index=False)
+
+    def update(self, name, simulation_df, run=DEFAULT_RUN):
+        """
+        Materialize features for the rows of `simulation_df` (all from one run)
+        not stored yet in that run's partition.
+
+        Rows count as new when their date is after the last stored date of their
+        series. Only the keys and dates of the partition are read to find them,
+        and only the last months of the affected series as context for lags and
+        rolling windows. Returns the number of new rows.
+        """
+        if not self.exists(name, run):
+            self.write(name, build_features(simulation_df, self.lags, self.windows), run)
+            return len(simulation_df)
+
+        keys = group_keys(simulation_df)
+        stored = self.read(name, columns=keys + ['date'], runs=[run])
+        if keys:
+            last_dates = stored.groupby(keys)['date'].max().rename('last_stored_date').reset_index()
+            merged = simulation_df.merge(last_dates, on=keys, how='left')
+            is_new = (merged['last_stored_date'].isna() | (merged['date'] > merged['last_stored_date'])).to_numpy()
+            context_start = merged.loc[is_new, 'last_stored_date'].min()
+        else:
+            is_new = (simulation_df['date'] > stored['date'].max()).to_numpy()
+            context_start = stored['date'].max()
+
+        new_rows = simulation_df[is_new]
+        if new_rows.empty:
+            return 0
+
+        # Prepend the stored tail of each affected series as lag/rolling context
+        lookback = max(max(self.lags), max(self.windows))
+        if pd.isna(context_start):
+            context = simulation_df.iloc[:0]
+        else:
+            since = (pd.Timestamp(context_start) - pd.DateOffset(months=lookback)).strftime('%Y-%m-%d')
+            context = self.read(name, columns=list(simulation_df.columns), runs=[run], since=since)
+            if keys:
+                context = context.merge(new_rows[keys].drop_duplicates(), on=keys)
+            context = context.groupby(keys, sort=False).tail(lookback) if keys else context.tail(lookback)
+        combined = pd.concat([context.assign(_new=False), new_rows.assign(_new=True)], ignore_index=True)
+        combined = combined.sort_values(keys + ['date'], kind='stable')
+
+        features = build_features(combined.drop(columns='_new'), self.lags, self.windows)
+        features = features[combined['_new'].to_numpy()]
+        self._append(name, features, run)
+        return len(features)
+
+
+def load_feature_frame(db_manager, table, feature_store=None, run_ids=None):
+    """
+    Load a simulation table with engineered features, optionally only for some
+    runs. With a `FeatureStore`, only rows not materialized yet are computed
+    and only the partitions of the loaded runs are read.
+    """
+    columns = ['run_id', 'scenario_id', 'date'] + DATA_COLUMNS
+    simulation_df = db_manager.load_simulation_frame(table, columns=columns, run_ids=run_ids)
+
+    if feature_store is None:
+        return build_features(simulation_df)
+
+    created_at = db_manager.load_runs().set_index('run_id')['created_at']
+    runs = []
+    for run_id, run_df in simulation_df.groupby('run_id', sort=True, dropna=False):
+        run = DEFAULT_RUN if pd.isna(run_id) else run_key(run_id, created_at[run_id])
+        feature_store.update(table.__tablename__, run_df, run)
+        runs.append(run)
+    if not runs:
+        return simulation_df
+    return feature_store.read(table.__tablename__, runs=runs)
@@ -0,0 +1,179 @@
+import numpy as np
+
+from Constants import SHORTAGE_THRESHOLD
+
+try:
+    import numba
+except ImportError:  # Numba is optional; the simulator falls back to its NumPy loop
+    numba = None
+
+NUMBA_AVAILABLE = numba is not None
+
+ENGINES = ('auto', 'numpy', 'numba')
+
+
+def resolve_engine(engine='auto'):
+    """
+    The engine that actually runs: "auto" picks Numba when it is installed.
+    """
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown engine '{engine}'. Choose from {list(ENGINES)}.")
+    if engine == 'numba' and not NUMBA_AVAILABLE:
+        raise ImportError("The numba engine needs the numba package (pip install numba).")
+    if engine == 'auto':
+        return 'numba' if NUMBA_AVAILABLE else 'numpy'
+    return engine
+
+
+def _recurrence_kernel(stock0, wirkstoff0, capacity, production_cycle, max_pharma_stock, max_wirkstoff_stock,
+                       demand, restock, restock_amounts, prod_issue,
+                       sales_out, stock_out, wirkstoff_out, shortage_out, cumulative_out,
+                       since_shortage_out, since_prod_issue_out, since_restock_out, final_wirkstoff):
+    """
+    The month recurrence of `DataSimulator._step` as explicit loops: scenarios
+    run in parallel, months in order. Same operations in the same order as the
+    NumPy reference, so results are identical.
+    """
+    n_scenarios, n_months = demand.shape
+    for i in numba.prange(n_scenarios):
+        stock = stock0[i]
+        wirkstoff_stock = wirkstoff0[i]
+        cumulative_shortages = 0
+        last_shortage_event = -1
+        last_prod_issue = -1
+        last_restock_day = 0
+
+        for month in range(n_months):
+            # Production logic
+            production_output = capacity[i]
+            required_wirkstoff = production_output * production_cycle[i]
+            if wirkstoff_stock >= required_wirkstoff:
+                wirkstoff_stock = wirkstoff_stock - required_wirkstoff
+            else:
+                production_output = wirkstoff_stock / production_cycle[i]
+                wirkstoff_stock = 0.0
+
+            if prod_issue[i, month]:
+                production_output = production_output * 0.9
+                last_prod_issue = month
+
+            stock = min(stock + production_output, max_pharma_stock[i])
+
+            # Shortage calculation
+            shortage_level = int((1 - (stock / max_pharma_stock[i])) * 9) + 1
+            shortage_level = min(max(shortage_level, 1), 10)
+            if shortage_level >= SHORTAGE_THRESHOLD:
+                cumulative_shortages += 1
+                last_shortage_event = month
+
+            # Restock logic
+            if restock[i, month]:
+                wirkstoff_stock = min(wirkstoff_stock + restock_amounts[i, month], max_wirkstoff_stock[i])
+                last_restock_day = month
+
+            # Sales logic
+            max_sales = stock * 0.65 if stock < max_pharma_stock[i] * 0.75 else stock
+            min_sales = stock * 0.02
+            monthly_sales = min(min(stock, demand[i, month]), max_sales)
+            monthly_sales = max(monthly_sales, min_sales)
+            stock = stock - monthly_sales
+
+            sales_out[i, month] = monthly_sales
+            stock_out[i, month] = stock
+            wirkstoff_out[i, month] = wirkstoff_stock
+            shortage_out[i, month] = shortage_level
+            cumulative_out[i, month] = cumulative_shortages
+            since_shortage_out[i, month] = month - last_shortage_event if last_shortage_event >= 0 else np.nan
+            since_prod_issue_out[i, month] = month - last_prod_issue if last_prod_issue >= 0 else np.nan
+            since_restock_out[i, month] = month - last_restock_day
+
+        final_wirkstoff[i] = wirkstoff_stock
+
+
+if NUMBA_AVAILABLE:
+    _recurrence_kernel = numba.njit(parallel=True, cache=True)(_recurrence_kernel)
+
+
+def run_recurrence(recurrence, state, demand, restock, restock_amounts, prod_issue):
+    """
+    Run the compiled recurrence for all (n_scenarios, months) inputs, starting
+    from a fresh `SimulationState`. Returns the same dict of output arrays as
+    the NumPy loop in `DataSimulator._simulate_paths` and leaves `state` at the last month.
+    """
+    n_scenarios, n_months = demand.shape
+    shape = (n_scenarios, n_months)
+    out = {
+        'sales': np.empty(shape), 'stock': np.empty(shape), 'wirkstoff_stock': np.empty(shape),
+        'shortage_level': np.empty(shape, dtype=np.int64), 'cumulative_shortages': np.empty(shape, dtype=np.int64),
+        'time_since_last_shortage_event': np.empty(shape), 'months_since_prod_issue': np.empty(shape),
+        'days_since_last_restock': np.empty(shape, dtype=np.int64),
+    }
+    final_wirkstoff = np.empty(n_scenarios)
+    vector = lambda values: np.ascontiguousarray(np.broadcast_to(np.asarray(values, dtype=float), (n_scenarios,)))
+
+    _recurrence_kernel(
+        vector(state.stock), vector(state.wirkstoff_stock), vector(recurrence['capacity']),
+        vector(recurrence['production_cycle']), vector(recurrence['max_pharma_stock']),
+        vector(recurrence['max_wirkstoff_stock']),
+        np.ascontiguousarray(demand, dtype=float), np.ascontiguousarray(restock, dtype=np.bool_),
+        np.ascontiguousarray(restock_amounts, dtype=float), np.ascontiguousarray(prod_issue, dtype=np.bool_),
+        out['sales'], out['stock'], out['wirkstoff_stock'], out['shortage_level'], out['cumulative_shortages'],
+        out['time_since_last_shortage_event'], out['months_since_prod_issue'], out['days_since_last_restock'],
+        final_wirkstoff,
+    )
+
+    # Recover the trackers of the last month from its output columns
+    last_month = n_months - 1
+    since_shortage = out['time_since_last_shortage_event'][:, -1]
+    since_prod_issue = out['months_since_prod_issue'][:, -1]
+    state.month = n_months
+    state.stock = out['stock'][:, -1].copy()
+    state.wirkstoff_stock = final_wirkstoff
+    state.cumulative_shortages = out['cumulative_shortages'][:, -1].copy()
+    state.last_shortage_event = np.where(np.isnan(since_shortage), -1, last_month - since_shortage).astype(int)
+    state.last_prod_issue = np.where(np.isnan(since_prod_issue), -1, last_month - since_prod_issue).astype(int)
+    state.last_restock_day = last_month - out['days_since_last_restock'][:, -1]
+    return out
+
+
+def verify_engines(n_scenarios=500, months=240, seed=0):
+    """
+    Run the same batch through the NumPy and the Numba engine and check that
+    every output column is identical. Returns the columns that differ.
+    """
+    from DataSimulator import DataSimulator
+
+    if not NUMBA_AVAILABLE:
+        raise ImportError("Numba is not installed; only the NumPy engine is available.")
+
+    mismatches = []
+    for scenarios, seed_offset in ((1, 0), (n_scenarios, 1)):
+        reference = DataSimulator(random_state=seed, months_to_simulate=months, engine='numpy')
+        compiled = DataSimulator(random_state=seed, months_to_simulate=months, engine='numba')
+        if scenarios == 1:
+            expected, actual = reference.simulate_sales_and_stock(), compiled.simulate_sales_and_stock()
+        else:
+            expected = reference.simulate_batch(scenarios, seed=seed + seed_offset)
+            actual = compiled.simulate_batch(scenarios, seed=seed + seed_offset)
+        mismatches += [f'{column}[scenarios={scenarios}]' for column in expected.columns
+                       if not expected[column].equals(actual[column])]
+    return mismatches
+
+
+if __name__ == '__main__':
+    import time
+
+    from DataSimulator import DataSimulator
+
+    if not NUMBA_AVAILABLE:
+        raise SystemExit("Numba is not installed; the simulator uses its NumPy engine.")
+
+    mismatches = verify_engines()
+    print("Numba and NumPy engines agree." if not mismatches else f"Engines differ in: {mismatches}")
+
+    for engine in ('numpy', 'numba'):
+        simulator = DataSimulator(random_state=0, engine=engine)
+        simulator.simulate_batch(10, seed=0)  # compile outside the timing
+        start = time.perf_counter()
+        simulator.simulate_batch(10_000, seed=0)
+        print(f"{engine}: 10,000 scenarios in {time.perf_counter() - start:.2f}s")
@@ -0,0 +1,140 @@
+import argparse
+import asyncio
+import json
+import sys
+import time
+from collections import Counter
+from urllib.parse import urlsplit
+
+import numpy as np
+
+
+PERCENTILES = (50, 90, 99)
+
+
+async def request(reader, writer, host, path):
+    """
+    GET `path` over an open keep-alive connection. Returns (status, body).
+    """
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: {host}\r\nConnection: keep-alive\r\n\r\n".encode("latin-1"))
+    await writer.drain()
+
+    status = int((await reader.readline()).split()[1])
+    content_length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        if name.strip().lower() == "content-length":
+            content_length = int(value)
+    return status, await reader.readexactly(content_length)
+
+
+async def client(host, port, paths, latencies, statuses, deadline):
+    """
+    One connection sending requests back to back, taking paths from the shared queue.
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while not paths.empty() and time.perf_counter() < deadline:
+            path = paths.get_nowait()
+            start = time.perf_counter()
+            try:
+                status, _ = await request(reader, writer, host, path)
+            except (ConnectionError, asyncio.IncompleteReadError, ValueError, IndexError):
+                statuses["error"] += 1
+                reader, writer = await asyncio.open_connection(host, port)
+                continue
+            latencies.append(time.perf_counter() - start)
+            statuses[status] += 1
+    finally:
+        writer.close()
+
+
+async def discover_paths(host, port, n_requests, page_size, hot_fraction, seed=0):
+    """
+    A request mix over the runs the service knows: simulation pages and forecasts.
+    `hot_fraction` of the requests repeat a small set of queries, the rest spread over many pages.
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    status, body = await request(reader, writer, host, "/runs")
+    writer.close()
+    if status != 200:
+        raise SystemExit(f"/runs returned {status}: {body[:200]!r}")
+    run_ids = [run["run_id"] for run in json.loads(body)["runs"]] or [1]
+
+    rng = np.random.default_rng(seed)
+    hot = [f"/simulations/testing?run_id={run_ids[-1]}&page=0&page_size={page_size}",
+           f"/simulations/training?run_id={run_ids[0]}&page=0&page_size={page_size}",
+           f"/forecast/testing?run_id={run_ids[-1]}&model=XGBoost&start=2033-01-01"]
+    paths = []
+    for _ in range(n_requests):
+        if rng.random() < hot_fraction:
+            paths.append(hot[rng.integers(len(hot))])
+        else:
+            dataset = ("training", "testing")[rng.integers(2)]
+            paths.append(f"/simulations/{dataset}?run_id={run_ids[rng.integers(len(run_ids))]}"
+                         f"&page={rng.integers(50)}&page_size={page_size}")
+    return paths
+
+
+async def run_load_test(url, n_requests=2_000, concurrency=32, duration=None, page_size=100, hot_fraction=0.8):
+    """
+    Send `n_requests` requests (or as many as fit in `duration` seconds) over
+    `concurrency` keep-alive connections. Returns latency percentiles in ms,
+    throughput and the count of every status.
+    """
+    parts = urlsplit(url)
+    host, port = parts.hostname, parts.port or 80
+
+    paths = asyncio.Queue()
+    for path in await discover_paths(host, port, n_requests, page_size, hot_fraction):
+        paths.put_nowait(path)
+
+    latencies, statuses = [], Counter()
+    deadline = time.perf_counter() + duration if duration else float("inf")
+    start = time.perf_counter()
+    await asyncio.gather(*(client(host, port, paths, latencies, statuses, deadline) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    latencies_ms = np.array(latencies) * 1000
+    report = {f"p{percentile}_ms": float(np.percentile(latencies_ms, percentile)) for percentile in PERCENTILES}
+    report.update(
+        mean_ms=float(latencies_ms.mean()),
+        max_ms=float(latencies_ms.max()),
+        requests=len(latencies),
+        requests_per_second=len(latencies) / elapsed,
+        statuses={str(status): number for status, number in sorted(statuses.items(), key=str)},
+    )
+    return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load-test the simulation query service (python Service.py).")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="Base URL of the running service.")
+    parser.add_argument("--requests", type=int, default=2_000, help="Number of requests to send.")
+    parser.add_argument("--concurrency", type=int, default=32, help="Concurrent keep-alive connections.")
+    parser.add_argument("--duration", type=float, help="Stop after this many seconds.")
+    parser.add_argument("--page-size", type=int, default=100, help="Rows per simulation page.")
+    parser.add_argument("--hot-fraction", type=float, default=0.8, help="Share of requests repeating hot queries.")
+    parser.add_argument("--output", help="Also write the report to this JSON file.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = asyncio.run(run_load_test(args.url, args.requests, args.concurrency, args.duration, args.page_size,
+                                       args.hot_fraction))
+    print(f"{report['requests']} requests, {report['requests_per_second']:,.0f} req/s, statuses {report['statuses']}")
+    print("  ".join(f"p{percentile} {report[f'p{percentile}_ms']:.2f}ms" for percentile in PERCENTILES)
+          + f"  max {report['max_ms']:.2f}ms")
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+    return 0 if set(report["statuses"]) <= {"200"} else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,102 +1,114 @@
-import pandas as pd
+import argparse
+import json
 import os
 
-from DB_Setup import init_db, TrainingSimulationData, TestingSimulationData
-from DB import DatabaseManager
-from DataSimulator import DataSimulator
-from Plotter import Plotter
-from PredictMed import train_and_evaluate_rolling_forecast
+from Pipeline import Pipeline, STAGES, load_config
+from utils import import_times
 
 
-def check_files_exist(file_paths):
-    """
-    Check if required files exist.
-    """
-    return all(os.path.exists(path) for path in file_paths)
-
+# Subcommands that run the pipeline, and the stage each one stops after
+COMMANDS = {
+    "simulate": ("persist", "Simulate the training and testing data and store it in the database."),
+    "train": ("tune", "Build the features and tune the models."),
+    "evaluate": ("evaluate", "Score the rolling forecasts of the tuned models."),
+    "plot": ("plot", "Render the score plots (the whole pipeline)."),
+}
 
-def main():
-    base_dir = "./Dataframes_CSV_PNG"
-    os.makedirs(base_dir, exist_ok=True)
+# Modules whose cold import time `report --imports` measures
+IMPORT_MODULES = ["Pipeline", "DB", "DataSimulator", "PredictMed", "Plotter"]
 
-    # Paths for CSV files
-    training_csv_path = os.path.join(base_dir, "training_simulation_results.csv")
-    testing_csv_path = os.path.join(base_dir, "testing_simulation_results.csv")
 
-    # Paths for PNG files
-    mse_by_step_path = os.path.join(base_dir, "mse_by_step_lavender.png")
-    average_mse_path = os.path.join(base_dir, "average_mse_lavender.png")
-    mse_comparison_path = os.path.join(base_dir, "mse_comparison_lavender.png")
+def add_pipeline_arguments(parser, defaults=True):
+    # Subcommands suppress the defaults so options given before the subcommand are kept
+    default = (lambda value: value) if defaults else (lambda value: argparse.SUPPRESS)
+    parser.add_argument("--config", default=default(None),
+                        help="JSON file overriding the default pipeline configuration.")
+    parser.add_argument("--force", nargs="+", default=default([]), choices=STAGES, metavar="STAGE",
+                        help=f"Re-run these stages (and all later ones) even if cached. Stages: {', '.join(STAGES)}.")
+    parser.add_argument("--profile", action="store_true", default=default(False),
+                        help="Capture cProfile and tracemalloc summaries per stage in the run report.")
 
-    # Initialize database and simulator
-    engine = init_db()
-    db_manager = DatabaseManager(engine)
-
-    # Check if simulations have already been run
-    if check_files_exist([training_csv_path, testing_csv_path]):
-        print("Simulations already completed. Loading data from CSV files...\n")
-        training_simulation = pd.read_csv(training_csv_path)
-        testing_simulation = pd.read_csv(testing_csv_path)
-    else:
-        print("Running simulations...\n")
 
-        # Run training simulation
-        simulator_train = DataSimulator(random_state=42, months_to_simulate=120)
-        training_simulation = simulator_train.simulate_sales_and_stock()
-        db_manager.save_simulation_to_db(training_simulation, TrainingSimulationData)
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Simulate, train and evaluate the shortage forecasting pipeline. "
+                                                 "Without a subcommand the whole pipeline runs.")
+    add_pipeline_arguments(parser)
+    parser.add_argument("--until", choices=STAGES, help="Stop after this stage.")
+    subparsers = parser.add_subparsers(dest="command", metavar="COMMAND")
 
-        # Save training simulation to CSV
-        training_simulation.to_csv(training_csv_path, index=False)
-        print("Training simulation saved.")
+    for command, (_, description) in COMMANDS.items():
+        add_pipeline_arguments(subparsers.add_parser(command, help=description, description=description),
+                               defaults=False)
 
-        # Run testing simulation
-        simulator_test = DataSimulator(random_state=99, months_to_simulate=120)
-        testing_simulation = simulator_test.simulate_sales_and_stock()
-        db_manager.save_simulation_to_db(testing_simulation, TestingSimulationData)
+    report_parser = subparsers.add_parser("report", help="Print the cached scores and the last run report.",
+                                          description="Print the cached scores and the last run report "
+                                                      "without running any stage.")
+    report_parser.add_argument("--config", default=argparse.SUPPRESS,
+                               help="JSON file overriding the default pipeline configuration.")
+    report_parser.add_argument("--imports", action="store_true",
+                               help="Also measure the cold import time of the main modules.")
+    return parser.parse_args(argv)
 
-        # Save testing simulation to CSV
-        testing_simulation.to_csv(testing_csv_path, index=False)
-        print("Testing simulation saved.\n")
 
-    print("Simulations completed.\n")
-
-    # Train and evaluate models with rolling forecast
-    print("Training and evaluating models with rolling forecast...\n")
-    mse_scores = train_and_evaluate_rolling_forecast(db_manager)
-
-    # Print evaluation results
+def print_scores(mse_scores):
     print("\nAlgorithm Performance (Rolling Forecast):\n")
     for model_name, scores in mse_scores.items():
         avg_mse = scores["average_mse"]
-        mse_list = [round(mse, 4) for mse in scores["mse_list"]]
+        mse_list = [round(float(mse), 4) for mse in scores["mse_list"]]
         print(f"{model_name}:")
         print(f" - Average MSE: {avg_mse:.4f}")
         print(f" - MSE List:")
         print("   ", mse_list, "\n")
 
-    print("Evaluation completed.\n")
 
-    # Initialize plotter
-    plotter = Plotter(save_path=base_dir)
-
-    # Generate plots if not already existing
-    if not os.path.exists(mse_by_step_path):
-        print("Generating MSE by Step plot...")
-        plotter.plot_mse_by_step(mse_scores, file_name="mse_by_step_lavender.png")
-    else:
-        print("MSE by Step plot already exists.")
-
-    if not os.path.exists(average_mse_path):
-        print("Generating Average MSE plot...")
-        plotter.plot_average_mse(mse_scores, file_name="average_mse_lavender.png")
+def report(pipeline, imports=False):
+    """
+    Print the cached scores and stage timings of the last run. Runs no stage
+    and imports none of the heavy dependencies.
+    """
+    mse_scores = pipeline.load_scores()
+    if mse_scores is None:
+        print("No scores yet; run `python Main.py evaluate` first.")
     else:
-        print("Average MSE plot already exists.")
+        print_scores(mse_scores)
+
+    report_name = pipeline.config["profiling"]["report"]
+    report_path = os.path.join(pipeline.base_dir, report_name) if report_name else None
+    if report_path and os.path.exists(report_path):
+        with open(report_path) as report_file:
+            run = json.load(report_file)
+        print(f"Last run ({run['created_at']}):")
+        for stage, timing in run.get("stages", {}).items():
+            print(f" - {stage:<9} {timing['seconds']:8.2f}s {'(cached)' if timing['cached'] else ''}")
+
+    if imports:
+        print("\nCold import times:")
+        for module, seconds in import_times(IMPORT_MODULES).items():
+            print(f" - {module:<14} {seconds:6.2f}s")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    config = load_config(args.config)
+    if args.command == "report":
+        report(Pipeline(config), imports=args.imports)
+        return
+
+    if args.profile:
+        config["profiling"].update(cprofile=True, tracemalloc=True)
+    until = COMMANDS[args.command][0] if args.command else args.until
+    pipeline = Pipeline(config, force=args.force)
+    pipeline.run(until=until)
+
+    # Scores exist once the pipeline got as far as the evaluate stage
+    mse_scores = pipeline.load_scores() if STAGES.index(until or STAGES[-1]) >= STAGES.index("evaluate") else None
+    if mse_scores is None:
+        return
 
-    if not os.path.exists(mse_comparison_path):
-        print("Generating MSE Comparison plot...")
-        plotter.plot_mse_comparison(mse_scores, file_name="mse_comparison_lavender.png")
-    else:
-        print("MSE Comparison plot already exists.")
+    # Print evaluation results
+    print_scores(mse_scores)
+    print("Evaluation completed.\n")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,84 @@
+import hashlib
+import json
+import os
+
+import joblib
+import numpy as np
+from sqlalchemy.orm import sessionmaker
+from xgboost import XGBModel, XGBRegressor
+
+from DB_Setup import TrainedModel
+
+
+def fingerprint(X_train, y_train, features, param_grid, **settings):
+    """
+    Hash of everything that determines a tuned model: the training data, the
+    feature list, the hyperparameter grid and any extra search settings.
+    """
+    digest = hashlib.sha256()
+    digest.update(np.ascontiguousarray(X_train, dtype=float).tobytes())
+    digest.update(np.ascontiguousarray(y_train, dtype=float).tobytes())
+    digest.update(json.dumps({"features": list(features), "param_grid": param_grid, "settings": settings},
+                             sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+class ModelRegistry:
+    """
+    Stores fitted scalers and best estimators on disk (joblib, or XGBoost's native
+    format) and indexes them in the `trained_models` table by fingerprint.
+    """
+
+    def __init__(self, engine, model_dir="./models"):
+        self.engine = engine
+        self.model_dir = os.path.abspath(model_dir)
+        self.session = sessionmaker(bind=self.engine)()
+        os.makedirs(self.model_dir, exist_ok=True)
+
+    def load(self, model_name, key):
+        """
+        Return (scaler, model, best_params) for a stored fingerprint, or None.
+        """
+        entry = self.session.query(TrainedModel).filter_by(model_name=model_name, fingerprint=key).first()
+        if entry is None or not (os.path.exists(entry.scaler_path) and os.path.exists(entry.model_path)):
+            return None
+
+        scaler = joblib.load(entry.scaler_path)
+        if entry.model_path.endswith(".ubj"):
+            model = XGBRegressor()
+            model.load_model(entry.model_path)
+        else:
+            model = joblib.load(entry.model_path)
+        return scaler, model, json.loads(entry.best_params)
+
+    def latest_key(self, model_name):
+        """
+        Fingerprint of the most recently stored `model_name`, or None.
+        """
+        entry = (self.session.query(TrainedModel).filter_by(model_name=model_name)
+                 .order_by(TrainedModel.created_at.desc(), TrainedModel.model_id.desc()).first())
+        return None if entry is None else entry.fingerprint
+
+    def save(self, model_name, key, scaler, model, best_params):
+        """
+        Store a fitted scaler and model under a fingerprint.
+        """
+        file_stem = os.path.join(self.model_dir, f"{model_name.lower().replace(' ', '_')}_{key[:16]}")
+        scaler_path = f"{file_stem}.scaler.joblib"
+        joblib.dump(scaler, scaler_path)
+
+        if isinstance(model, XGBModel):
+            model_path = f"{file_stem}.ubj"
+            model.save_model(model_path)
+        else:
+            model_path = f"{file_stem}.joblib"
+            joblib.dump(model, model_path)
+
+        entry = self.session.query(TrainedModel).filter_by(model_name=model_name, fingerprint=key).first()
+        if entry is None:
+            entry = TrainedModel(model_name=model_name, fingerprint=key)
+            self.session.add(entry)
+        entry.best_params = json.dumps(best_params, default=str)
+        entry.scaler_path = scaler_path
+        entry.model_path = model_path
+        self.session.commit()
@@ -0,0 +1,165 @@
+import numpy as np
+import pandas as pd
+
+from DataSimulator import DataSimulator, SimulationState, SIMULATION_COLUMNS
+from Decomposition import decompose
+from utils import count, timed
+
+
+# Per-series parameters, scaled by the series' demand weight relative to the single reference drug
+DEMAND_SCALED_PARAMETERS = ['population', 'variance', 'initial_pharma_stock', 'max_pharma_stock',
+                            'max_production_capacity']
+# Per-pool parameters, scaled by the summed demand weight of the series drawing on the pool
+POOL_SCALED_PARAMETERS = ['wirkstoff_stock', 'max_wirkstoff_stock', 'wirkstoff_restock_amount',
+                          'wirkstoff_restock_variance']
+
+POOL_SCOPES = ('site', 'network')
+
+NETWORK_COLUMNS = ['product_id', 'site_id', 'scenario_id'] + SIMULATION_COLUMNS + ['wirkstoff_allocation']
+
+
+def make_network(n_products, n_sites, n_wirkstoffe, seed=None):
+    """
+    A random synthetic network for what-if runs. Returns the products
+    (product_id, name, wirkstoff, demand_share) and the sites (site_id, name,
+    capacity_share). `demand_share` is relative to the single reference drug of
+    `DataSimulator`; the capacity shares of the sites add up to one.
+    """
+    rng = np.random.default_rng(seed)
+    products = pd.DataFrame({
+        'product_id': np.arange(1, n_products + 1),
+        'name': [f'Product {i}' for i in range(1, n_products + 1)],
+        'wirkstoff': [f'Wirkstoff {i}' for i in rng.integers(1, n_wirkstoffe + 1, size=n_products)],
+        'demand_share': rng.lognormal(mean=-0.5, sigma=0.5, size=n_products),
+    })
+    capacity_share = rng.dirichlet(np.full(n_sites, 5.0))
+    sites = pd.DataFrame({
+        'site_id': np.arange(1, n_sites + 1),
+        'name': [f'Site {i}' for i in range(1, n_sites + 1)],
+        'capacity_share': capacity_share,
+    })
+    return products, sites
+
+
+class NetworkSimulator:
+    """
+    Simulates every product at every site in one vectorized pass.
+
+    Each (product, site) series runs the `DataSimulator` month recurrence with
+    its parameters scaled by `demand_share * capacity_share`. Production no
+    longer has a Wirkstoff stock of its own: all products using the same
+    Wirkstoff draw on one shared pool per site (`pool_scope="site"`) or one pool
+    for the whole network (`pool_scope="network"`). When a pool cannot cover
+    this month's requirement, every series gets the same share of what it needs
+    (pro-rata allocation), reported as `wirkstoff_allocation`.
+    """
+
+    def __init__(self, products, sites, random_state=None, months_to_simulate=120, pool_scope='site',
+                 decomposer='classical', decomposition_cache=None):
+        if pool_scope not in POOL_SCOPES:
+            raise ValueError(f"Unknown pool scope '{pool_scope}'. Choose from {list(POOL_SCOPES)}.")
+        self.products = pd.DataFrame(products).reset_index(drop=True)
+        self.sites = pd.DataFrame(sites).reset_index(drop=True)
+        self.random_state = random_state
+        self.pool_scope = pool_scope
+        self.decomposer = decomposer
+        self.decomposition_cache = decomposition_cache
+        self.reference = DataSimulator(random_state=random_state, months_to_simulate=months_to_simulate)
+
+        # One series per (product, site), products varying slowest
+        product_index = np.repeat(np.arange(len(self.products)), len(self.sites))
+        site_index = np.tile(np.arange(len(self.sites)), len(self.products))
+        self.series = pd.DataFrame({
+            'product_id': self.products['product_id'].to_numpy()[product_index],
+            'site_id': self.sites['site_id'].to_numpy()[site_index],
+            'wirkstoff': self.products['wirkstoff'].to_numpy()[product_index],
+            'weight': (self.products['demand_share'].to_numpy()[product_index]
+                       * self.sites['capacity_share'].to_numpy()[site_index]),
+        })
+
+        pool_keys = ['wirkstoff', 'site_id'] if pool_scope == 'site' else ['wirkstoff']
+        self.series['pool_id'] = self.series.groupby(pool_keys, sort=True).ngroup()
+        self.pools = (self.series.groupby('pool_id')
+                      .agg(**{key: (key, 'first') for key in pool_keys}, weight=('weight', 'sum'))
+                      .reset_index())
+
+    def run_parameters(self):
+        """
+        Parameters describing this network, as stored with a simulation run.
+        """
+        parameters = self.reference.run_parameters()
+        parameters.update(n_products=len(self.products), n_sites=len(self.sites), n_pools=len(self.pools),
+                          pool_scope=self.pool_scope)
+        return parameters
+
+    def draw_parameters(self, rng):
+        """
+        Per-series and per-pool parameter arrays around the reference drug's base parameters.
+        """
+        weight = self.series['weight'].to_numpy()
+        series_params = self.reference.draw_scenario_parameters(len(self.series), rng)
+        for name in DEMAND_SCALED_PARAMETERS:
+            series_params[name] = series_params[name] * weight
+
+        base = self.reference.base_parameters
+        pool_weight = self.pools['weight'].to_numpy()
+        pool_params = {name: base[name] * pool_weight for name in POOL_SCALED_PARAMETERS}
+        pool_params['wirkstoff_restock_interval'] = np.full(len(self.pools), base['wirkstoff_restock_interval'])
+        return series_params, pool_params
+
+    @timed('network.simulate')
+    def simulate(self, seed=None):
+        """
+        Simulate the whole network. Returns a long-format DataFrame with one row
+        per product, site and month (`NETWORK_COLUMNS`).
+        """
+        rng = np.random.default_rng(self.random_state if seed is None else seed)
+        dates = self.reference.get_dates()
+
+        series_params, pool_params = self.draw_parameters(rng)
+        noise = self.reference._draw_batch_noise(series_params, dates, rng)
+        pool_noise = pool_params['wirkstoff_restock_variance'].reshape(-1, 1) * rng.standard_normal(
+            (len(self.pools), len(dates)))
+
+        paths = self._simulate_network(series_params, pool_params, self.series['pool_id'].to_numpy(), noise,
+                                       pool_noise, dates)
+        paths['trend'], paths['seasonal'], paths['residual'] = decompose(
+            paths['sales'], dates, decomposer=self.decomposer, cache=self.decomposition_cache
+        )
+        count('network.series', len(self.series))
+
+        # The flat scenario axis of the paths enumerates the series; the network itself is one scenario
+        frame = DataSimulator._paths_to_frame(paths, dates)
+        series_index = frame['scenario_id'].to_numpy()
+        frame['scenario_id'] = 0
+        frame.insert(0, 'site_id', self.series['site_id'].to_numpy()[series_index])
+        frame.insert(0, 'product_id', self.series['product_id'].to_numpy()[series_index])
+        frame['wirkstoff_allocation'] = paths['wirkstoff_allocation'].ravel()
+        return frame.round(2)
+
+    @staticmethod
+    def _simulate_network(series_params, pool_params, pool_index, noise, pool_noise, dates):
+        """
+        The `DataSimulator` month recurrence with the Wirkstoff stock moved from
+        the series to shared pools (`DataSimulator._step` with `pool_index`).
+        Returns (n_series, months) arrays.
+        """
+        n_series, n_months = noise['demand_noise'].shape
+        recurrence = DataSimulator._recurrence_parameters(series_params)
+        recurrence['max_wirkstoff_stock'] = np.asarray(pool_params['max_wirkstoff_stock'], dtype=float)
+
+        # Demand per series; the restock outputs are replaced by the pool restocks below
+        demand, _, _ = DataSimulator._month_inputs(series_params, noise, np.arange(n_months), dates)
+
+        months = np.arange(n_months)
+        pool_restock = (months % pool_params['wirkstoff_restock_interval'].reshape(-1, 1)) == 0
+        pool_restock_amounts = np.where(
+            pool_restock, np.maximum(0, pool_params['wirkstoff_restock_amount'].reshape(-1, 1) + pool_noise), 0.0)
+
+        state = SimulationState(series_params, n_series, pool_params)
+        out = DataSimulator._run_steps(state, recurrence, demand, pool_restock, pool_restock_amounts,
+                                       noise['prod_issue'], pool_index)
+
+        # Ratios and scaling as for single series; pool columns are reported per series
+        recurrence['max_wirkstoff_stock'] = recurrence['max_wirkstoff_stock'][pool_index]
+        return DataSimulator._derived_columns(out, recurrence, pool_restock_amounts[pool_index], noise['spike'])
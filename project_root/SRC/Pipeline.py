@@ -0,0 +1,385 @@
+import copy
+import hashlib
+import json
+import os
+import time
+
+from utils import metrics, profile_stage, run_report
+
+# Heavy dependencies (pandas, SQLAlchemy, pyarrow, sklearn, XGBoost, matplotlib) are
+# imported inside the stages that use them, so cached runs and reports start fast
+
+
+STAGES = ["simulate", "persist", "features", "tune", "evaluate", "plot"]
+
+DATASETS = ("training", "testing")
+
+
+def dataset_tables():
+    """
+    The ORM table of every dataset.
+    """
+    from DB_Setup import TrainingSimulationData, TestingSimulationData
+
+    return {"training": TrainingSimulationData, "testing": TestingSimulationData}
+
+DEFAULT_CONFIG = {
+    "base_dir": "./Dataframes_CSV_PNG",
+    "db_name": "simulation_3nf.db",
+    "simulation": {
+        "seed": None,
+        "max_workers": 2,
+        "store_dir": "./simulation_store",
+        "store_format": "feather",
+        "export_csv": False,
+        "training": {"random_state": 42, "n_scenarios": None, "simulator_args": {"months_to_simulate": 120}},
+        "testing": {"random_state": 99, "n_scenarios": None, "simulator_args": {"months_to_simulate": 120}},
+    },
+    "features": {"store_dir": "./feature_store"},
+    "tuning": {
+        "model_dir": "./models",
+        "features": None,  # None: Features.BASE_FEATURES
+        "search_strategy": "random",
+        "search_budget": 20,
+        "cv_splits": 3,
+        # Concurrent model searches and the cores they share (null: one process per model, all cores)
+        "max_workers": None,
+        "core_budget": None,
+    },
+    # "quantiles": e.g. [0.05, 0.5, 0.95] also scores probabilistic multi-horizon forecasts
+    "evaluation": {"steps": 12, "quantiles": None},
+    "plot": {"max_workers": None},
+    "profiling": {"cprofile": False, "tracemalloc": False, "top": 20, "report": "run_report.json"},
+}
+
+
+def load_config(path=None):
+    """
+    Default configuration, overridden by the sections of a JSON config file.
+    """
+    config = copy.deepcopy(DEFAULT_CONFIG)
+    if path is not None:
+        with open(path) as config_file:
+            _merge(config, json.load(config_file))
+    return config
+
+
+def _merge(base, overrides):
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(base.get(key), dict):
+            _merge(base[key], value)
+        else:
+            base[key] = value
+
+
+def stage_fingerprint(*parts):
+    """
+    Hash of a stage's configuration and the fingerprint of the stage before it.
+    """
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class Pipeline:
+    """
+    Runs simulate -> persist -> features -> tune -> evaluate -> plot.
+
+    Every stage is fingerprinted by its config section plus the fingerprint of
+    the previous stage. A stage whose fingerprint matches the stored state and
+    whose outputs still exist is loaded instead of run; once a stage runs, all
+    later stages run too. State is kept in `pipeline_state.json` in `base_dir`.
+    """
+
+    def __init__(self, config=None, force=()):
+        self.config = config or load_config()
+        self.force = set(force)
+        self.base_dir = self.config["base_dir"]
+        os.makedirs(self.base_dir, exist_ok=True)
+
+        self.state_path = os.path.join(self.base_dir, "pipeline_state.json")
+        self.state = {}
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as state_file:
+                self.state = json.load(state_file)
+
+        self.context = {}
+        self.timings = {}
+        self.fingerprint = None
+        self._db_manager = None
+
+    @property
+    def db_manager(self):
+        if self._db_manager is None:
+            from DB_Setup import init_db
+            from DB import DatabaseManager
+
+            self._db_manager = DatabaseManager(init_db(self.config["db_name"]))
+        return self._db_manager
+
+    def stage_config(self, stage):
+        return {
+            "simulate": self.config["simulation"],
+            "persist": {"db_name": self.config["db_name"]},
+            "features": self.config["features"],
+            "tune": self.config["tuning"],
+            "evaluate": self.config["evaluation"],
+            "plot": self.config["plot"],
+        }[stage]
+
+    def run(self, until=None, lazy=True):
+        """
+        Run (or load) all stages up to and including `until`. Returns the context dict.
+
+        Loading a cached stage's outputs is only needed to run a later stage, so
+        with `lazy` and every stage cached only the last stage is loaded.
+        """
+        profiling = self.config["profiling"]
+        stages = STAGES[:STAGES.index(until) + 1] if until else STAGES
+        upstream = None
+        upstream_ran = False
+        metrics.reset()
+
+        fingerprints = []
+        for stage in stages:
+            upstream = stage_fingerprint(upstream, stage, self.stage_config(stage))
+            fingerprints.append(upstream)
+        lazy = lazy and all(stage not in self.force and self.state.get(stage, {}).get("fingerprint") == fingerprint
+                            for stage, fingerprint in zip(stages, fingerprints))
+
+        for stage, fingerprint in zip(stages, fingerprints):
+            self.fingerprint = fingerprint
+            start = time.perf_counter()
+
+            with profile_stage(stage, cprofile=profiling["cprofile"], memory=profiling["tracemalloc"],
+                               top=profiling["top"]):
+                if lazy:
+                    cached = stage != stages[-1] or getattr(self, f"load_{stage}")(self.state[stage]["outputs"])
+                    if not cached:
+                        # The last stage's outputs are gone: load and run the stages the usual way
+                        return self.run(until, lazy=False)
+                else:
+                    cached = (not upstream_ran and stage not in self.force
+                              and self.state.get(stage, {}).get("fingerprint") == fingerprint
+                              and getattr(self, f"load_{stage}")(self.state[stage]["outputs"]))
+                if not cached:
+                    outputs = getattr(self, f"run_{stage}")()
+                    self.state[stage] = {"fingerprint": fingerprint, "outputs": outputs}
+                    self._save_state()
+                    upstream_ran = True
+
+            elapsed = time.perf_counter() - start
+            self.timings[stage] = {"seconds": elapsed, "cached": bool(cached)}
+            print(f"[{stage}] {'loaded from cache' if cached else 'ran'} in {elapsed:.2f}s")
+
+        if profiling["report"]:
+            report_path = os.path.join(self.base_dir, profiling["report"])
+            run_report(report_path, stages=self.timings, config=self.config)
+            print(f"Run report written to {report_path}.")
+        return self.context
+
+    def load_scores(self):
+        """
+        Rolling forecast scores of the last evaluate stage, without running anything. None if there are none.
+        """
+        if "mse_scores" not in self.context:
+            outputs = self.state.get("evaluate", {}).get("outputs")
+            if outputs is None or not self.load_evaluate(outputs):
+                return None
+        return self.context["mse_scores"]
+
+    def _save_state(self):
+        with open(self.state_path, "w") as state_file:
+            json.dump(self.state, state_file, indent=2, default=str)
+
+    def features(self):
+        """
+        The configured model features, `Features.BASE_FEATURES` by default.
+        """
+        from Features import BASE_FEATURES
+
+        return self.config["tuning"]["features"] or BASE_FEATURES
+
+    def simulation_store(self):
+        from SimulationStore import SimulationStore
+
+        simulation_config = self.config["simulation"]
+        return SimulationStore(simulation_config["store_dir"], simulation_config["store_format"])
+
+    # simulate: run the configured simulations and keep them in the simulation store
+    def run_simulate(self):
+        from SimulationRunner import run_simulations
+
+        simulation_config = self.config["simulation"]
+        results = run_simulations([simulation_config[name] for name in DATASETS],
+                                  max_workers=simulation_config["max_workers"], seed=simulation_config["seed"])
+
+        store = self.simulation_store()
+        store_run = self.fingerprint[:12]
+        outputs = {}
+        self.context["simulations"] = {}
+        for name, result in zip(DATASETS, results):
+            store.write(name, result["simulation"], run_id=store_run)
+            if simulation_config["export_csv"]:
+                store.export_csv(name, os.path.join(self.base_dir, f"{name}_simulation_results.csv"), run_ids=[store_run])
+            self.context["simulations"][name] = result["simulation"]
+            outputs[name] = {"dataset": name, "store_run": store_run,
+                             "parameters": result["parameters"], "seed": result["random_state"]}
+        return outputs
+
+    def load_simulate(self, outputs):
+        store = self.simulation_store()
+        if not all(store.exists(output["dataset"], output["store_run"]) for output in outputs.values()):
+            return False
+        self.context["simulations"] = {
+            name: self._widen(store.read(output["dataset"], run_ids=[output["store_run"]]).drop(columns="run_id"))
+            for name, output in outputs.items()
+        }
+        return True
+
+    @staticmethod
+    def _widen(simulation_df):
+        """
+        Back to the simulator's dtypes. The simulator rounds to two decimals, so
+        rounding the float32 values restores the exact float64 values.
+        """
+        widened = simulation_df.astype({column: "float64" for column in simulation_df.columns
+                                        if simulation_df[column].dtype == "float32"})
+        float_columns = widened.select_dtypes("float64").columns
+        widened[float_columns] = widened[float_columns].round(2)
+        for column in ("date", "month_name"):
+            widened[column] = widened[column].astype(str)
+        return widened
+
+    # persist: store the simulations as new runs, replacing the runs of the previous persist
+    def run_persist(self):
+        previous_run_ids = list(self.state.get("persist", {}).get("outputs", {}).values())
+        if previous_run_ids:
+            from Features import FeatureStore
+
+            self.db_manager.delete_runs(previous_run_ids)
+            feature_store = FeatureStore(self.config["features"]["store_dir"])
+            for table in dataset_tables().values():
+                feature_store.drop_runs(table.__tablename__, previous_run_ids)
+
+        simulation_outputs = self.state["simulate"]["outputs"]
+        run_ids = {}
+        for name, table in dataset_tables().items():
+            run_ids[name] = self.db_manager.create_simulation_run(simulation_outputs[name]["parameters"],
+                                                                  seed=simulation_outputs[name]["seed"])
+            self.db_manager.bulk_save_simulation_to_db(self.context["simulations"][name], table,
+                                                       run_id=run_ids[name])
+        self.context["run_ids"] = run_ids
+        return run_ids
+
+    def load_persist(self, outputs):
+        tables = dataset_tables()
+        if not all(self.db_manager.count_run_rows(tables[name], [run_id]) for name, run_id in outputs.items()):
+            return False
+        self.context["run_ids"] = outputs
+        return True
+
+    # features: materialize features for the persisted runs
+    def run_features(self):
+        from Features import FeatureStore, load_feature_frame
+
+        feature_store = FeatureStore(self.config["features"]["store_dir"])
+        self.context["feature_frames"] = {
+            name: load_feature_frame(self.db_manager, table, feature_store, run_ids=[self.context["run_ids"][name]])
+            for name, table in dataset_tables().items()
+        }
+        return {"store_dir": feature_store.store_dir}
+
+    def load_features(self, outputs):
+        from Features import FeatureStore
+
+        feature_store = FeatureStore(outputs["store_dir"])
+        if not all(feature_store.exists(table.__tablename__) for table in dataset_tables().values()):
+            return False
+        # A lazy run loads no earlier stage; the persisted runs must still be in the database
+        if "run_ids" not in self.context and not self.load_persist(self.state["persist"]["outputs"]):
+            return False
+        self.run_features()
+        return True
+
+    # tune: tune the models, stored in the model registry
+    def run_tune(self):
+        from ModelRegistry import ModelRegistry
+        from PredictMed import tune_models
+
+        tuning = self.config["tuning"]
+        features = self.features()
+        registry = ModelRegistry(self.db_manager.engine, model_dir=tuning["model_dir"])
+        training_df = self.context["feature_frames"]["training"].dropna(subset=features)
+
+        self.context["tuned_models"] = tune_models(training_df, features, tuning["search_strategy"],
+                                                   tuning["search_budget"], tuning["cv_splits"], registry,
+                                                   tuning["max_workers"], tuning["core_budget"])
+        return {name: tuned["fingerprint"] for name, tuned in self.context["tuned_models"].items()}
+
+    def load_tune(self, outputs):
+        from ModelRegistry import ModelRegistry
+
+        registry = ModelRegistry(self.db_manager.engine, model_dir=self.config["tuning"]["model_dir"])
+        tuned_models = {}
+        for model_name, model_key in outputs.items():
+            stored = registry.load(model_name, model_key)
+            if stored is None:
+                return False
+            scaler, model, best_params = stored
+            tuned_models[model_name] = {"scaler": scaler, "model": model, "best_params": best_params,
+                                        "fingerprint": model_key}
+        self.context["tuned_models"] = tuned_models
+        return True
+
+    # evaluate: rolling forecast scores, kept as JSON
+    def run_evaluate(self):
+        from PredictMed import evaluate_models, evaluate_probabilistic_models
+
+        features = self.features()
+        testing_df = self.context["feature_frames"]["testing"].dropna(subset=features)
+        mse_scores = evaluate_models(testing_df, features, self.context["tuned_models"],
+                                     steps=self.config["evaluation"]["steps"])
+
+        scores_path = os.path.join(self.base_dir, "mse_scores.json")
+        with open(scores_path, "w") as scores_file:
+            json.dump(mse_scores, scores_file, indent=2, default=float)
+        self.context["mse_scores"] = mse_scores
+        outputs = {"scores": scores_path}
+
+        quantiles = self.config["evaluation"]["quantiles"]
+        if quantiles:
+            training_df = self.context["feature_frames"]["training"].dropna(subset=features)
+            quantile_scores = evaluate_probabilistic_models(training_df, testing_df, features,
+                                                            steps=self.config["evaluation"]["steps"],
+                                                            quantiles=quantiles)
+            outputs["quantile_scores"] = os.path.join(self.base_dir, "quantile_scores.json")
+            with open(outputs["quantile_scores"], "w") as scores_file:
+                json.dump(quantile_scores, scores_file, indent=2)
+            self.context["quantile_scores"] = quantile_scores
+        return outputs
+
+    def load_evaluate(self, outputs):
+        if not all(os.path.exists(path) for path in outputs.values()):
+            return False
+        with open(outputs["scores"]) as scores_file:
+            self.context["mse_scores"] = json.load(scores_file)
+        if "quantile_scores" in outputs:
+            with open(outputs["quantile_scores"]) as scores_file:
+                self.context["quantile_scores"] = json.load(scores_file)
+        return True
+
+    # plot: render the score plots headless
+    def run_plot(self):
+        from Plotter import Plotter
+
+        mse_scores = self.context["mse_scores"]
+        plotter = Plotter(save_path=self.base_dir, interactive=False)
+        plotter.render_all([
+            ("plot_mse_by_step", mse_scores, "mse_by_step_lavender.png"),
+            ("plot_average_mse", mse_scores, "average_mse_lavender.png"),
+            ("plot_mse_comparison", mse_scores, "mse_comparison_lavender.png"),
+        ], max_workers=self.config["plot"]["max_workers"])
+        return {"plots": [os.path.join(plotter.save_path, file_name) for file_name in
+                          ("mse_by_step_lavender.png", "average_mse_lavender.png", "mse_comparison_lavender.png")]}
+
+    def load_plot(self, outputs):
+        return all(os.path.exists(path) for path in outputs["plots"])
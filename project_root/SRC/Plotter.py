@@ -1,10 +1,19 @@
-import matplotlib.pyplot as plt
+import hashlib
+import json
 import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from matplotlib.figure import Figure
+
+from utils import count, metrics, timed
 
 
 class Plotter:
-    def __init__(self, save_path="./Dataframes_CSV_PNG"):
+    def __init__(self, save_path="./Dataframes_CSV_PNG", interactive=True):
         self.save_path = os.path.abspath(save_path)  # Use absolute path
+        # Headless mode draws on plain Figure objects and never touches pyplot
+        self.interactive = interactive
         self.ensure_save_directory()
 
     def ensure_save_directory(self):
@@ -13,11 +22,34 @@ class Plotter:
         """
         os.makedirs(self.save_path, exist_ok=True)
 
+    def new_figure(self, figsize):
+        """
+        Create a figure with one Axes, through pyplot only in interactive mode.
+        """
+        if self.interactive:
+            import matplotlib.pyplot as plt
+            fig = plt.figure(figsize=figsize)
+        else:
+            fig = Figure(figsize=figsize)
+        return fig, fig.subplots()
+
+    def finish_figure(self, fig, file_name):
+        """
+        Save the figure and show it in interactive mode. Returns the file path.
+        """
+        fig.tight_layout()
+        file_path = os.path.join(self.save_path, file_name)
+        fig.savefig(file_path)
+        if self.interactive:
+            import matplotlib.pyplot as plt
+            plt.show()
+        return file_path
+
     def plot_mse_by_step(self, mse_scores, file_name="mse_by_step.png"):
         """
         Plot MSE values for each step in the rolling forecast for all models.
         """
-        plt.figure(figsize=(10, 6))
+        fig, ax = self.new_figure(figsize=(10, 6))
 
         colors = {
             "Linear Regression": "#b19cd9",  # Lavender
@@ -28,18 +60,15 @@ class Plotter:
         for model, scores in mse_scores.items():
             mse_list = scores["mse_list"]
             steps = range(1, len(mse_list) + 1)
-            plt.plot(steps, mse_list, marker='o', label=model, color=colors.get(model, "#9370db"))
+            ax.plot(steps, mse_list, marker='o', label=model, color=colors.get(model, "#9370db"))
 
-        plt.title("MSE by Step in Rolling Forecast", fontsize=14)
-        plt.xlabel("Step (Month)", fontsize=12)
-        plt.ylabel("Mean Squared Error (MSE)", fontsize=12)
-        plt.legend(title="Models", fontsize=10)
-        plt.grid(True, linestyle='--', alpha=0.7)
-        plt.tight_layout()
+        ax.set_title("MSE by Step in Rolling Forecast", fontsize=14)
+        ax.set_xlabel("Step (Month)", fontsize=12)
+        ax.set_ylabel("Mean Squared Error (MSE)", fontsize=12)
+        ax.legend(title="Models", fontsize=10)
+        ax.grid(True, linestyle='--', alpha=0.7)
 
-        file_path = os.path.join(self.save_path, file_name)
-        plt.savefig(file_path)
-        plt.show()
+        file_path = self.finish_figure(fig, file_name)
         print(f"MSE by Step plot saved as {file_path}.")
 
     def plot_average_mse(self, mse_scores, file_name="average_mse.png"):
@@ -51,17 +80,14 @@ class Plotter:
 
         colors = ["#b19cd9", "#9370db", "#8a2be2"]
 
-        plt.figure(figsize=(8, 6))
-        plt.bar(models, averages, color=colors)
-        plt.title("Average MSE Across Rolling Forecast", fontsize=14)
-        plt.xlabel("Models", fontsize=12)
-        plt.ylabel("Average Mean Squared Error (MSE)", fontsize=12)
-        plt.grid(axis='y', linestyle='--', alpha=0.7)
-        plt.tight_layout()
+        fig, ax = self.new_figure(figsize=(8, 6))
+        ax.bar(models, averages, color=colors)
+        ax.set_title("Average MSE Across Rolling Forecast", fontsize=14)
+        ax.set_xlabel("Models", fontsize=12)
+        ax.set_ylabel("Average Mean Squared Error (MSE)", fontsize=12)
+        ax.grid(axis='y', linestyle='--', alpha=0.7)
 
-        file_path = os.path.join(self.save_path, file_name)
-        plt.savefig(file_path)
-        plt.show()
+        file_path = self.finish_figure(fig, file_name)
         print(f"Average MSE plot saved as {file_path}.")
 
     def plot_mse_comparison(self, mse_scores, file_name="mse_comparison.png"):
@@ -74,20 +100,102 @@ class Plotter:
 
         colors = ["#b19cd9", "#9370db", "#8a2be2"]
 
-        plt.figure(figsize=(12, 6))
+        fig, ax = self.new_figure(figsize=(12, 6))
         for i, (model, scores) in enumerate(mse_scores.items()):
             mse_list = scores["mse_list"]
-            plt.bar([pos + (i * width) for pos in x], mse_list, width=width, label=model, color=colors[i])
+            ax.bar([pos + (i * width) for pos in x], mse_list, width=width, label=model, color=colors[i])
 
-        plt.title("MSE Comparison Across Steps", fontsize=14)
-        plt.xlabel("Step (Month)", fontsize=12)
-        plt.ylabel("Mean Squared Error (MSE)", fontsize=12)
-        plt.xticks([pos + width for pos in x], steps)
-        plt.legend(title="Models", fontsize=10)
-        plt.grid(axis='y', linestyle='--', alpha=0.7)
-        plt.tight_layout()
+        ax.set_title("MSE Comparison Across Steps", fontsize=14)
+        ax.set_xlabel("Step (Month)", fontsize=12)
+        ax.set_ylabel("Mean Squared Error (MSE)", fontsize=12)
+        ax.set_xticks([pos + width for pos in x], steps)
+        ax.legend(title="Models", fontsize=10)
+        ax.grid(axis='y', linestyle='--', alpha=0.7)
 
-        file_path = os.path.join(self.save_path, file_name)
-        plt.savefig(file_path)
-        plt.show()
+        file_path = self.finish_figure(fig, file_name)
         print(f"MSE Comparison plot saved as {file_path}.")
+
+    def plot_mse_percentile_bands(self, scenario_mse, file_name="mse_percentile_bands.png",
+                                  percentiles=(5, 25, 50, 75, 95)):
+        """
+        Plot the median MSE by step across many scenarios with percentile bands.
+        `scenario_mse` maps each model to an array of shape (n_scenarios, steps).
+        """
+        colors = ["#b19cd9", "#9370db", "#8a2be2"]
+        low, mid_low, median, mid_high, high = percentiles
+
+        fig, ax = self.new_figure(figsize=(10, 6))
+        for i, (model, mse) in enumerate(scenario_mse.items()):
+            bands = np.nanpercentile(np.asarray(mse, dtype=float), percentiles, axis=0)
+            steps = range(1, bands.shape[1] + 1)
+            color = colors[i % len(colors)]
+            ax.fill_between(steps, bands[0], bands[4], color=color, alpha=0.15,
+                            label=f"{model} P{low}-P{high}")
+            ax.fill_between(steps, bands[1], bands[3], color=color, alpha=0.3,
+                            label=f"{model} P{mid_low}-P{mid_high}")
+            ax.plot(steps, bands[2], marker='o', color=color, label=f"{model} median")
+
+        ax.set_title("MSE by Step Across Scenarios", fontsize=14)
+        ax.set_xlabel("Step (Month)", fontsize=12)
+        ax.set_ylabel("Mean Squared Error (MSE)", fontsize=12)
+        ax.legend(title="Models", fontsize=9)
+        ax.grid(True, linestyle='--', alpha=0.7)
+
+        file_path = self.finish_figure(fig, file_name)
+        print(f"MSE percentile band plot saved as {file_path}.")
+
+    @staticmethod
+    def scores_hash(data):
+        """
+        Stable hash of the data a plot is drawn from.
+        """
+        encoded = json.dumps(data, sort_keys=True, default=lambda value: np.asarray(value, dtype=float).tolist())
+        return hashlib.sha256(encoded.encode()).hexdigest()
+
+    def render_if_changed(self, plot_name, data, file_name):
+        """
+        Render `plot_name` (e.g. "plot_mse_by_step") unless the PNG exists and was
+        drawn from identical data. The data hash is kept next to the PNG.
+        Returns True if the plot was (re)generated.
+        """
+        file_path = os.path.join(self.save_path, file_name)
+        hash_path = f"{file_path}.sha256"
+        data_hash = self.scores_hash(data)
+
+        if os.path.exists(file_path) and os.path.exists(hash_path):
+            with open(hash_path) as hash_file:
+                if hash_file.read().strip() == data_hash:
+                    count("plot.skipped")
+                    print(f"{file_name} is up to date.")
+                    return False
+
+        with timed(f"plot.{plot_name}"):
+            getattr(self, plot_name)(data, file_name=file_name)
+        count("plot.rendered")
+        with open(hash_path, "w") as hash_file:
+            hash_file.write(data_hash)
+        return True
+
+    def render_all(self, jobs, max_workers=None):
+        """
+        Render (plot_name, data, file_name) jobs headless in parallel worker
+        processes, skipping plots whose data did not change.
+        Returns {file_name: regenerated}.
+        """
+        regenerated = {}
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(_render_job, self.save_path, *job) for job in jobs]
+            for job, future in zip(jobs, futures):
+                regenerated[job[2]], job_metrics = future.result()
+                metrics.merge(job_metrics)
+        return regenerated
+
+
+def _render_job(save_path, plot_name, data, file_name):
+    """
+    Worker entry point for `Plotter.render_all`. Returns the result and the
+    worker's metrics for this job.
+    """
+    metrics.reset()
+    regenerated = Plotter(save_path, interactive=False).render_if_changed(plot_name, data, file_name)
+    return regenerated, metrics.snapshot()
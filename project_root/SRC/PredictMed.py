@@ -1,54 +1,358 @@
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
 import pandas as pd
 import numpy as np
-from sklearn.model_selection import GridSearchCV
-from sklearn.linear_model import LinearRegression
+from joblib import parallel_config
+from threadpoolctl import threadpool_limits
+from sklearn.base import clone
+from sklearn.experimental import enable_halving_search_cv  # noqa: F401, enables HalvingGridSearchCV
+from sklearn.model_selection import GridSearchCV, HalvingGridSearchCV, RandomizedSearchCV, TimeSeriesSplit
+from sklearn.linear_model import LinearRegression, SGDRegressor
 from sklearn.svm import SVR
 from xgboost import XGBRegressor
 from sklearn.preprocessing import StandardScaler
 from sklearn.metrics import mean_squared_error
 from DB_Setup import TrainingSimulationData, TestingSimulationData
+from ModelRegistry import fingerprint
+from Features import BASE_FEATURES, group_keys, load_feature_frame
+from utils import count, metrics, timed
 
 
-def evaluate_rolling_forecast(testing_df, features, scaler, model, steps=12):
+# Share of the most recent training months held out for XGBoost early stopping
+EARLY_STOPPING_FRACTION = 0.2
+EARLY_STOPPING_ROUNDS = 20
+
+# Quantiles of the probabilistic forecasts; the outer two bound the prediction interval
+QUANTILES = (0.05, 0.5, 0.95)
+# Share of the most recent training rows held out to calibrate conformal intervals
+CALIBRATION_FRACTION = 0.2
+
+# Features known at the end of a month; trend and seasonal need the whole series and do not exist online
+ONLINE_FEATURES = ['sales', 'stock', 'wirkstoff_stock', 'last_restock_amount', 'days_since_last_restock',
+                   'shortage_level']
+
+
+def make_grid_search(model, param_grid, cv, budget=None, random_state=0, n_jobs=-1):
     """
-    Evaluate the model using a rolling forecast for the next `steps` months.
+    Exhaustive search over the whole grid.
     """
-    mse_list = []
-    X_test = testing_df[features]
-    y_test = testing_df['shortage_level']
+    return GridSearchCV(model, param_grid, cv=cv, scoring="neg_mean_squared_error", n_jobs=n_jobs)
+
 
-    for i in range(steps):
-        # Ensure we don't exceed available test data
-        if i >= len(X_test):
-            break
+def make_halving_search(model, param_grid, cv, budget=None, random_state=0, n_jobs=-1):
+    """
+    Successive halving: every round keeps the best third of the candidates and
+    gives them three times as many training samples.
+    """
+    return HalvingGridSearchCV(model, param_grid, cv=cv, factor=3, scoring="neg_mean_squared_error", n_jobs=n_jobs,
+                               random_state=random_state)
 
-        # Scale the current test row
-        X_test_scaled = scaler.transform(pd.DataFrame([X_test.iloc[i]], columns=features))
-        y_pred = model.predict(X_test_scaled)[0]
 
-        # Get the actual value and calculate MSE for this step
-        y_actual = y_test.iloc[i]
-        mse = (y_actual - y_pred) ** 2
-        mse_list.append(mse)
+def make_random_search(model, param_grid, cv, budget=20, random_state=0, n_jobs=-1):
+    """
+    Randomized search limited to `budget` candidates (budget * folds fits).
+    """
+    n_candidates = int(np.prod([len(values) for values in param_grid.values()]))
+    return RandomizedSearchCV(model, param_grid, n_iter=min(budget, n_candidates), cv=cv,
+                              scoring="neg_mean_squared_error", n_jobs=n_jobs, random_state=random_state)
+
+
+SEARCH_STRATEGIES = {
+    "grid": make_grid_search,
+    "halving": make_halving_search,
+    "random": make_random_search,
+}
+
+
+def evaluate_rolling_forecast(testing_df, features, scaler, model, steps=12):
+    """
+    Evaluate the model using a rolling forecast for the next `steps` months.
+    """
+    results = evaluate_forecast_batch(testing_df, features, scaler, model, steps=steps)
+    mse_list = [mse for mse in results["mse_by_step"] if not np.isnan(mse)]
 
     # Calculate average MSE over all steps
     avg_mse = np.mean(mse_list)
     return avg_mse, mse_list
 
 
-def train_and_evaluate_rolling_forecast(db_manager):
+def forecast_origins(n_months, steps=12, stride=None):
     """
-    Train models and evaluate their rolling forecast performance over 12 months with hyperparameter tuning.
+    Forecast origins every `stride` months (default: `steps`) that leave room for a full horizon.
     """
-    # Load data from the database
-    training_df = db_manager.load_simulation_data(TrainingSimulationData)
-    testing_df = db_manager.load_simulation_data(TestingSimulationData)
+    stride = stride or steps
+    return np.arange(0, max(n_months - steps, 0) + 1, stride)
 
-    # Feature set
-    features = [
-        'sales', 'stock', 'last_restock_amount', 'days_since_last_restock',
-        'wirkstoff_stock', 'trend', 'seasonal',
-    ]
+
+@timed("predict.evaluate_forecast_batch")
+def evaluate_forecast_batch(testing_df, features, scaler, model, steps=12, origins=None, window="sliding",
+                            series_keys=None):
+    """
+    Evaluate a forecast over many horizons, origins and test scenarios with one
+    `scaler.transform` and one `model.predict` call.
+
+    Rows are grouped into series by `series_keys` (default:
+    `Features.group_keys`, i.e. run, product, site and scenario where present)
+    in their given order. `origins` are month offsets within each series
+    (default: [0]). A "sliding" window scores months origin..origin+steps-1; an
+    "expanding" window scores all months from 0 to origin+steps-1, so its
+    horizon grows with the origin. Steps past the end of a series are NaN and
+    ignored by the aggregates.
+
+    Returns a dict of arrays: per-forecast errors of shape
+    (n_series, n_origins, horizon), per-step MSE/MAE/accuracy, and the
+    aggregate values. Accuracy compares the rounded prediction with `shortage_level`.
+    """
+    if window not in ("sliding", "expanding"):
+        raise ValueError(f"Unknown window '{window}'. Use 'sliding' or 'expanding'.")
+    origins = np.atleast_1d(np.asarray([0] if origins is None else origins, dtype=int))
+
+    # Predict every test row at once
+    y_pred = np.asarray(model.predict(scaler.transform(testing_df[features])), dtype=float)
+    y_test = testing_df['shortage_level'].to_numpy(dtype=float)
+    count("predict.predictions", len(y_pred))
+
+    # Lay rows out as (n_series, n_months), padding shorter series with NaN
+    keys = group_keys(testing_df) if series_keys is None else list(series_keys)
+    if keys:
+        grouped = testing_df.groupby(keys, sort=False)
+        series_codes = grouped.ngroup().to_numpy()
+        positions = grouped.cumcount().to_numpy()
+    else:
+        series_codes = np.zeros(len(testing_df), dtype=int)
+        positions = np.arange(len(testing_df))
+    n_series = series_codes.max() + 1 if len(testing_df) else 0
+    n_months = positions.max() + 1 if len(testing_df) else 0
+
+    predicted = np.full((n_series, n_months), np.nan)
+    actual = np.full((n_series, n_months), np.nan)
+    predicted[series_codes, positions] = y_pred
+    actual[series_codes, positions] = y_test
+
+    # Month index for every (origin, step) of the forecast windows
+    if window == "sliding":
+        month_index = origins[:, None] + np.arange(steps)[None, :]
+    else:
+        month_index = np.broadcast_to(np.arange(origins.max() + steps), (len(origins), origins.max() + steps)).copy()
+        month_index[month_index >= origins[:, None] + steps] = -1
+    valid = (month_index >= 0) & (month_index < n_months)
+    month_index = np.where(valid, month_index, 0)
+
+    predicted = np.where(valid, predicted[:, month_index], np.nan)
+    actual = np.where(valid, actual[:, month_index], np.nan)
+
+    squared_error = (actual - predicted) ** 2
+    absolute_error = np.abs(actual - predicted)
+    correct = np.where(np.isnan(actual), np.nan, np.clip(np.rint(predicted), 1, 10) == actual)
+
+    with warnings.catch_warnings():
+        # Steps that no window reaches are all-NaN and stay NaN
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        return {
+            "squared_error": squared_error,
+            "absolute_error": absolute_error,
+            "correct": correct,
+            "mse_by_step": np.nanmean(squared_error, axis=(0, 1)),
+            "mae_by_step": np.nanmean(absolute_error, axis=(0, 1)),
+            "accuracy_by_step": np.nanmean(correct, axis=(0, 1)),
+            "average_mse": np.nanmean(squared_error),
+            "average_mae": np.nanmean(absolute_error),
+            "accuracy": np.nanmean(correct),
+        }
+
+
+# Hyperparameter grids for each model
+PARAM_GRIDS = {
+    "Linear Regression": {
+        "fit_intercept": [True, False]
+    },
+    "XGBoost": {
+        "learning_rate": [0.01, 0.1, 0.2],
+        "max_depth": [3, 5, 7],
+        "subsample": [0.8, 1.0],
+    },
+    "SVM": {
+        "C": [0.1, 1, 10],
+        "epsilon": [0.01, 0.1, 0.5],
+        "kernel": ["linear", "rbf"],
+    },
+}
+
+
+# Model families to tune: {name: {"build", "param_grid", "threads", "eval_set"}}, see `register_model_family`
+MODEL_FAMILIES = {}
+
+
+def register_model_family(name, build, param_grid, threads=1, eval_set=False):
+    """
+    Add a model family to `tune_models`.
+
+    `build(n_threads)` returns a fresh, unfitted estimator using at most
+    `n_threads` threads per fit; it is sent to the tuning processes, so it must
+    be picklable (a module-level function or class). `threads` is how many
+    threads a fit should get: a search job with c cores runs c // threads
+    candidates at once. With `eval_set`, the held-out most recent training
+    months are passed to `fit` for early stopping (XGBoost style), and the best
+    estimator is refit on all training months with the number of boosting
+    rounds early stopping chose.
+    """
+    MODEL_FAMILIES[name] = {"build": build, "param_grid": param_grid, "threads": threads, "eval_set": eval_set}
+
+
+def build_linear_regression(n_threads):
+    return LinearRegression()
+
+
+def build_xgboost(n_threads):
+    return XGBRegressor(n_estimators=1000, early_stopping_rounds=EARLY_STOPPING_ROUNDS, n_jobs=n_threads)
+
+
+def build_svm(n_threads):
+    return SVR()
+
+
+register_model_family("Linear Regression", build_linear_regression, PARAM_GRIDS["Linear Regression"])
+# The search already runs candidates in parallel, so each booster uses one thread
+register_model_family("XGBoost", build_xgboost, PARAM_GRIDS["XGBoost"], eval_set=True)
+register_model_family("SVM", build_svm, PARAM_GRIDS["SVM"])
+
+
+def build_models():
+    """
+    Fresh, unfitted instances of the registered models to tune.
+    """
+    return {name: family["build"](family["threads"]) for name, family in MODEL_FAMILIES.items()}
+
+
+class IncrementalXGBRegressor:
+    """
+    XGBoost with continued training for online learning.
+
+    `partial_fit` collects rows in a window of the most recent `window` rows and,
+    on the first call and every `update_every` calls after it, adds
+    `trees_per_update` trees fitted on that window to the existing booster. Once
+    the booster has `max_trees` trees it is refitted from scratch on the window,
+    so memory stays bounded on endless streams.
+    """
+
+    def __init__(self, window=2_000, update_every=6, trees_per_update=5, max_trees=200, **params):
+        self.window = window
+        self.update_every = update_every
+        self.trees_per_update = trees_per_update
+        self.max_trees = max_trees
+        self.params = params
+        self.model = None
+        self.n_trees = 0
+        self._calls = 0
+        self._X = self._y = None
+
+    def partial_fit(self, X, y):
+        X, y = np.asarray(X, dtype=float), np.asarray(y, dtype=float)
+        self._X = X[-self.window:] if self._X is None else np.concatenate([self._X, X])[-self.window:]
+        self._y = y[-self.window:] if self._y is None else np.concatenate([self._y, y])[-self.window:]
+
+        if self.model is None or self._calls % self.update_every == 0:
+            restart = self.model is None or self.n_trees + self.trees_per_update > self.max_trees
+            model = XGBRegressor(n_estimators=self.trees_per_update, n_jobs=1, **self.params)
+            model.fit(self._X, self._y, xgb_model=None if restart else self.model.get_booster())
+            self.model = model
+            self.n_trees = self.trees_per_update if restart else self.n_trees + self.trees_per_update
+            count("predict.online_xgb_updates")
+        self._calls += 1
+        return self
+
+    def predict(self, X):
+        return self.model.predict(np.asarray(X, dtype=float))
+
+
+def build_online_models():
+    """
+    Fresh incremental learners for `evaluate_online`.
+    """
+    return {
+        "SGD": SGDRegressor(learning_rate="invscaling", eta0=0.01, random_state=0),
+        "XGBoost": IncrementalXGBRegressor(learning_rate=0.1, max_depth=3),
+    }
+
+
+def core_split(core_budget, n_jobs):
+    """
+    Cores per search job when `n_jobs` searches share `core_budget` cores.
+    """
+    return max(1, core_budget // max(1, n_jobs))
+
+
+def tune_job(model_name, family, search_strategy, search_budget, cv_splits, cores, data):
+    """
+    Run one model family's hyperparameter search on `cores` cores.
+
+    The search's joblib workers get cores // threads processes and every fit
+    `threads` threads; OpenMP/BLAS pools are capped to match, so XGBoost and
+    the search do not oversubscribe the job's cores.
+
+    Returns the best estimator and parameters, the best CV score, the number of
+    fits and the tuning time.
+    """
+    threads = min(family["threads"], cores)
+    search_jobs = max(1, cores // threads)
+
+    X_tune, y_tune, X_validation, y_validation, X_train_scaled, y_train = data
+    cv = TimeSeriesSplit(n_splits=cv_splits)
+    search = SEARCH_STRATEGIES[search_strategy](family["build"](threads), family["param_grid"], cv,
+                                                budget=search_budget, n_jobs=search_jobs)
+
+    with threadpool_limits(limits=threads), parallel_config(backend="loky", inner_max_num_threads=threads):
+        with timed(f"predict.tune.{model_name}") as tuning_timer:
+            if family["eval_set"]:
+                search.fit(X_tune, y_tune, eval_set=[(X_validation, y_validation)], verbose=False)
+            else:
+                search.fit(X_train_scaled, y_train)
+
+            best_model, best_params = search.best_estimator_, dict(search.best_params_)
+            if family["eval_set"]:
+                # The search never saw the validation months; refit on all of them with the chosen tree count
+                best_params["n_estimators"] = int(best_model.best_iteration) + 1
+                best_model = clone(best_model).set_params(n_estimators=best_params["n_estimators"],
+                                                          early_stopping_rounds=None)
+                best_model.fit(X_train_scaled, y_train, verbose=False)
+
+    # Every candidate row of cv_results_ was fitted once per split, plus the final refit(s)
+    n_fits = len(search.cv_results_["params"]) * search.n_splits_ + 1 + int(family["eval_set"])
+    return best_model, best_params, search.best_score_, n_fits, tuning_timer.elapsed
+
+
+def _tune_in_worker(*args):
+    """
+    `tune_job` inside a worker process; also returns the worker's metrics for this job.
+    """
+    metrics.reset()
+    return tune_job(*args) + (metrics.snapshot(),)
+
+
+def tune_models(training_df, features, search_strategy="random", search_budget=20, cv_splits=3, registry=None,
+                max_workers=None, core_budget=None):
+    """
+    Tune every registered model family (`MODEL_FAMILIES`) on the training data.
+
+    `search_strategy` picks an entry of `SEARCH_STRATEGIES`; `search_budget` caps
+    the candidates of the randomized search. Cross-validation uses time-ordered
+    splits. XGBoost stops adding trees once the held-out most recent training
+    months stop improving, so `n_estimators` is not part of its grid; the best
+    model is then refit on all training months with that many trees.
+
+    The searches run concurrently in up to `max_workers` processes (default:
+    one per model) that share `core_budget` cores (default: all) evenly; see
+    `tune_job`. With one worker the searches run one after another in this process.
+
+    With a `ModelRegistry`, models whose fingerprint (training data, features,
+    param grid and search settings) is already stored are loaded instead of refit.
+
+    Returns {model_name: {"scaler", "model", "best_params", "fingerprint"}}.
+    """
+    if search_strategy not in SEARCH_STRATEGIES:
+        raise ValueError(f"Unknown search strategy '{search_strategy}'. Choose from {list(SEARCH_STRATEGIES)}.")
 
     # Separate features and target variable for training
     X_train = training_df[features]
@@ -58,41 +362,346 @@ def train_and_evaluate_rolling_forecast(db_manager):
     scaler = StandardScaler()
     X_train_scaled = scaler.fit_transform(X_train)
 
-    # Define hyperparameter grids for each model
-    param_grids = {
-        "Linear Regression": {
-            "fit_intercept": [True, False]
-        },
-        "XGBoost": {
-            "n_estimators": [50, 100, 200],
-            "learning_rate": [0.01, 0.1, 0.2],
-            "max_depth": [3, 5, 7],
-            "subsample": [0.8, 1.0],
-        },
-        "SVM": {
-            "C": [0.1, 1, 10],
-            "epsilon": [0.01, 0.1, 0.5],
-            "kernel": ["linear", "rbf"],
-        },
-    }
+    # Hold out the most recent months as the XGBoost early-stopping validation set
+    n_validation = max(1, int(len(X_train_scaled) * EARLY_STOPPING_FRACTION))
+    X_tune, X_validation = X_train_scaled[:-n_validation], X_train_scaled[-n_validation:]
+    y_tune, y_validation = y_train.iloc[:-n_validation], y_train.iloc[-n_validation:]
+    data = (X_tune, y_tune, X_validation, y_validation, X_train_scaled, y_train)
 
-    rolling_steps = 12  # Number of months to forecast
-    mse_scores = {}
+    tuned_models = {}
+    pending = []
+
+    for model_name, family in MODEL_FAMILIES.items():
+        model_key = fingerprint(X_train, y_train, features, family["param_grid"], model=model_name,
+                                search_strategy=search_strategy, search_budget=search_budget, cv_splits=cv_splits,
+                                refit_on_all_months=family["eval_set"])
+        stored = registry.load(model_name, model_key) if registry is not None else None
 
-    for model_name, model in {"Linear Regression": LinearRegression(), "XGBoost": XGBRegressor(), "SVM": SVR()}.items():
-        print(f"Tuning {model_name}...")
-        param_grid = param_grids[model_name]
-        grid_search = GridSearchCV(model, param_grid, cv=3, scoring="neg_mean_squared_error", n_jobs=-1)
-        grid_search.fit(X_train_scaled, y_train)
+        if stored is not None:
+            model_scaler, best_model, best_params = stored
+            count("predict.registry_hits")
+            print(f"Loaded {model_name} from the model registry (best parameters: {best_params}).")
+            tuned_models[model_name] = {"scaler": model_scaler, "model": best_model, "best_params": best_params,
+                                        "fingerprint": model_key}
+        else:
+            pending.append((model_name, model_key))
 
-        print(f"Best parameters for {model_name}: {grid_search.best_params_}")
-        best_model = grid_search.best_estimator_
+    core_budget = core_budget or os.cpu_count()
+    max_workers = max(1, min(max_workers or len(pending), len(pending), core_budget))
+    cores = core_split(core_budget, max_workers)
+    jobs = [(model_name, MODEL_FAMILIES[model_name], search_strategy, search_budget, cv_splits, cores, data)
+            for model_name, _ in pending]
+    if pending:
+        print(f"Tuning {len(pending)} model(s) in {max_workers} process(es) with {cores} core(s) each...")
 
-        print(f"Training {model_name} with best parameters...")
-        avg_mse, mse_list = evaluate_rolling_forecast(testing_df, features, scaler, best_model, steps=rolling_steps)
+    if max_workers == 1:
+        results = [tune_job(*job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(_tune_in_worker, *job) for job in jobs]
+            results = []
+            for future in futures:
+                *result, job_metrics = future.result()
+                metrics.merge(job_metrics)
+                results.append(result)
+
+    for (model_name, model_key), result in zip(pending, results):
+        best_model, best_params, best_score, n_fits, elapsed = result
+        count("predict.fits", n_fits)
+        count("predict.models_tuned")
+        print(f"Tuned {model_name} in {elapsed:.2f}s (best MSE {-best_score:.4f}).")
+        print(f"Best parameters for {model_name}: {best_params}")
+        if registry is not None:
+            registry.save(model_name, model_key, scaler, best_model, best_params)
+
+        tuned_models[model_name] = {
+            "scaler": scaler,
+            "model": best_model,
+            "best_params": best_params,
+            "fingerprint": model_key,
+        }
+
+    # Keep the registration order, whether a model was loaded or tuned
+    return {model_name: tuned_models[model_name] for model_name in MODEL_FAMILIES}
+
+
+def evaluate_models(testing_df, features, tuned_models, steps=12):
+    """
+    Evaluate the rolling forecast of every tuned model over `steps` months.
+    """
+    mse_scores = {}
+    for model_name, tuned in tuned_models.items():
+        print(f"Evaluating {model_name} with best parameters...")
+        avg_mse, mse_list = evaluate_rolling_forecast(testing_df, features, tuned["scaler"], tuned["model"],
+                                                      steps=steps)
         mse_scores[model_name] = {
             "average_mse": avg_mse,
             "mse_list": mse_list
         }
-
     return mse_scores
+
+
+@timed("predict.evaluate_online")
+def evaluate_online(stream, features=None, models=None, warmup_months=12, keep_history=False):
+    """
+    Evaluate incremental learners on a stream of months, e.g. `DataSimulator.stream`.
+
+    Every month, the `shortage_level` of each scenario is predicted from the
+    previous month's `features` before the month is revealed. Afterwards the
+    scaler (`StandardScaler.partial_fit`) and all models (`partial_fit`) learn
+    from the revealed month. Months before `warmup_months` are not scored, and
+    neither is any month before the models' first `partial_fit` (month 1), so
+    scoring starts at month max(`warmup_months`, 2).
+
+    Only running sums are kept, so memory does not grow with the horizon;
+    `keep_history` additionally collects the MSE of every scored month.
+    Returns {model: {"average_mse", "average_mae", "accuracy", "n_predictions", "mse_list"}}.
+    """
+    features = ONLINE_FEATURES if features is None else list(features)
+    models = build_online_models() if models is None else models
+    scaler = StandardScaler()
+    totals = {name: {"squared_error": 0.0, "absolute_error": 0.0, "correct": 0, "n_predictions": 0, "mse_list": []}
+              for name in models}
+
+    # The models first learn at month 1 and can only predict afterwards
+    first_scored_month = max(warmup_months, 2)
+    previous = None
+    for month, month_df in enumerate(stream):
+        y_month = month_df['shortage_level'].to_numpy(dtype=float)
+        if previous is not None:
+            X_previous = scaler.transform(previous)
+            for model_name, model in models.items():
+                if month >= first_scored_month:
+                    y_pred = np.asarray(model.predict(X_previous), dtype=float)
+                    squared_error = (y_month - y_pred) ** 2
+                    total = totals[model_name]
+                    total["squared_error"] += squared_error.sum()
+                    total["absolute_error"] += np.abs(y_month - y_pred).sum()
+                    total["correct"] += int((np.clip(np.rint(y_pred), 1, 10) == y_month).sum())
+                    total["n_predictions"] += len(y_month)
+                    if keep_history:
+                        total["mse_list"].append(squared_error.mean())
+                    count("predict.online_predictions", len(y_month))
+                model.partial_fit(X_previous, y_month)
+
+        previous = month_df[features].to_numpy(dtype=float)
+        scaler.partial_fit(previous)
+
+    scores = {}
+    for model_name, total in totals.items():
+        n_predictions = max(total["n_predictions"], 1)
+        scores[model_name] = {
+            "average_mse": float(total["squared_error"]) / n_predictions,
+            "average_mae": float(total["absolute_error"]) / n_predictions,
+            "accuracy": total["correct"] / n_predictions,
+            "n_predictions": total["n_predictions"],
+            "mse_list": total["mse_list"],
+        }
+    return scores
+
+
+def direct_targets(frame, steps=12, target="shortage_level"):
+    """
+    Targets of a direct multi-horizon forecast: row t gets the `target` of
+    months t+1..t+steps of its own series as an (n_rows, steps) array, NaN past
+    the end of the series.
+    """
+    keys = group_keys(frame)
+    values = frame[target].astype(float)
+    shifted = values.groupby([frame[key] for key in keys], sort=False) if keys else values
+    return np.column_stack([shifted.shift(-step).to_numpy() for step in range(1, steps + 1)])
+
+
+def pinball_loss(actual, predicted, quantiles=QUANTILES):
+    """
+    Pinball (quantile) loss of every prediction: `actual` of any shape,
+    `predicted` with one more trailing axis holding the `quantiles`.
+    NaN where `actual` is NaN.
+    """
+    quantiles = np.asarray(quantiles, dtype=float)
+    difference = np.asarray(actual, dtype=float)[..., None] - predicted
+    return np.maximum(quantiles * difference, (quantiles - 1) * difference)
+
+
+def interval_coverage(actual, lower, upper):
+    """
+    1.0 where `actual` lies in [lower, upper], 0.0 where not and NaN where `actual` is NaN.
+    """
+    actual = np.asarray(actual, dtype=float)
+    return np.where(np.isnan(actual), np.nan, (actual >= lower) & (actual <= upper))
+
+
+class QuantileXGBForecaster:
+    """
+    Direct multi-horizon quantile forecast with one XGBoost model.
+
+    Every row is repeated once per horizon with the horizon as an extra
+    feature, and a single booster with the quantile objective learns all
+    `quantiles` at once. `predict` returns (n_rows, steps, n_quantiles) from
+    one `predict` call; quantiles are sorted so they never cross.
+    """
+
+    def __init__(self, steps=12, quantiles=QUANTILES, **params):
+        self.steps = steps
+        self.quantiles = tuple(quantiles)
+        self.params = params
+        self.model = None
+
+    def _stack(self, X):
+        X = np.asarray(X, dtype=float)
+        horizons = np.tile(np.arange(1, self.steps + 1, dtype=float), len(X)).reshape(-1, 1)
+        return np.hstack([np.repeat(X, self.steps, axis=0), horizons])
+
+    def fit(self, X, Y):
+        y = np.asarray(Y, dtype=float).ravel()
+        known = ~np.isnan(y)
+        self.model = XGBRegressor(objective="reg:quantileerror", quantile_alpha=np.array(self.quantiles),
+                                  **self.params)
+        self.model.fit(self._stack(X)[known], y[known])
+        return self
+
+    def predict(self, X):
+        predicted = np.asarray(self.model.predict(self._stack(X)), dtype=float)
+        return np.sort(predicted.reshape(len(X), self.steps, len(self.quantiles)), axis=-1)
+
+
+class ConformalForecaster:
+    """
+    Split-conformal quantiles around a direct multi-horizon point model.
+
+    `model` is any regressor that fits an (n_rows, steps) target and predicts
+    all steps in one call (`LinearRegression`, multi-output `XGBRegressor`).
+    The most recent `calibration_fraction` of the rows is held out; per horizon,
+    the residual quantiles on it (with the finite-sample correction) become the
+    offsets of the forecast `quantiles`. Rows without a full horizon are not used.
+    """
+
+    def __init__(self, model, quantiles=QUANTILES, calibration_fraction=CALIBRATION_FRACTION):
+        self.model = model
+        self.quantiles = tuple(quantiles)
+        self.calibration_fraction = calibration_fraction
+        self.offsets = None
+
+    def fit(self, X, Y):
+        X, Y = np.asarray(X, dtype=float), np.asarray(Y, dtype=float)
+        complete = ~np.isnan(Y).any(axis=1)
+        X, Y = X[complete], Y[complete]
+        n_calibration = max(1, int(len(X) * self.calibration_fraction))
+
+        self.model.fit(X[:-n_calibration], Y[:-n_calibration])
+        residuals = Y[-n_calibration:] - np.asarray(self.model.predict(X[-n_calibration:]), dtype=float)
+
+        # Widen the empirical levels by one calibration point so the intervals keep their coverage
+        levels = [min(1.0, np.ceil((n_calibration + 1) * q) / n_calibration) if q >= 0.5
+                  else max(0.0, np.floor((n_calibration + 1) * q) / n_calibration) for q in self.quantiles]
+        self.offsets = np.stack([np.quantile(residuals, level, axis=0, method="higher" if q >= 0.5 else "lower")
+                                 for q, level in zip(self.quantiles, levels)], axis=-1)
+        return self
+
+    def predict(self, X):
+        point = np.asarray(self.model.predict(np.asarray(X, dtype=float)), dtype=float)
+        return point.reshape(len(point), -1)[:, :, None] + self.offsets[None]
+
+
+def build_probabilistic_models(steps=12, quantiles=QUANTILES):
+    """
+    Fresh, unfitted probabilistic multi-horizon models.
+    """
+    return {
+        "XGBoost Quantile": QuantileXGBForecaster(steps, quantiles, n_estimators=200, learning_rate=0.1, max_depth=3,
+                                                  n_jobs=1),
+        "Conformal Linear": ConformalForecaster(LinearRegression(), quantiles),
+        "Conformal XGBoost": ConformalForecaster(
+            XGBRegressor(n_estimators=200, learning_rate=0.1, max_depth=3, multi_strategy="one_output_per_tree",
+                         n_jobs=1), quantiles),
+    }
+
+
+@timed("predict.evaluate_quantile_forecast")
+def evaluate_quantile_forecast(testing_df, features, scaler, model, steps=12, quantiles=QUANTILES):
+    """
+    Score a probabilistic multi-horizon forecast on every row of every test
+    scenario with one `model.predict` call.
+
+    Every row is a forecast origin for months t+1..t+steps. Returns arrays of
+    pinball loss per step and quantile, coverage and width of the interval
+    between the outer quantiles per step, and the MSE of the quantile closest
+    to the median, plus their averages. Steps past the end of a series are ignored.
+    """
+    actual = direct_targets(testing_df, steps)
+    predicted = np.asarray(model.predict(scaler.transform(testing_df[features])), dtype=float)
+    count("predict.predictions", len(testing_df))
+
+    loss = pinball_loss(actual, predicted, quantiles)
+    lower, upper = predicted[..., 0], predicted[..., -1]
+    covered = interval_coverage(actual, lower, upper)
+    width = np.where(np.isnan(actual), np.nan, upper - lower)
+    median = predicted[..., int(np.argmin(np.abs(np.asarray(quantiles) - 0.5)))]
+    squared_error = (actual - median) ** 2
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        return {
+            "quantiles": np.asarray(quantiles, dtype=float),
+            "pinball_by_step": np.nanmean(loss, axis=0),
+            "coverage_by_step": np.nanmean(covered, axis=0),
+            "width_by_step": np.nanmean(width, axis=0),
+            "mse_by_step": np.nanmean(squared_error, axis=0),
+            "average_pinball": np.nanmean(loss),
+            "coverage": np.nanmean(covered),
+            "nominal_coverage": quantiles[-1] - quantiles[0],
+            "average_width": np.nanmean(width),
+            "average_mse": np.nanmean(squared_error),
+        }
+
+
+def evaluate_probabilistic_models(training_df, testing_df, features, steps=12, quantiles=QUANTILES, models=None):
+    """
+    Fit the probabilistic multi-horizon models (default: `build_probabilistic_models`)
+    on the training data and score them with `evaluate_quantile_forecast`.
+    Returns {model_name: scores} with lists instead of arrays, ready for JSON.
+    """
+    models = build_probabilistic_models(steps, quantiles) if models is None else models
+    scaler = StandardScaler()
+    X_train = scaler.fit_transform(training_df[features])
+    Y_train = direct_targets(training_df, steps)
+
+    scores = {}
+    for model_name, model in models.items():
+        print(f"Fitting {model_name}...")
+        with timed(f"predict.fit.{model_name}"):
+            model.fit(X_train, Y_train)
+        count("predict.models_fitted")
+        results = evaluate_quantile_forecast(testing_df, features, scaler, model, steps, quantiles)
+        scores[model_name] = {name: value.tolist() if isinstance(value, np.ndarray) else float(value)
+                              for name, value in results.items()}
+        print(f"{model_name}: pinball loss {results['average_pinball']:.4f}, "
+              f"coverage {results['coverage']:.1%} (nominal {results['nominal_coverage']:.0%}).")
+    return scores
+
+
+def train_and_evaluate_rolling_forecast(db_manager, search_strategy="random", search_budget=20, cv_splits=3,
+                                        registry=None, features=None, feature_store=None, run_ids=None,
+                                        max_workers=None, core_budget=None):
+    """
+    Train models and evaluate their rolling forecast performance over 12 months with hyperparameter tuning.
+
+    See `tune_models` for the search arguments, the registry and the process
+    and core budget of the concurrent searches. `features` defaults to
+    `BASE_FEATURES`; any column built by `Features.build_features` can be used.
+    With a `FeatureStore` the features are read from the store and only
+    computed for months that were not materialized yet. `run_ids` restricts
+    both tables to the given simulation runs.
+    """
+    # Feature set
+    features = BASE_FEATURES if features is None else list(features)
+
+    # Load features; the first months of each series have no lags yet
+    training_df = load_feature_frame(db_manager, TrainingSimulationData, feature_store, run_ids)
+    testing_df = load_feature_frame(db_manager, TestingSimulationData, feature_store, run_ids)
+
+    tuned_models = tune_models(training_df.dropna(subset=features), features, search_strategy, search_budget,
+                               cv_splits, registry, max_workers, core_budget)
+
+    rolling_steps = 12  # Number of months to forecast
+    return evaluate_models(testing_df.dropna(subset=features), features, tuned_models, steps=rolling_steps)
@@ -0,0 +1,348 @@
+import argparse
+import asyncio
+import json
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+
+from DB_Setup import init_db, TrainingSimulationData, TestingSimulationData
+from DB import DatabaseManager, DATA_COLUMNS, SUMMARY_GROUPS
+from Features import build_features
+from ModelRegistry import ModelRegistry
+from utils import count, metrics, timed
+
+
+DATASETS = {"training": TrainingSimulationData, "testing": TestingSimulationData}
+
+SERIES_COLUMNS = ["run_id", "scenario_id", "product_id", "site_id"]
+
+DEFAULT_PAGE_SIZE = 1_000
+MAX_PAGE_SIZE = 10_000
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class TTLCache:
+    """
+    In-memory LRU cache whose entries also expire `ttl` seconds after they were stored.
+    """
+
+    def __init__(self, maxsize=256, ttl=60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        stored_at, value = entry
+        if time.monotonic() - stored_at > self.ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self._entries[key] = (time.monotonic(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class QueryService:
+    """
+    Read-only HTTP/JSON service over the simulation database and the model registry.
+
+    SQLite is queried through a pool of `pool_size` connections by as many
+    worker threads, so the event loop never blocks on a query. Responses of
+    hot queries are kept in a `TTLCache`; concurrent requests for the same
+    uncached response share one query. Fitted models are loaded once from the
+    registry (the most recent entry per model name) and kept in memory.
+
+    Endpoints (GET, JSON):
+    - /health
+    - /runs
+    - /simulations/<training|testing>?run_id=&scenario_id=&start=&end=&columns=&page=&page_size=
+    - /forecast/<training|testing>?model=&run_id=&scenario_id=&start=&end=
+    - /summary/<training|testing>?group_by=&run_id=&product_id=&site_id=&scenario_id=&month=
+    - /stats
+    """
+
+    def __init__(self, db_name="simulation_3nf.db", model_dir="./models", pool_size=4, cache_size=256, ttl=60.0):
+        self.engine = init_db(db_name, pool_size=pool_size, max_overflow=0)
+        self.db_manager = DatabaseManager(self.engine)
+        self.registry = ModelRegistry(self.engine, model_dir=model_dir)
+        self.pool_size = pool_size
+        self.executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="query")
+        self.cache = TTLCache(cache_size, ttl)
+        self.models = {}
+        self._model_lock = threading.Lock()
+        self._inflight = {}
+        self.routes = {
+            "health": self.health,
+            "runs": self.runs,
+            "simulations": self.simulations,
+            "forecast": self.forecast,
+            "summary": self.summary,
+            "stats": self.stats,
+        }
+
+    # Endpoints: (query parameters, path arguments) -> JSON-serializable payload, run in a worker thread
+
+    def health(self, params):
+        return {"status": "ok"}
+
+    def runs(self, params):
+        runs = self.db_manager.load_runs()
+        runs["created_at"] = runs["created_at"].astype(str)
+        parameters = [json.loads(parameters) if parameters else {} for parameters in runs.pop("parameters")]
+        return {"runs": [dict(run, parameters=run_parameters)
+                         for run, run_parameters in zip(_records(runs), parameters)]}
+
+    def simulations(self, params, dataset=None):
+        table = self._table(dataset)
+        page = _int_param(params, "page", 0)
+        page_size = min(_int_param(params, "page_size", DEFAULT_PAGE_SIZE), MAX_PAGE_SIZE)
+        if page < 0 or page_size < 1:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "'page' must be >= 0 and 'page_size' >= 1.")
+        columns = params["columns"].split(",") if "columns" in params else SERIES_COLUMNS[:2] + ["date"] + DATA_COLUMNS
+        unknown = set(columns) - set(SERIES_COLUMNS + ["date"] + DATA_COLUMNS)
+        if unknown:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, f"Unknown columns {sorted(unknown)}.")
+
+        frame, has_more = self.db_manager.load_simulation_page(
+            table, page=page, page_size=page_size, columns=columns, start_date=params.get("start"),
+            end_date=params.get("end"), run_ids=_id_list(params, "run_id"),
+            scenario_ids=_id_list(params, "scenario_id"),
+        )
+        return {"page": page, "page_size": page_size, "next_page": page + 1 if has_more else None,
+                "rows": _records(frame)}
+
+    def forecast(self, params, dataset=None):
+        table = self._table(dataset)
+        model_name = params.get("model", "XGBoost")
+        key, scaler, model = self._model(model_name)
+        features = list(scaler.feature_names_in_)
+
+        # Lags and rolling windows need the whole series, so the date range is applied after building them
+        frame = self.db_manager.load_simulation_frame(
+            table, columns=["run_id", "scenario_id", "date"] + DATA_COLUMNS, run_ids=_id_list(params, "run_id"),
+            scenario_ids=_id_list(params, "scenario_id"),
+        )
+        feature_frame = build_features(frame).dropna(subset=features)
+        if "start" in params:
+            feature_frame = feature_frame[feature_frame["date"] >= params["start"]]
+        if "end" in params:
+            feature_frame = feature_frame[feature_frame["date"] <= params["end"]]
+
+        result = feature_frame[["run_id", "scenario_id", "date", "shortage_level"]].copy()
+        if len(feature_frame):
+            result["predicted_shortage_level"] = model.predict(scaler.transform(feature_frame[features]))
+        else:
+            result["predicted_shortage_level"] = np.array([], dtype=float)
+        count("service.predictions", len(result))
+        return {"model": model_name, "fingerprint": key, "features": features, "rows": _records(result)}
+
+    def summary(self, params, dataset=None):
+        table = self._table(dataset)
+        group_by = params["group_by"].split(",") if params.get("group_by") else ["month_name"]
+        if set(group_by) - set(SUMMARY_GROUPS):
+            raise HTTPError(HTTPStatus.BAD_REQUEST, f"'group_by' must be a subset of {SUMMARY_GROUPS}.")
+
+        frame = self.db_manager.load_summary(
+            table, group_by=group_by, run_ids=_id_list(params, "run_id"),
+            scenario_ids=_id_list(params, "scenario_id"),
+            month_names=params["month"].split(",") if "month" in params else None,
+            product_ids=_id_list(params, "product_id"), site_ids=_id_list(params, "site_id"),
+        )
+        return {"group_by": group_by, "rows": _records(frame)}
+
+    def stats(self, params):
+        return {"cache_entries": len(self.cache), "models_loaded": sorted(self.models), **metrics.snapshot()}
+
+    def _table(self, dataset):
+        if dataset not in DATASETS:
+            raise HTTPError(HTTPStatus.NOT_FOUND, f"Unknown dataset '{dataset}'. Choose from {list(DATASETS)}.")
+        return DATASETS[dataset]
+
+    def _model(self, model_name):
+        """
+        (fingerprint, scaler, model) of the newest stored `model_name`, loaded once.
+        """
+        with self._model_lock:
+            if model_name not in self.models:
+                key = self.registry.latest_key(model_name)
+                stored = self.registry.load(model_name, key) if key is not None else None
+                if stored is None:
+                    raise HTTPError(HTTPStatus.NOT_FOUND, f"No fitted model '{model_name}' in the registry.")
+                scaler, model, _ = stored
+                self.models[model_name] = (key, scaler, model)
+                count("service.models_loaded")
+            return self.models[model_name]
+
+    # HTTP plumbing
+
+    async def respond(self, target):
+        """
+        Status and JSON body for a GET of `target`, from the cache if possible.
+        """
+        url = urlsplit(target)
+        parts = [part for part in url.path.split("/") if part]
+        params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        if not parts or parts[0] not in self.routes:
+            return HTTPStatus.NOT_FOUND, _json({"error": f"Unknown path '{url.path}'."})
+
+        cacheable = parts[0] not in ("health", "stats")
+        key = (tuple(parts), tuple(sorted(params.items())))
+        if cacheable:
+            cached = self.cache.get(key)
+            if cached is not None:
+                count("service.cache_hits")
+                return cached
+            if key in self._inflight:
+                count("service.coalesced")
+                return await asyncio.shield(self._inflight[key])
+            count("service.cache_misses")
+
+        future = asyncio.get_running_loop().run_in_executor(self.executor, self._call, parts, params)
+        if cacheable:
+            self._inflight[key] = future
+        try:
+            response = await future
+        finally:
+            self._inflight.pop(key, None)
+        if cacheable and response[0] == HTTPStatus.OK:
+            self.cache.put(key, response)
+        return response
+
+    def _call(self, parts, params):
+        try:
+            with timed(f"service.{parts[0]}"):
+                payload = self.routes[parts[0]](params, *parts[1:])
+            return HTTPStatus.OK, _json(payload)
+        except HTTPError as error:
+            return error.status, _json({"error": str(error)})
+        except (TypeError, ValueError) as error:
+            return HTTPStatus.BAD_REQUEST, _json({"error": str(error)})
+        except Exception as error:
+            # Answer instead of dropping the connection; the details stay in the server log
+            count("service.errors")
+            traceback.print_exc()
+            return HTTPStatus.INTERNAL_SERVER_ERROR, _json({"error": f"Internal error ({type(error).__name__})."})
+
+    async def handle_connection(self, reader, writer):
+        """
+        Serve HTTP/1.1 GET requests on one connection, keeping it alive between requests.
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, version = request_line.decode("latin-1").split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                if int(headers.get("content-length", 0)):
+                    await reader.readexactly(int(headers["content-length"]))
+
+                if method != "GET":
+                    status, body = HTTPStatus.METHOD_NOT_ALLOWED, _json({"error": "Only GET is supported."})
+                else:
+                    status, body = await self.respond(target)
+
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                writer.write(
+                    f"HTTP/1.1 {status.value} {status.phrase}\r\nContent-Type: application/json\r\n"
+                    f"Content-Length: {len(body)}\r\nConnection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+                    .encode("latin-1") + body
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=8000):
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print(f"Serving on http://{host}:{port} (pool of {self.pool_size} connections).")
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        self.executor.shutdown()
+        self.engine.dispose()
+
+
+def _int_param(params, name, default):
+    try:
+        return int(params.get(name, default))
+    except ValueError:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, f"'{name}' must be an integer.")
+
+
+def _id_list(params, name):
+    """
+    Comma-separated ids of a query parameter, or None if it is not given.
+    """
+    if name not in params:
+        return None
+    try:
+        return [int(value) for value in params[name].split(",")]
+    except ValueError:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, f"'{name}' must be a comma-separated list of integers.")
+
+
+def _records(frame):
+    # NaN is not valid JSON; missing values become null
+    return json.loads(frame.to_json(orient="records"))
+
+
+def _json(payload):
+    return json.dumps(payload, default=float).encode()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Serve simulations and shortage forecasts over HTTP.")
+    parser.add_argument("--db", default="simulation_3nf.db", help="Simulation database.")
+    parser.add_argument("--model-dir", default="./models", help="Directory of the model registry.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--pool-size", type=int, default=4, help="Database connections and query threads.")
+    parser.add_argument("--cache-size", type=int, default=256, help="Cached responses (LRU).")
+    parser.add_argument("--ttl", type=float, default=60.0, help="Seconds a cached response stays valid.")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    service = QueryService(args.db, args.model_dir, args.pool_size, args.cache_size, args.ttl)
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
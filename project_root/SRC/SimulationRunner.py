@@ -0,0 +1,84 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from DataSimulator import DataSimulator
+from utils import metrics
+
+
+def simulate_job(job, seed_sequence):
+    """
+    Run one simulator configuration. Executed inside a worker process.
+
+    A job is a dict with optional keys:
+    - `random_state`: fixed seed; otherwise one is derived from `seed_sequence`
+    - `n_scenarios`: number of batch scenarios; None runs the single-scenario simulation
+    - `simulator_args`: extra keyword arguments for `DataSimulator`
+
+    Returns the run parameters, the seed, the simulation and the worker's metrics for this job.
+    The parameters hold the root `entropy` and `spawn_key` of `seed_sequence`,
+    so `job_seed_sequence` can recreate the stream from the stored run.
+    """
+    metrics.reset()
+    random_state = job.get('random_state')
+    if random_state is None:
+        random_state = int(seed_sequence.generate_state(1)[0])
+
+    simulator = DataSimulator(random_state=random_state, **job.get('simulator_args', {}))
+    if job.get('n_scenarios') is None:
+        simulation = simulator.simulate_sales_and_stock()
+    else:
+        seed = seed_sequence if job.get('random_state') is None else random_state
+        simulation = simulator.simulate_batch(job['n_scenarios'], seed=seed)
+
+    parameters = simulator.run_parameters()
+    parameters['n_scenarios'] = job.get('n_scenarios')
+    # As a string: the root entropy is a 128-bit integer when no seed was given
+    parameters['entropy'] = str(seed_sequence.entropy)
+    parameters['spawn_key'] = list(seed_sequence.spawn_key)
+    return parameters, random_state, simulation, metrics.snapshot()
+
+
+def job_seed_sequence(parameters):
+    """
+    The `SeedSequence` a job ran with, from the parameters stored with its run.
+    Re-running the job with it as `seed_sequence` reproduces the simulation.
+    """
+    return np.random.SeedSequence(int(parameters['entropy']), spawn_key=tuple(parameters['spawn_key']))
+
+
+def run_simulations(jobs, db_manager=None, max_workers=None, seed=None):
+    """
+    Fan simulation jobs out over a process pool.
+
+    Every job gets an independent, reproducible stream spawned from
+    `np.random.SeedSequence(seed)`. Results are written to the database by this
+    (parent) process only, in job order, so SQLite never sees concurrent writers.
+    Jobs that should be stored need a `table` key with the target ORM class.
+
+    Returns one dict per job with `job`, `run_id`, `simulation`, `parameters`
+    and the `random_state` the job ran with.
+    """
+    max_workers = max_workers or os.cpu_count()
+    seed_sequences = np.random.SeedSequence(seed).spawn(len(jobs))
+    results = []
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(simulate_job, job, seed_sequence)
+                   for job, seed_sequence in zip(jobs, seed_sequences)]
+
+        # Later jobs keep running while the finished ones are written
+        for job, future in zip(jobs, futures):
+            parameters, random_state, simulation, job_metrics = future.result()
+            metrics.merge(job_metrics)
+
+            run_id = None
+            if db_manager is not None and job.get('table') is not None:
+                run_id = db_manager.create_simulation_run(parameters, seed=random_state)
+                db_manager.bulk_save_simulation_to_db(simulation, job['table'], run_id=run_id)
+
+            results.append({'job': job, 'run_id': run_id, 'simulation': simulation,
+                            'parameters': parameters, 'random_state': random_state})
+
+    return results
@@ -0,0 +1,132 @@
+import os
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.fs
+
+
+# Narrow dtypes for the simulation columns; other float columns become float32
+COMPACT_DTYPES = {
+    'shortage_level': 'int8',
+    'demand_spike_indicator': 'int8',
+    'days_since_last_restock': 'int16',
+    'cumulative_shortages': 'int16',
+    'month_name': 'category',
+    'date': 'category',
+    'scenario_id': 'int32',
+    'product_id': 'int32',
+    'site_id': 'int32',
+}
+
+# Columns that identify one series inside a run; network runs add product and site
+SERIES_KEYS = ('product_id', 'site_id', 'scenario_id')
+
+# Hive-style partitions per run (<dataset>/run_id=<run>/); inside a run, rows are
+# clustered by scenario so every row group covers a contiguous block of scenarios
+PARTITIONING = ds.partitioning(pa.schema([('run_id', pa.string())]), flavor='hive')
+SCENARIOS_PER_ROW_GROUP = 64
+
+FILE_FORMATS = {'feather': 'ipc', 'parquet': 'parquet'}
+
+
+def compact_dtypes(simulation_df):
+    """
+    Downcast a simulation frame to the narrow storage dtypes.
+    """
+    compact = simulation_df.copy()
+    for column in compact.columns:
+        if column in COMPACT_DTYPES:
+            compact[column] = compact[column].astype(COMPACT_DTYPES[column])
+        elif compact[column].dtype == np.float64:
+            compact[column] = compact[column].astype(np.float32)
+    return compact
+
+
+class SimulationStore:
+    """
+    Columnar store for simulation outputs, partitioned by run and clustered by scenario.
+
+    The default "feather" format writes uncompressed Arrow IPC files, which are
+    read through memory maps without copying; "parquet" is smaller on disk but
+    has to be decoded. CSV is only offered as an export.
+    """
+
+    def __init__(self, root_dir="./simulation_store", file_format="feather"):
+        if file_format not in FILE_FORMATS:
+            raise ValueError(f"Unknown format '{file_format}'. Choose from {list(FILE_FORMATS)}.")
+        self.root_dir = os.path.abspath(root_dir)
+        self.file_format = file_format
+        os.makedirs(self.root_dir, exist_ok=True)
+
+    def _dataset_dir(self, name):
+        return os.path.join(self.root_dir, name)
+
+    def exists(self, name, run_id=None):
+        path = self._dataset_dir(name) if run_id is None else os.path.join(self._dataset_dir(name), f'run_id={run_id}')
+        return os.path.isdir(path) and any(files for _, _, files in os.walk(path))
+
+    def write(self, name, simulation_df, run_id):
+        """
+        Write one run of a dataset, replacing the partitions of that run that already exist.
+        """
+        if 'scenario_id' not in simulation_df.columns:
+            simulation_df = simulation_df.assign(scenario_id=0)
+        series_keys = [key for key in SERIES_KEYS if key in simulation_df.columns]
+        partitioned = compact_dtypes(simulation_df.sort_values(series_keys + ['date'], kind='stable'))
+        partitioned['run_id'] = str(run_id)
+
+        n_series = len(partitioned[series_keys].drop_duplicates())
+        rows_per_scenario = max(1, len(partitioned) // max(1, n_series))
+        ds.write_dataset(
+            pa.Table.from_pandas(partitioned, preserve_index=False),
+            self._dataset_dir(name),
+            format=FILE_FORMATS[self.file_format],
+            partitioning=PARTITIONING,
+            basename_template='part-{i}.' + self.file_format,
+            max_rows_per_group=SCENARIOS_PER_ROW_GROUP * rows_per_scenario,
+            existing_data_behavior='delete_matching',
+            # read_table relies on the sorted row order inside each run
+            preserve_order=True,
+        )
+
+    def dataset(self, name):
+        """
+        The Arrow dataset behind `name`, opened with memory-mapped files.
+        """
+        return ds.dataset(self._dataset_dir(name), format=FILE_FORMATS[self.file_format], partitioning=PARTITIONING,
+                          filesystem=pyarrow.fs.LocalFileSystem(use_mmap=True))
+
+    def read_table(self, name, run_ids=None, scenario_ids=None, columns=None):
+        """
+        Read an Arrow table. Run filters only open the matching partitions;
+        Parquet also skips row groups outside the scenario filter.
+        """
+        expression = None
+        if run_ids is not None:
+            expression = ds.field('run_id').isin([str(run_id) for run_id in run_ids])
+        if scenario_ids is not None:
+            scenario_filter = ds.field('scenario_id').isin(list(scenario_ids))
+            expression = scenario_filter if expression is None else expression & scenario_filter
+
+        # Rows are written sorted within each run partition, so ordering the
+        # partitions by run restores the full order without copying any rows
+        dataset = self.dataset(name)
+        fragments = sorted(dataset.get_fragments(filter=expression),
+                           key=lambda fragment: (str(ds.get_partition_keys(fragment.partition_expression)
+                                                     .get('run_id', '')), fragment.path))
+        ordered = ds.FileSystemDataset(fragments, dataset.schema, dataset.format, dataset.filesystem)
+        return ordered.to_table(columns=columns, filter=expression)
+
+    def read(self, name, run_ids=None, scenario_ids=None, columns=None):
+        """
+        Read a dataset into pandas, keeping the narrow dtypes.
+        """
+        return self.read_table(name, run_ids, scenario_ids, columns).to_pandas()
+
+    def export_csv(self, name, csv_path, run_ids=None, scenario_ids=None):
+        """
+        Export (part of) a dataset as CSV.
+        """
+        self.read(name, run_ids, scenario_ids).to_csv(csv_path, index=False)
+        return csv_path
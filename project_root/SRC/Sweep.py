@@ -0,0 +1,145 @@
+import itertools
+
+import numpy as np
+import pandas as pd
+from scipy.stats import qmc
+
+from Constants import SHORTAGE_THRESHOLD
+from DataSimulator import DataSimulator, SCENARIO_PARAMETERS
+from utils import count, timed
+
+
+# Parameters that only make sense as whole numbers (months between restocks)
+INTEGER_PARAMETERS = {'wirkstoff_restock_interval'}
+
+METRIC_COLUMNS = ['mean_shortage_level', 'shortage_months', 'first_shortage_month', 'shortage_probability']
+
+
+def parameter_grid(ranges):
+    """
+    Full factorial grid from {parameter: values}. Returns {parameter: array} with one entry per point.
+    """
+    names = list(ranges)
+    combinations = np.array(list(itertools.product(*(ranges[name] for name in names))), dtype=float)
+    return _finish_points(names, combinations)
+
+
+def latin_hypercube(bounds, n_points, seed=None):
+    """
+    Latin-hypercube sample of `n_points` within {parameter: (low, high)}.
+    """
+    sampler = qmc.LatinHypercube(d=len(bounds), seed=seed)
+    return _scale_sample(bounds, sampler.random(n_points))
+
+
+def sobol(bounds, n_points, seed=None):
+    """
+    Scrambled Sobol sample of `n_points` within {parameter: (low, high)}.
+    Sobol points are balanced for powers of two, so `n_points` is rounded up to one.
+    """
+    sampler = qmc.Sobol(d=len(bounds), scramble=True, seed=seed)
+    return _scale_sample(bounds, sampler.random_base2(int(np.ceil(np.log2(max(n_points, 1))))))
+
+
+SAMPLERS = {
+    'lhs': latin_hypercube,
+    'sobol': sobol,
+}
+
+
+def _scale_sample(bounds, unit_sample):
+    names = list(bounds)
+    low, high = np.array([bounds[name] for name in names], dtype=float).T
+    if any(name in INTEGER_PARAMETERS for name in names):
+        # Stretch integer ranges by one so both ends are drawn as often as the values between them
+        high = high + np.array([name in INTEGER_PARAMETERS for name in names])
+    return _finish_points(names, qmc.scale(unit_sample, low, high) if len(unit_sample) else unit_sample)
+
+
+def _finish_points(names, values):
+    unknown = set(names) - set(SCENARIO_PARAMETERS)
+    if unknown:
+        raise ValueError(f"Unknown parameters {sorted(unknown)}. Choose from {SCENARIO_PARAMETERS}.")
+    points = {}
+    for i, name in enumerate(names):
+        column = values[:, i]
+        points[name] = np.maximum(np.floor(column), 1).astype(int) if name in INTEGER_PARAMETERS else column
+    return points
+
+
+def shortage_metrics(shortage_level):
+    """
+    Shortage metrics per row of a (n_scenarios, months) shortage-level array:
+    mean level, number of months at or above `SHORTAGE_THRESHOLD` and the first
+    such month (NaN if there is none).
+    """
+    shortage = shortage_level >= SHORTAGE_THRESHOLD
+    any_shortage = shortage.any(axis=1)
+    return {
+        'mean_shortage_level': shortage_level.mean(axis=1),
+        'shortage_months': shortage.sum(axis=1),
+        'first_shortage_month': np.where(any_shortage, shortage.argmax(axis=1), np.nan),
+        'shortage_probability': any_shortage.astype(float),
+    }
+
+
+@timed('sweep.run_sweep')
+def run_sweep(points, simulator=None, replications=1, batch_size=10_000, seed=None):
+    """
+    Simulate every parameter point and summarize its shortages.
+
+    `points` is {parameter: array} as returned by `parameter_grid` or one of the
+    `SAMPLERS`; parameters not in `points` keep the simulator's base values
+    (with the usual scenario jitter). Every point is simulated `replications`
+    times with independent noise, in vectorized batches of at most `batch_size`
+    scenarios, so no per-point Python loop runs. Results depend on `seed` and
+    `batch_size`.
+
+    Returns one row per point with the parameter values and the metrics averaged
+    over the replications; `shortage_probability` is the share of replications
+    with at least one shortage month.
+    """
+    simulator = simulator or DataSimulator()
+    points = {name: np.asarray(values) for name, values in points.items()}
+    n_points = len(next(iter(points.values())))
+    dates = simulator.get_dates()
+    rng = np.random.default_rng(seed)
+
+    # Scenario i simulates point i // replications
+    scenario_points = np.repeat(np.arange(n_points), replications)
+    totals = {name: np.zeros(n_points) for name in METRIC_COLUMNS}
+    first_shortage_counts = np.zeros(n_points)
+
+    for start in range(0, len(scenario_points), batch_size):
+        batch_points = scenario_points[start:start + batch_size]
+        params = simulator.draw_scenario_parameters(len(batch_points), rng)
+        for name, values in points.items():
+            params[name] = values[batch_points]
+
+        noise = simulator._draw_batch_noise(params, dates, rng)
+        paths = simulator._simulate_paths(params, noise, dates, simulator.engine)
+        metrics = shortage_metrics(paths['shortage_level'])
+
+        for name, values in metrics.items():
+            np.add.at(totals[name], batch_points, np.nan_to_num(values))
+        np.add.at(first_shortage_counts, batch_points, ~np.isnan(metrics['first_shortage_month']))
+        count('sweep.scenarios', len(batch_points))
+
+    summary = pd.DataFrame(points)
+    for name in METRIC_COLUMNS:
+        summary[name] = totals[name] / replications
+    # The first shortage month is averaged over the replications that had a shortage
+    with np.errstate(invalid='ignore', divide='ignore'):
+        summary['first_shortage_month'] = totals['first_shortage_month'] / first_shortage_counts
+    return summary
+
+
+def sensitivity(summary, metric='mean_shortage_level'):
+    """
+    Rank-correlation of every swept parameter with a metric, strongest first.
+    A quick global sensitivity measure for LHS or Sobol sweeps.
+    """
+    parameters = [column for column in summary.columns if column in SCENARIO_PARAMETERS]
+    ranks = summary[parameters + [metric]].rank()
+    correlation = ranks[parameters].corrwith(ranks[metric])
+    return correlation.reindex(correlation.abs().sort_values(ascending=False).index)
@@ -1,2 +1,205 @@
+import cProfile
+import functools
+import io
+import json
+import os
+import platform
+import pstats
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+
 def yap(message):
-    print(message)
\ No newline at end of file
+    print(message)
+
+
+class Metrics:
+    """
+    Timings and counters of the current process.
+
+    Timings are aggregated per name (calls, total, min and max seconds);
+    counters are plain integers. Stage profiles hold the cProfile and
+    tracemalloc summaries captured by `profile_stage`.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.timings = {}
+            self.counters = {}
+            self.profiles = {}
+
+    def add_timing(self, name, seconds):
+        with self._lock:
+            timing = self.timings.setdefault(name, {"calls": 0, "total": 0.0, "min": seconds, "max": seconds})
+            timing["calls"] += 1
+            timing["total"] += seconds
+            timing["min"] = min(timing["min"], seconds)
+            timing["max"] = max(timing["max"], seconds)
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + int(amount)
+
+    def add_profile(self, name, profile):
+        with self._lock:
+            self.profiles[name] = profile
+
+    def snapshot(self):
+        """
+        Copy of all metrics, e.g. to send them from a worker process to the parent.
+        """
+        with self._lock:
+            return json.loads(json.dumps({"timings": self.timings, "counters": self.counters,
+                                          "profiles": self.profiles}))
+
+    def merge(self, snapshot):
+        """
+        Add the metrics of another process (a `snapshot`) to this one.
+        """
+        with self._lock:
+            for name, other in snapshot["timings"].items():
+                timing = self.timings.setdefault(name, {"calls": 0, "total": 0.0, "min": other["min"],
+                                                        "max": other["max"]})
+                timing["calls"] += other["calls"]
+                timing["total"] += other["total"]
+                timing["min"] = min(timing["min"], other["min"])
+                timing["max"] = max(timing["max"], other["max"])
+            for name, amount in snapshot["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + amount
+            self.profiles.update(snapshot.get("profiles", {}))
+
+
+# Metrics of this process; worker processes send theirs back with `snapshot`/`merge`
+metrics = Metrics()
+
+
+def count(name, amount=1):
+    """
+    Increase the counter `name`, e.g. count("db.rows_inserted", len(df)).
+    """
+    metrics.count(name, amount)
+
+
+class timed:
+    """
+    Time a block or a function under `name`.
+
+        with timed("db.bulk_insert"):
+            ...
+
+        @timed("simulator.simulate_batch")
+        def simulate_batch(...):
+            ...
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.elapsed = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed = time.perf_counter() - self._start
+        metrics.add_timing(self.name, self.elapsed)
+        return False
+
+    def __call__(self, function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with timed(self.name):
+                return function(*args, **kwargs)
+        return wrapper
+
+
+@contextmanager
+def profile_stage(name, cprofile=False, memory=False, top=20):
+    """
+    Time a pipeline stage and optionally capture a cProfile summary (the `top`
+    functions by cumulative time) and the tracemalloc peak and top allocations.
+    """
+    modules_before = len(sys.modules)
+    profiler = cProfile.Profile() if cprofile else None
+    started_tracing = memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    elif memory:
+        tracemalloc.reset_peak()
+    if profiler is not None:
+        profiler.enable()
+
+    try:
+        with timed(f"stage.{name}"):
+            yield
+    finally:
+        # Heavy dependencies are imported by the stages that need them; count where they land
+        count(f"stage.{name}.modules_imported", len(sys.modules) - modules_before)
+        profile = {}
+        if profiler is not None:
+            profiler.disable()
+            profile["cprofile"] = _cprofile_summary(profiler, top)
+        if memory:
+            snapshot = tracemalloc.take_snapshot()
+            profile["memory"] = {
+                "peak_mb": tracemalloc.get_traced_memory()[1] / 1e6,
+                "top": [{"location": str(stat.traceback), "size_mb": stat.size / 1e6, "count": stat.count}
+                        for stat in snapshot.statistics("lineno")[:top]],
+            }
+            if started_tracing:
+                tracemalloc.stop()
+        if profile:
+            metrics.add_profile(name, profile)
+
+
+def _cprofile_summary(profiler, top):
+    stats = pstats.Stats(profiler, stream=io.StringIO())
+    rows = []
+    for (file_name, line, function), (_, calls, own_time, cumulative_time, _) in stats.stats.items():
+        rows.append({"function": f"{os.path.basename(file_name)}:{line}({function})", "calls": calls,
+                     "own_seconds": own_time, "cumulative_seconds": cumulative_time})
+    return sorted(rows, key=lambda row: row["cumulative_seconds"], reverse=True)[:top]
+
+
+def import_times(modules):
+    """
+    Cold import time in seconds of every module, each measured in a fresh
+    interpreter with `-X importtime` (the module plus everything it imports).
+    """
+    times = {}
+    for module in modules:
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output=True,
+                                text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        # Lines read "import time: <self us> | <cumulative us> | <indented module name>"
+        for line in result.stderr.splitlines():
+            fields = line.split("|")
+            if len(fields) == 3 and fields[2].strip() == module:
+                times[module] = int(fields[1]) / 1e6
+    return times
+
+
+def run_report(path=None, **details):
+    """
+    Machine-readable report of the metrics of this run, with any extra `details`
+    (config, stage results). Written as JSON when `path` is given.
+    """
+    report = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        **details,
+        **metrics.snapshot(),
+    }
+    if path is not None:
+        with open(path, "w") as report_file:
+            json.dump(report, report_file, indent=2, default=str)
+    return report